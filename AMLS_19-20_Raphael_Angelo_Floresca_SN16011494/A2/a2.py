@@ -1,10 +1,15 @@
-from pipeline.datasets.celeba_smiling import create_smiling_df, create_smiling_test_df
-from pipeline.datasets.utilities import get_X_y_test_sets, go_up_three_dirs, create_train_datagens, create_test_datagen, data_dir, test_dir, celeba_dir, celeba_test_dir
+from pipeline.datasets.celeba_smiling import create_smiling_labels, create_smiling_test_labels
+from pipeline.datasets.utilities import create_train_inputs, create_test_datagen, celeba_root, celeba_test_root
+from pipeline.datasets.dataset_root import get_output_path
 from pipeline.models.mlp import train_mlp
 from pipeline.models.cnn import train_cnn
 from pipeline.models.xception import train_xception
-from pipeline.plotting.plotting import plot_train_loss_acc_lr, plot_top_losses, plot_grad_cam
-import os
+from pipeline.models.distillation import train_distilled, create_distillation_inputs
+from pipeline.models.artifact_store import get_task_artifact
+from pipeline.plotting.plotting import plot_train_loss_acc_lr, plot_top_losses_data, plot_grad_cam_data
+from pipeline.evaluation.streaming import evaluate_streaming
+from pipeline.optimisation.step_timing import get_step_timing_path
+from pipeline.optimisation.adaptive_budget import get_val_acc
 from tensorflow.keras.applications.xception import preprocess_input
 
 class A2:
@@ -13,34 +18,67 @@ class A2:
     num_classes = 2
     batch_size = 32
     random_state = 42
-    train_df = create_smiling_df()
-    test_df = create_smiling_test_df()
-
-    os.chdir(os.path.join(data_dir,celeba_dir))
-
-    train_gen, val_gen = create_train_datagens(
-        height,
-        width,
-        train_df,
-        "celeba",
-        "img_name",
-        "smiling",
-        batch_size,
-        random_state,
-        None)
-
-    os.chdir(os.path.join(test_dir,celeba_test_dir))
-
-    test_gen = create_test_datagen(
-        height,
-        width,
-        test_df,
-        "celeba",
-        "img_name",
-        "smiling",
-        batch_size,
-        random_state,
-        None)
+
+    # Labels and generators are only built the first time they are needed,
+    # then memoised for every model of this task
+    loaded = {}
+
+    @staticmethod
+    def get_train_labels():
+        if "train_labels" not in A2.loaded:
+            A2.loaded["train_labels"] = create_smiling_labels()
+        return A2.loaded["train_labels"]
+
+    @staticmethod
+    def get_test_labels():
+        if "test_labels" not in A2.loaded:
+            A2.loaded["test_labels"] = create_smiling_test_labels()
+        return A2.loaded["test_labels"]
+
+    # With cache_eval_batches, the validation batches of the 'keras' input
+    # backend are computed once and kept in memory for every epoch
+    @staticmethod
+    def get_train_val_gens(input_backend="keras", cache_eval_batches=False):
+        key = "train_gens_" + input_backend
+        kwargs = {}
+        if input_backend == "keras" and cache_eval_batches:
+            key += "_cached_eval"
+            kwargs["cache_eval_batches"] = True
+        if key not in A2.loaded:
+            train_labels = A2.get_train_labels()
+
+            A2.loaded[key] = create_train_inputs(
+                input_backend,
+                A2.height,
+                A2.width,
+                train_labels,
+                "celeba",
+                "img_name",
+                "smiling",
+                A2.batch_size,
+                A2.random_state,
+                None,
+                celeba_root,
+                **kwargs)
+        return A2.loaded[key]
+
+    @staticmethod
+    def get_test_gen():
+        if "test_gen" not in A2.loaded:
+            test_labels = A2.get_test_labels()
+
+            A2.loaded["test_gen"] = create_test_datagen(
+                A2.height,
+                A2.width,
+                test_labels,
+                "celeba",
+                "img_name",
+                "smiling",
+                A2.batch_size,
+                A2.random_state,
+                None,
+                celeba_test_root)
+        return A2.loaded["test_gen"]
 
 class A2MLP(A2):
     def __init__(
@@ -50,14 +88,16 @@ class A2MLP(A2):
             schedule_type,
             find_lr,
             random_state,
+            input_backend="keras",
+            step_timing=None,
+            budget=None,
+            strategy=None,
+            cache_eval_batches=False,
             first_af="relu",
             second_af="relu",
             layer1_hn=300,
             layer2_hn=100):
 
-        # Change to relevant image set directory
-        os.chdir(os.path.join(data_dir, celeba_dir))
-
         # Change random state according to constructor
         self.random_state = random_state
         A2.random_state = self.random_state
@@ -66,7 +106,33 @@ class A2MLP(A2):
         self.find_lr = find_lr
         self.schedule_type = schedule_type
 
-        self.train_gen, self.val_gen = A2.train_gen, A2.val_gen
+        self.train_gen, self.val_gen = A2.get_train_val_gens(input_backend, cache_eval_batches)
+
+        # Trained weights (or the learning rate finder curve) are reused by runs
+        # with the same configuration
+        artifact = get_task_artifact(
+            "A2",
+            "mlp",
+            celeba_root,
+            find_lr,
+            height=A2.height,
+            width=A2.width,
+            batch_size=A2.batch_size,
+            epochs=epochs,
+            learning_rate=learning_rate,
+            schedule_type=schedule_type,
+            random_state=random_state,
+            input_backend=input_backend,
+            first_af=first_af,
+            second_af=second_af,
+            layer1_hn=layer1_hn,
+            layer2_hn=layer2_hn,
+            budget=budget.config if budget is not None else None)
+
+        # Every worker of a data-parallel run trains, as the others would wait
+        # on it otherwise, so no weights are reused
+        if strategy is not None:
+            artifact = None
         
         if find_lr == True:
             self.lr_finder = train_mlp(
@@ -83,7 +149,8 @@ class A2MLP(A2):
             first_af,
             second_af,
             layer1_hn,
-            layer2_hn)
+            layer2_hn,
+            artifact=artifact)
         else:
             print("[INFO] Training MLP...")
             self.model, self.history, self.schedule = train_mlp(
@@ -100,21 +167,21 @@ class A2MLP(A2):
                 first_af,
                 second_af,
                 layer1_hn,
-                layer2_hn)
+                layer2_hn,
+                get_step_timing_path("A2_mlp", step_timing),
+                artifact,
+                budget,
+                strategy)
 
     def train(self):
         if self.find_lr == True:
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()        
 
             # Plot learning rate finder plot
             self.lr_finder.plot_loss(
-                "output/lr_finder_plot_A2.png"
+                get_output_path("lr_finder_plot_A2.png")
             )
         else:
             # Plot training loss accuracy and learning rate change
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()
 
             plot_train_loss_acc_lr(
                 self.history,
@@ -122,28 +189,26 @@ class A2MLP(A2):
                 self.schedule,
                 self.schedule_type,
                 "A2",
-                "output/train_loss_acc_A2_mlp.png",
-                "output/lr_A2_mlp.png")
+                get_output_path("train_loss_acc_A2_mlp.png"),
+                get_output_path("lr_A2_mlp.png"))
 
-            # Get the training accuracy
-            training_accuracy = self.history.history['val_acc'][-1]
+            # Get the validation accuracy of the weights the model was left with
+            training_accuracy = get_val_acc(self.history)
             return training_accuracy
 
     def test(self):
-        # Go back to image folder
-        os.chdir("data/dataset_test_AMLS_19-20/celeba_test")
-
-        # Split ImageDataGenerator object for the test set into separate X and y test sets
-        X_test, y_test = get_X_y_test_sets(self.test_gen)
+        self.test_gen = A2.get_test_gen()
 
-        # Navigate to output folder in parent directory
-        go_up_three_dirs()
+        # Evaluate the test set in bounded batches, only keeping the images
+        # needed for the plots below
+        evaluation = evaluate_streaming(self.model, self.test_gen, A2.num_classes)
 
         # Plot top losses
-        plot_top_losses(self.model, X_test, y_test, "output/plot_top_losses_A2_mlp.png")
+        loss_pred_data, loss_images = evaluation.get_loss_pred_data()
+        plot_top_losses_data(loss_pred_data, loss_images, get_output_path("plot_top_losses_A2_mlp.png"))
 
         # Get the test accuracy
-        test_accuracy = self.model.evaluate(X_test, y_test)[-1]
+        test_accuracy = evaluation.accuracy
         return test_accuracy
 
 
@@ -155,13 +220,15 @@ class A2CNN(A2):
             schedule_type,
             find_lr,
             random_state,
+            input_backend="keras",
+            step_timing=None,
+            budget=None,
+            strategy=None,
+            cache_eval_batches=False,
             num_start_filters=16,
             kernel_size=3,
             fcl_size=512):
 
-        # Change to relevant image set directory
-        os.chdir(os.path.join(data_dir, celeba_dir))
-
         # Change random state according to constructor
         self.random_state = random_state
         A2.random_state = self.random_state
@@ -170,7 +237,32 @@ class A2CNN(A2):
         self.find_lr = find_lr
         self.schedule_type = schedule_type
 
-        self.train_gen, self.val_gen = A2.train_gen, A2.val_gen
+        self.train_gen, self.val_gen = A2.get_train_val_gens(input_backend, cache_eval_batches)
+
+        # Trained weights (or the learning rate finder curve) are reused by runs
+        # with the same configuration
+        artifact = get_task_artifact(
+            "A2",
+            "cnn",
+            celeba_root,
+            find_lr,
+            height=A2.height,
+            width=A2.width,
+            batch_size=A2.batch_size,
+            epochs=epochs,
+            learning_rate=learning_rate,
+            schedule_type=schedule_type,
+            random_state=random_state,
+            input_backend=input_backend,
+            num_start_filters=num_start_filters,
+            kernel_size=kernel_size,
+            fcl_size=fcl_size,
+            budget=budget.config if budget is not None else None)
+
+        # Every worker of a data-parallel run trains, as the others would wait
+        # on it otherwise, so no weights are reused
+        if strategy is not None:
+            artifact = None
         
         if find_lr == True:
             self.lr_finder = train_cnn(
@@ -186,7 +278,8 @@ class A2CNN(A2):
             self.val_gen,
             num_start_filters,
             kernel_size,
-            fcl_size)
+            fcl_size,
+            artifact=artifact)
         else:
             print("[INFO] Training CNN...")
             self.model, self.history, self.schedule = train_cnn(
@@ -202,21 +295,21 @@ class A2CNN(A2):
                 self.val_gen,
                 num_start_filters,
                 kernel_size,
-                fcl_size)
+                fcl_size,
+                get_step_timing_path("A2_cnn", step_timing),
+                artifact,
+                budget,
+                strategy)
 
     def train(self):
         if self.find_lr == True:
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()        
 
             print("[INFO] Creating learning rate finder plot...")
             # Plot learning rate finder plot
             self.lr_finder.plot_loss(
-                "output/lr_finder_plot_A2.png")
+                get_output_path("lr_finder_plot_A2.png"))
         else:
             # Plot training loss accuracy and learning rate change
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()
 
             plot_train_loss_acc_lr(
                 self.history,
@@ -224,31 +317,30 @@ class A2CNN(A2):
                 self.schedule,
                 self.schedule_type,
                 "A2",
-                "output/train_loss_acc_A2_cnn.png",
-                "output/lr_A2_cnn.png")
+                get_output_path("train_loss_acc_A2_cnn.png"),
+                get_output_path("lr_A2_cnn.png"))
 
-            # Get the training accuracy
-            training_accuracy = self.history.history['val_acc'][-1]
+            # Get the validation accuracy of the weights the model was left with
+            training_accuracy = get_val_acc(self.history)
             return training_accuracy
 
     def test(self):
-        # Go back to image folder
-        os.chdir("data/dataset_test_AMLS_19-20/celeba_test")
+        self.test_gen = A2.get_test_gen()
 
-        # Split ImageDataGenerator object for the test set into separate X and y test sets
-        X_test, y_test = get_X_y_test_sets(self.test_gen)
-
-        # Navigate to output folder in parent directory
-        go_up_three_dirs()
+        # Evaluate the test set in bounded batches, only keeping the images
+        # needed for the plots below
+        evaluation = evaluate_streaming(self.model, self.test_gen, A2.num_classes)
 
         # Plot top losses
-        plot_top_losses(self.model, X_test, y_test, "output/plot_top_losses_A2_cnn.png")
+        loss_pred_data, loss_images = evaluation.get_loss_pred_data()
+        plot_top_losses_data(loss_pred_data, loss_images, get_output_path("plot_top_losses_A2_cnn.png"))
 
         # Plot GradCam
-        plot_grad_cam(self.model, X_test, y_test, 3, "conv2d_2", "output/plot_top_5_gradcam_A2_cnn.png")
+        top_n_data, top_n_images = evaluation.get_top_n_data()
+        plot_grad_cam_data(self.model, top_n_data, top_n_images, "conv2d_2", get_output_path("plot_top_5_gradcam_A2_cnn.png"))
 
         # Get the test accuracy
-        test_accuracy = self.model.evaluate(X_test, y_test)[-1]
+        test_accuracy = evaluation.accuracy
         return test_accuracy
 
 class A2Xception(A2):
@@ -258,10 +350,13 @@ class A2Xception(A2):
             learning_rate,
             schedule_type,
             find_lr,
-            random_state):
-
-        # Change to relevant image set directory
-        os.chdir(os.path.join(data_dir, celeba_dir))
+            random_state,
+            cache_features=False,
+            input_backend="keras",
+            step_timing=None,
+            budget=None,
+            strategy=None,
+            cache_eval_batches=False):
 
         # Change random state according to constructor
         self.random_state = random_state
@@ -271,32 +366,61 @@ class A2Xception(A2):
         self.find_lr = find_lr
         self.schedule_type = schedule_type
 
-        self.train_gen, self.val_gen = create_train_datagens(
+        train_labels, test_labels = A2.get_train_labels(), A2.get_test_labels()
+        augmentation_seed = self.random_state if self.random_state is not None else 0
+
+        # Trained weights of both stages (or the learning rate finder curve) are
+        # reused by runs with the same configuration
+        artifact = get_task_artifact(
+            "A2",
+            "xception",
+            celeba_root,
+            find_lr,
+            height=A2.height,
+            width=A2.width,
+            batch_size=A2.batch_size,
+            epochs=epochs,
+            learning_rate=learning_rate,
+            schedule_type=schedule_type,
+            random_state=random_state,
+            input_backend=input_backend,
+            cache_features=cache_features,
+            augmentation_seed=augmentation_seed,
+            budget=budget.config if budget is not None else None)
+
+        # Every worker of a data-parallel run trains, as the others would wait
+        # on it otherwise, so no weights are reused
+        if strategy is not None:
+            artifact = None
+
+        kwargs = {}
+        if input_backend == "keras" and cache_eval_batches:
+            kwargs["cache_eval_batches"] = True
+        self.train_gen, self.val_gen = create_train_inputs(
+            input_backend,
             A2.height,
             A2.width,
-            A2.train_df,
+            train_labels,
             "celeba",
             "img_name",
             "smiling",
             A2.batch_size,
             A2.random_state,
-            preprocess_input)
-
-        os.chdir(os.path.join(test_dir, celeba_test_dir))
+            preprocess_input,
+            celeba_root,
+            **kwargs)
 
         self.test_gen = create_test_datagen(
             A2.height,
             A2.width,
-            A2.test_df,
+            test_labels,
             "celeba",
             "img_name",
             "smiling",
             A2.batch_size,
             A2.random_state,
-            preprocess_input)
-
-        # Change to relevant image set directory
-        os.chdir(os.path.join(data_dir, celeba_dir))
+            preprocess_input,
+            celeba_test_root)
         
         if self.find_lr == True:
             self.lr_finder = train_xception(
@@ -308,11 +432,16 @@ class A2Xception(A2):
                 learning_rate,
                 schedule_type,
                 self.find_lr,
-                    self.train_gen,
+                self.train_gen,
                 self.val_gen,
-                "A2_frozen_model.h5",
-                "train_loss_acc_A2_xception_frozen.png",
-                "A2 (frozen model)")
+                celeba_root.get_path("A2_frozen_model.h5"),
+                celeba_root.get_path("train_loss_acc_A2_xception_frozen.png"),
+                "A2 (frozen model)",
+                cache_features,
+                augmentation_seed,
+                get_step_timing_path("A2_xception", step_timing),
+                artifact,
+                labels_path=celeba_root.labels_path)
         else:
             self.model, self.history, self.schedule = train_xception(
                 A2.height, 
@@ -325,23 +454,26 @@ class A2Xception(A2):
                 self.find_lr,
                 self.train_gen,
                 self.val_gen,
-                "A2_frozen_model.h5",
-                "train_loss_acc_A2_xception_frozen.png",
-                "A2 (frozen model)")
+                celeba_root.get_path("A2_frozen_model.h5"),
+                celeba_root.get_path("train_loss_acc_A2_xception_frozen.png"),
+                "A2 (frozen model)",
+                cache_features,
+                augmentation_seed,
+                get_step_timing_path("A2_xception", step_timing),
+                artifact,
+                budget,
+                strategy,
+                celeba_root.labels_path)
 
     def train(self):
         if self.find_lr == True:
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()        
 
             # Plot learning rate finder plot
             self.lr_finder.plot_loss(
-                "output/lr_finder_plot_A2.png")
+                get_output_path("lr_finder_plot_A2.png"))
                 
         else:
             # Plot training loss accuracy and learning rate change
-            # Navigate to output folder in parent directory
-            go_up_three_dirs()
 
             plot_train_loss_acc_lr(
                 self.history,
@@ -349,29 +481,154 @@ class A2Xception(A2):
                 self.schedule,
                 self.schedule_type,
                 "A2",
-                "output/train_loss_acc_A2_xception.png",
-                "output/lr_A2_xception.png")
+                get_output_path("train_loss_acc_A2_xception.png"),
+                get_output_path("lr_A2_xception.png"))
 
-            # Get the training accuracy
-            training_accuracy = self.history.history['val_acc'][-1]
+            # Get the validation accuracy of the weights the model was left with
+            training_accuracy = get_val_acc(self.history)
             return training_accuracy
 
     def test(self):
-        # Go back to image folder
-        os.chdir("data/dataset_test_AMLS_19-20/celeba_test")
-
-        # Split ImageDataGenerator object for the test set into separate X and y test sets
-        X_test, y_test = get_X_y_test_sets(self.test_gen)
-
-        # Navigate to output folder in parent directory
-        go_up_three_dirs()
+        # Evaluate the test set in bounded batches, only keeping the images
+        # needed for the plots below
+        evaluation = evaluate_streaming(self.model, self.test_gen, A2.num_classes)
 
         # Plot top losses
-        plot_top_losses(self.model, X_test, y_test, "output/plot_top_losses_A2_xception.png")
+        loss_pred_data, loss_images = evaluation.get_loss_pred_data()
+        plot_top_losses_data(loss_pred_data, loss_images, get_output_path("plot_top_losses_A2_xception.png"))
 
         # Plot GradCam
-        plot_grad_cam(self.model, X_test, y_test, 3, "block14_sepconv2", "output/plot_top_5_gradcam_A2_xception.png")
+        top_n_data, top_n_images = evaluation.get_top_n_data()
+        plot_grad_cam_data(self.model, top_n_data, top_n_images, "block14_sepconv2", get_output_path("plot_top_5_gradcam_A2_xception.png"))
+
+        # Get the test accuracy
+        test_accuracy = evaluation.accuracy
+        return test_accuracy
+
+class A2Distilled(A2):
+    def __init__(
+            self,
+            epochs,
+            learning_rate,
+            schedule_type,
+            find_lr,
+            random_state,
+            student_type="cnn",
+            step_timing=None,
+            budget=None,
+            temperature=4.,
+            alpha=0.1):
+
+        # Change random state according to constructor
+        self.random_state = random_state
+        A2.random_state = self.random_state
+
+        self.epochs = epochs
+        self.find_lr = find_lr
+        self.schedule_type = schedule_type
+        self.model_type = student_type + "_distilled"
+
+        # The student learns from the trained A2 Xception model, whose soft
+        # targets are computed once and cached next to the decoded images
+        self.train_gen, self.val_gen, teacher_key = create_distillation_inputs(
+            "A2",
+            A2.height,
+            A2.width,
+            A2.get_train_labels(),
+            "celeba",
+            A2.batch_size,
+            A2.random_state,
+            celeba_root)
+
+        # Trained weights (or the learning rate finder curve) are reused by runs
+        # with the same configuration and teacher
+        artifact = get_task_artifact(
+            "A2",
+            self.model_type,
+            celeba_root,
+            find_lr,
+            height=A2.height,
+            width=A2.width,
+            batch_size=A2.batch_size,
+            epochs=epochs,
+            learning_rate=learning_rate,
+            schedule_type=schedule_type,
+            random_state=random_state,
+            temperature=temperature,
+            alpha=alpha,
+            teacher=teacher_key,
+            budget=budget.config if budget is not None else None)
+
+        if find_lr == True:
+            self.lr_finder = train_distilled(
+                student_type,
+                A2.height,
+                A2.width,
+                A2.num_classes,
+                A2.batch_size,
+                self.epochs,
+                learning_rate,
+                schedule_type,
+                find_lr,
+                self.train_gen,
+                self.val_gen,
+                temperature,
+                alpha,
+                artifact=artifact)
+        else:
+            print("[INFO] Training distilled {}...".format(student_type.upper()))
+            self.model, self.history, self.schedule = train_distilled(
+                student_type,
+                A2.height,
+                A2.width,
+                A2.num_classes,
+                A2.batch_size,
+                self.epochs,
+                learning_rate,
+                schedule_type,
+                find_lr,
+                self.train_gen,
+                self.val_gen,
+                temperature,
+                alpha,
+                get_step_timing_path("A2_" + self.model_type, step_timing),
+                artifact,
+                budget)
+
+    def train(self):
+        if self.find_lr == True:
+
+            # Plot learning rate finder plot
+            self.lr_finder.plot_loss(
+                get_output_path("lr_finder_plot_A2.png"))
+        else:
+            # Plot training loss accuracy and learning rate change
+
+            plot_train_loss_acc_lr(
+                self.history,
+                self.epochs,
+                self.schedule,
+                self.schedule_type,
+                "A2",
+                get_output_path("train_loss_acc_A2_{}.png".format(self.model_type)),
+                get_output_path("lr_A2_{}.png".format(self.model_type)))
+
+            # Get the validation accuracy of the weights the model was left with
+            training_accuracy = get_val_acc(self.history)
+            return training_accuracy
+
+    def test(self):
+        self.test_gen = A2.get_test_gen()
+
+        # Evaluate the test set in bounded batches, only keeping the images
+        # needed for the plots below
+        evaluation = evaluate_streaming(self.model, self.test_gen, A2.num_classes)
+
+        # Plot top losses
+        loss_pred_data, loss_images = evaluation.get_loss_pred_data()
+        plot_top_losses_data(loss_pred_data, loss_images,
+            get_output_path("plot_top_losses_A2_{}.png".format(self.model_type)))
 
         # Get the test accuracy
-        test_accuracy = self.model.evaluate(X_test, y_test)[-1]
-        return test_accuracy
\ No newline at end of file
+        test_accuracy = evaluation.accuracy
+        return test_accuracy
@@ -1,13 +1,12 @@
-from A1.a1 import A1MLP, A1CNN, A1Xception
-from A2.a2 import A2MLP, A2CNN, A2Xception
-from B1.b1 import B1MLP, B1CNN, B1Xception
-from B2.b2 import B2MLP, B2CNN, B2Xception
-from tensorflow.keras import backend as K
+from pipeline.task_registry import task_names, run_task
+from pipeline.parallel_runner import run_tasks_in_parallel
+from pipeline.shared_backbone import get_shared_task_groups, run_shared_backbone, multi_head_model_types
 import argparse
 
 # ======================================================================================================================
 # Data preprocessing:
 # This is done in the respective task packages, using functions from the pipeline.datasets package.
+# Task packages are imported lazily, so only the selected tasks load their data.
 # ======================================================================================================================
 # Argument parser, used to define which learning rate scheduler to use as well as the number of epochs
 # This section is taken from: https://www.pyimagesearch.com/2019/07/22/keras-learning-rate-schedules-and-decay/
@@ -23,83 +22,120 @@ ap.add_argument("-f", "--find_lr", type=bool, default=False,
 ap.add_argument("-r", "--random_state", type=int, default=None,
     help="random state for splitting the training and test sets, used for replicating results")
 ap.add_argument("-t", "--model_type", type=str, default='xception,xception,xception,xception',
-    help="choose model type ('mlp', 'cnn', 'xception') for each of the tasks")
+    help="choose model type ('mlp', 'cnn', 'xception', 'mlp_distilled', 'cnn_distilled') for each of the tasks")
+ap.add_argument("-c", "--cache_features", action="store_true",
+    help="train the frozen Xception stage on cached bottleneck features")
+ap.add_argument("-i", "--input_backend", type=str, default='keras,keras,keras,keras',
+    help="choose the input pipeline ('keras', 'tf_data') for each of the tasks")
+ap.add_argument("--cache_eval_batches", action="store_true",
+    help="keep the validation batches of the 'keras' input backend in memory after the first epoch")
+ap.add_argument("--step_timing", type=str, default=None, choices=["jsonl", "trace"],
+    help="record the input wait and compute time of every training step to the output folder")
+ap.add_argument("--patience", type=int, default=None,
+    help="stop training once the validation loss has not improved for this many epochs")
+ap.add_argument("--min_delta", type=float, default=0.,
+    help="smallest decrease of the validation loss counted as an improvement")
+ap.add_argument("--time_budget", type=float, default=None,
+    help="training time of each task in minutes, the learning rate schedule is compressed to fit it")
+ap.add_argument("--multi_head", action="store_true",
+    help="train one model with a head per task for the tasks sharing an image set (A1 and A2, B1 and B2)")
+ap.add_argument("-k", "--tasks", type=str, default='A1,A2,B1,B2',
+    help="choose which of the tasks ('A1', 'A2', 'B1', 'B2') to run")
+ap.add_argument("-p", "--parallel_tasks", type=int, default=1,
+    help="number of tasks to run concurrently, each in its own worker process")
+ap.add_argument("--intra_op_threads", type=int, default=None,
+    help="cap on the threads used within each operation by each worker")
+ap.add_argument("--inter_op_threads", type=int, default=None,
+    help="cap on the operations run concurrently by each worker")
 args = vars(ap.parse_args())
 schedule_type = [str(item) for item in args["schedule_type"].split(",")]
 epochs = [int(item) for item in args["epochs"].split(",")]
 learning_rates = [float(item) for item in args["learning_rates"].split(",")]
 model_type = [str(item) for item in args["model_type"].split(",")]
+tasks = [str(item) for item in args["tasks"].split(",")]
+input_backend = [str(item) for item in args["input_backend"].split(",")]
 
 # ======================================================================================================================
-# Task A1
-if model_type[0] == "mlp":
-    model_A1 = A1MLP(epochs[0], learning_rates[0], schedule_type[0], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[0] == "cnn":
-    model_A1 = A1CNN(epochs[0], learning_rates[0], schedule_type[0], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[0] == "xception":
-    model_A1 = A1Xception(epochs[0], learning_rates[0], schedule_type[0], args["find_lr"], args["random_state"])   # Build model object.
-acc_A1_train = model_A1.train() # Train model based on the training set (you should fine-tune your model based on validation set.)
-if args["find_lr"] != True:
-    acc_A1_test = model_A1.test()   # Test model based on the test set.
+# Tasks A1, A2, B1 and B2
+task_kwargs = {}
+for i, task in enumerate(task_names):
+    if task in tasks:
+        task_kwargs[task] = dict(
+            task=task,
+            model_type=model_type[i],
+            epochs=epochs[i],
+            learning_rate=learning_rates[i],
+            schedule_type=schedule_type[i],
+            find_lr=args["find_lr"],
+            random_state=args["random_state"],
+            cache_features=args["cache_features"],
+            input_backend=input_backend[i],
+            cache_eval_batches=args["cache_eval_batches"],
+            step_timing=args["step_timing"],
+            patience=args["patience"],
+            min_delta=args["min_delta"],
+            time_budget=args["time_budget"])
 
-# Clear GPU memory
-K.clear_session()
+# Worker processes re-import this module, so tasks are only run from the main process
+if __name__ == "__main__":
+    acc_train = {task: 'TBD' for task in task_names}
+    acc_test = {task: 'TBD' for task in task_names}
 
-# ======================================================================================================================
-# Task A2
-if model_type[1] == "mlp":
-    model_A2 = A2MLP(epochs[1], learning_rates[1], schedule_type[1], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[1] == "cnn":
-    model_A2 = A2CNN(epochs[1], learning_rates[1], schedule_type[1], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[1] == "xception":
-    model_A2 = A2Xception(epochs[1], learning_rates[1], schedule_type[1], args["find_lr"], args["random_state"])   # Build model object.
-acc_A2_train = model_A2.train() # Train model based on the training set (you should fine-tune your model based on validation set.)
-if args["find_lr"] != True:
-    acc_A2_test = model_A2.test()   # Test model based on the test set.
-
-# Clear GPU memory
-K.clear_session()
+    # Tasks sharing an image set are trained together, using the settings of
+    # the first of them. The learning rate finder still runs task by task.
+    if args["multi_head"] and args["find_lr"] != True:
+        for image_set, shared_tasks in get_shared_task_groups(tasks).items():
+            kwargs = task_kwargs[shared_tasks[0]]
+            # Other model types fall back to one model per task
+            if kwargs["model_type"] not in multi_head_model_types:
+                print("[INFO] No multi-head {} model, training {} one task at a time".format(
+                    kwargs["model_type"], ",".join(shared_tasks)))
+                continue
+            budget = None
+            if args["patience"] is not None or args["time_budget"] is not None:
+                from pipeline.optimisation.adaptive_budget import TrainingBudget
+                budget = TrainingBudget(args["patience"], args["min_delta"], args["time_budget"])
+            results = run_shared_backbone(
+                image_set,
+                shared_tasks,
+                kwargs["model_type"],
+                kwargs["epochs"],
+                kwargs["learning_rate"],
+                kwargs["schedule_type"],
+                kwargs["random_state"],
+                kwargs["step_timing"],
+                budget)
+            for task, (task_acc_train, task_acc_test) in results.items():
+                acc_train[task], acc_test[task] = task_acc_train, task_acc_test
+                task_kwargs.pop(task)
 
-# ======================================================================================================================
-# Task B1
-if model_type[2] == "mlp":
-    model_B1 = B1MLP(epochs[2], learning_rates[2], schedule_type[2], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[2] == "cnn":
-    model_B1 = B1CNN(epochs[2], learning_rates[2], schedule_type[2], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[2] == "xception":
-    model_B1 = B1Xception(epochs[2], learning_rates[2], schedule_type[2], args["find_lr"], args["random_state"])   # Build model object.
-acc_B1_train = model_B1.train() # Train model based on the training set (you should fine-tune your model based on validation set.)
-if args["find_lr"] != True:
-    acc_B1_test = model_B1.test()   # Test model based on the test set.
+    if args["parallel_tasks"] > 1:
+        results = run_tasks_in_parallel(
+            task_kwargs,
+            args["parallel_tasks"],
+            args["intra_op_threads"],
+            args["inter_op_threads"])
+        for task, (task_acc_train, task_acc_test) in results.items():
+            acc_train[task], acc_test[task] = task_acc_train, task_acc_test
+    else:
+        for task, kwargs in task_kwargs.items():
+            acc_train[task], acc_test[task] = run_task(**kwargs)
 
-# Clear GPU memory
-K.clear_session()
+    acc_A1_train, acc_A1_test = acc_train["A1"], acc_test["A1"]
+    acc_A2_train, acc_A2_test = acc_train["A2"], acc_test["A2"]
+    acc_B1_train, acc_B1_test = acc_train["B1"], acc_test["B1"]
+    acc_B2_train, acc_B2_test = acc_train["B2"], acc_test["B2"]
 
-# ======================================================================================================================
-# Task B2
-if model_type[3] == "mlp":
-    model_B2 = B2MLP(epochs[3], learning_rates[3], schedule_type[3], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[3] == "cnn":
-    model_B2 = B2CNN(epochs[3], learning_rates[3], schedule_type[3], args["find_lr"], args["random_state"])        # Build model object.
-elif model_type[3] == "xception":
-    model_B2 = B2Xception(epochs[3], learning_rates[3], schedule_type[3], args["find_lr"], args["random_state"])   # Build model object.
-acc_B2_train = model_B2.train() # Train model based on the training set (you should fine-tune your model based on validation set.)
-if args["find_lr"] != True:
-    acc_B2_test = model_B2.test()   # Test model based on the test set.
-
-# Clear GPU memory
-K.clear_session()
-
-# ======================================================================================================================
-if args["find_lr"] != True:
-    # Print out your results with following format:
-    print('TA1: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_A1_train, acc_A1_test) +
-          'TA2: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_A2_train, acc_A2_test) + 
-          'TA3: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_B1_train, acc_B1_test) +
-          'TA4: Validation accuracy: {}, Test accuracy: {}'.format(acc_B2_train, acc_B2_test))
+    # ==================================================================================================================
+    if args["find_lr"] != True:
+        # Print out your results with following format:
+        print('TA1: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_A1_train, acc_A1_test) +
+              'TA2: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_A2_train, acc_A2_test) + 
+              'TA3: Validation accuracy: {}, Test accuracy: {};\n'.format(acc_B1_train, acc_B1_test) +
+              'TA4: Validation accuracy: {}, Test accuracy: {}'.format(acc_B2_train, acc_B2_test))
 
-    # If you are not able to finish a task, fill the corresponding variable with 'TBD'. For example:
-    # acc_A1_train = 'TBD'
-else:
-    print("Please check the output folder for the learning rate finder plots. " +
-          "Then re-run this script with the appropriate learning rates.")
\ No newline at end of file
+        # If you are not able to finish a task, fill the corresponding variable with 'TBD'. For example:
+        # acc_A1_train = 'TBD'
+    else:
+        print("Please check the output folder for the learning rate finder plots. " +
+              "Then re-run this script with the appropriate learning rates.")
@@ -0,0 +1,241 @@
+# Benchmark suite for the input pipelines, training and inference.
+# Measures, for each model type at the resolution of each selected task:
+#   - data:       images/sec of the training input pipeline alone, per input backend
+#   - train_step: images/sec of train_on_batch on synthetic tensors, without input
+#   - end_to_end: images/sec of model.fit over the real training input
+#   - inference:  batch-size-1 and batched predict_on_batch latency
+# Results are written as JSON together with the host and commit, so that runs
+# can be compared across code changes and machines.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with:
+#   python -m pipeline.benchmark --output output/benchmark.json
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import time
+import numpy as np
+from pipeline.task_registry import get_task_class
+from pipeline.datasets.dataset_root import project_dir, get_output_path
+
+sections = ["data", "train_step", "end_to_end", "inference"]
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=project_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_host_info():
+    import tensorflow as tf
+    return {
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "gpus": tf.test.is_gpu_available()}
+
+# Build and compile a model of the given type, with the settings the tasks use.
+# The Xception weights are not loaded, as they do not change the timings, and
+# its layers are all trainable as in the second training stage.
+def build_model(model_type, height, width, num_classes):
+    from tensorflow.keras.optimizers import SGD
+
+    if model_type == "mlp":
+        from pipeline.models.mlp import build_mlp
+        model = build_mlp(height, width, num_classes)
+    elif model_type == "cnn":
+        from pipeline.models.cnn import build_cnn
+        model = build_cnn(height, width, num_classes)
+    else:
+        from pipeline.models.xception import build_xception
+        model, _ = build_xception(height, width, num_classes, weights=None)
+        for layer in model.layers:
+            layer.trainable = True
+
+    model.compile(loss="sparse_categorical_crossentropy", optimizer=SGD(lr=0.01, momentum=0.9),
+                  metrics=["accuracy"])
+    return model
+
+def synthetic_batch(batch_size, height, width, num_classes, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(0., 1., (batch_size, height, width, 3)).astype(np.float32)
+    y = rng.randint(0, num_classes, batch_size).astype(np.float32)
+    return X, y
+
+# Return a function fetching the next batch from a Sequence or a tf.data dataset
+def get_batch_fetcher(gen):
+    if hasattr(gen, "__getitem__"):
+        state = {"batch": 0}
+
+        def fetch():
+            batch = gen[state["batch"] % len(gen)]
+            state["batch"] += 1
+            return batch
+        return fetch
+
+    import tensorflow as tf
+    from tensorflow.keras import backend as K
+    next_batch = tf.compat.v1.data.make_one_shot_iterator(gen).get_next()
+    return lambda: K.get_session().run(next_batch)
+
+def summarise_latencies(latencies, batch_size):
+    latencies = np.array(latencies) * 1000.
+    return {
+        "batch_size": batch_size,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "images_per_sec": batch_size / (latencies.mean() / 1000.)}
+
+def benchmark_data(task_class, input_backend, num_batches, warmup):
+    print("[INFO] Benchmarking {} input ({})...".format(task_class.__name__, input_backend))
+    train_gen, _ = task_class.get_train_val_gens(input_backend)
+    fetch = get_batch_fetcher(train_gen)
+    for _ in range(warmup):
+        fetch()
+
+    num_images = 0
+    start = time.time()
+    for _ in range(num_batches):
+        X, _ = fetch()
+        num_images += len(X)
+    elapsed = time.time() - start
+    return {"input_backend": input_backend, "batches": num_batches,
+            "seconds": elapsed, "images_per_sec": num_images / elapsed}
+
+def benchmark_train_step(model, batch_size, height, width, num_classes, num_steps, warmup):
+    X, y = synthetic_batch(batch_size, height, width, num_classes)
+    for _ in range(warmup):
+        model.train_on_batch(X, y)
+
+    latencies = []
+    for _ in range(num_steps):
+        start = time.time()
+        model.train_on_batch(X, y)
+        latencies.append(time.time() - start)
+    return summarise_latencies(latencies, batch_size)
+
+# The training input uses the task's own batch size
+def benchmark_end_to_end(model, task_class, input_backend, epoch_steps):
+    print("[INFO] Benchmarking one epoch of {} ({})...".format(task_class.__name__, input_backend))
+    train_gen, _ = task_class.get_train_val_gens(input_backend)
+    batch_size = task_class.batch_size
+    steps = train_gen.samples // batch_size
+    if epoch_steps is not None:
+        steps = min(steps, epoch_steps)
+
+    start = time.time()
+    model.fit(train_gen, steps_per_epoch=steps, epochs=1, verbose=0)
+    elapsed = time.time() - start
+    return {"input_backend": input_backend, "batch_size": batch_size, "steps": steps,
+            "seconds": elapsed, "images_per_sec": steps * batch_size / elapsed}
+
+def benchmark_inference(model, batch_size, height, width, num_classes, num_runs, warmup):
+    X, _ = synthetic_batch(batch_size, height, width, num_classes)
+    for _ in range(warmup):
+        model.predict_on_batch(X)
+
+    latencies = []
+    for _ in range(num_runs):
+        start = time.time()
+        model.predict_on_batch(X)
+        latencies.append(time.time() - start)
+    return summarise_latencies(latencies, batch_size)
+
+def run_benchmarks(tasks, model_types, input_backends, selected_sections, batch_size,
+                   num_steps, warmup, epoch_steps, inference_runs):
+    from tensorflow.keras import backend as K
+
+    results = {section: [] for section in selected_sections}
+    for task in tasks:
+        task_class = get_task_class(task, "mlp")
+        height, width, num_classes = task_class.height, task_class.width, task_class.num_classes
+        resolution = "{}x{}".format(height, width)
+
+        if "data" in selected_sections:
+            for input_backend in input_backends:
+                result = benchmark_data(task_class, input_backend, num_steps, warmup)
+                results["data"].append(dict(task=task, resolution=resolution, **result))
+
+        for model_type in model_types:
+            print("[INFO] Benchmarking {} at {}...".format(model_type, resolution))
+            model = build_model(model_type, height, width, num_classes)
+            info = dict(task=task, model_type=model_type, resolution=resolution)
+
+            if "train_step" in selected_sections:
+                result = benchmark_train_step(model, batch_size, height, width, num_classes, num_steps, warmup)
+                results["train_step"].append(dict(info, **result))
+
+            if "end_to_end" in selected_sections:
+                for input_backend in input_backends:
+                    result = benchmark_end_to_end(model, task_class, input_backend, epoch_steps)
+                    results["end_to_end"].append(dict(info, **result))
+
+            if "inference" in selected_sections:
+                for inference_batch_size in [1, batch_size]:
+                    result = benchmark_inference(model, inference_batch_size, height, width, num_classes,
+                                                 inference_runs, warmup)
+                    results["inference"].append(dict(info, **result))
+
+            # Free the graph of this model before building the next one. tf.data
+            # inputs belong to that graph, so they are rebuilt for the next model
+            K.clear_session()
+            task_class.loaded.pop("train_gens_tf_data", None)
+    return results
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-o", "--output", type=str, default=get_output_path("benchmark.json"),
+        help="path of the JSON results")
+    ap.add_argument("-k", "--tasks", type=str, default='A1,B1',
+        help="tasks whose resolutions and data are benchmarked (A1/A2: 218x178, B1/B2: 299x299)")
+    ap.add_argument("-t", "--model_type", type=str, default='mlp,cnn,xception',
+        help="model types ('mlp', 'cnn', 'xception') to benchmark")
+    ap.add_argument("-i", "--input_backend", type=str, default='keras,tf_data',
+        help="input pipelines ('keras', 'tf_data') to benchmark")
+    ap.add_argument("--sections", type=str, default=",".join(sections),
+        help="benchmarks to run ('data', 'train_step', 'end_to_end', 'inference')")
+    ap.add_argument("-b", "--batch_size", type=int, default=32,
+        help="batch size for training and batched inference")
+    ap.add_argument("--steps", type=int, default=20,
+        help="timed batches for the data and train step benchmarks")
+    ap.add_argument("--warmup", type=int, default=3,
+        help="untimed batches run before each measurement")
+    ap.add_argument("--epoch_steps", type=int, default=None,
+        help="cap on the steps of the end-to-end epoch, a full epoch by default")
+    ap.add_argument("--inference_runs", type=int, default=50,
+        help="timed calls for each inference latency")
+    args = vars(ap.parse_args())
+
+    tasks = [str(item) for item in args["tasks"].split(",")]
+    model_types = [str(item) for item in args["model_type"].split(",")]
+    input_backends = [str(item) for item in args["input_backend"].split(",")]
+    selected_sections = [str(item) for item in args["sections"].split(",")]
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": get_git_commit(),
+        "host": get_host_info(),
+        "config": args,
+        "results": run_benchmarks(
+            tasks,
+            model_types,
+            input_backends,
+            selected_sections,
+            args["batch_size"],
+            args["steps"],
+            args["warmup"],
+            args["epoch_steps"],
+            args["inference_runs"])}
+
+    os.makedirs(os.path.dirname(os.path.abspath(args["output"])), exist_ok=True)
+    with open(args["output"], "w") as f:
+        json.dump(report, f, indent=2)
+    print("[INFO] Benchmark results written to {}".format(args["output"]))
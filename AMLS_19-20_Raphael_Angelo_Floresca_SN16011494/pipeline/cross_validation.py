@@ -0,0 +1,182 @@
+# K-fold cross-validation of the task models.
+# Rather than the single validation split used by main.py, the rows of a task's
+# label index are shuffled and split into k folds. Each fold is the validation
+# set of one training run on the other k-1 folds, and the mean and standard
+# deviation of the validation accuracies are reported per model type. The folds
+# train concurrently in worker processes, which read the decoded-image cache
+# built once up front, so with as many workers as folds (and the cores split
+# between them) a cross-validation takes about the time of a single fold.
+# The results are written per task to the output folder.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with:
+#   python -m pipeline.cross_validation -k A1 -t mlp,cnn --folds 5 -w 5 -e 10
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from pipeline.task_registry import get_task_class
+from pipeline.parallel_runner import init_worker, set_session_threads
+from pipeline.datasets.dataset_root import get_output_path
+from pipeline.models.artifact_store import artifacts_dir
+
+cross_validation_dir = os.path.join(artifacts_dir, "cross_validation")
+
+# The architecture of each model type, as in the task classes
+model_params = {
+    "mlp": {"first_af": "relu", "second_af": "relu", "layer1_hn": 300, "layer2_hn": 100},
+    "cnn": {"num_start_filters": 16, "kernel_size": 3, "fcl_size": 512},
+    "xception": {}
+}
+
+# Validation indices of each fold, from a shuffle of the rows by seed
+def get_folds(num_images, num_folds, seed):
+    indices = np.random.RandomState(seed).permutation(num_images)
+    return [np.sort(fold) for fold in np.array_split(indices, num_folds)]
+
+# Training and validation sequences of a fold over the decoded-image cache,
+# augmented and preprocessed as by create_train_datagens
+def create_fold_gens(task_class, model_type, train_indices, val_indices, seed):
+    from tensorflow.keras.applications.xception import preprocess_input
+    from pipeline.datasets.image_cache import CachedImageSequence
+    from pipeline.datasets.utilities import create_augmenting_datagen, create_eval_datagen
+
+    images = task_class.get_train_val_gens("keras")[0].images
+    labels = task_class.get_train_labels().labels
+    preprocessing_function = preprocess_input if model_type == "xception" else None
+    train_gen = CachedImageSequence(images, labels, train_indices, task_class.batch_size,
+        create_augmenting_datagen(), preprocessing_function, seed=seed)
+    val_gen = CachedImageSequence(images, labels, val_indices, task_class.batch_size,
+        create_eval_datagen(), preprocessing_function, shuffle=False, seed=seed)
+    return train_gen, val_gen
+
+# Train one fold in a worker process and return its validation accuracy
+def run_fold(
+        task,
+        model_type,
+        fold,
+        train_indices,
+        val_indices,
+        args):
+    from tensorflow.keras import backend as K
+    from pipeline.optimisation.adaptive_budget import get_val_acc
+
+    set_session_threads(args["intra_op_threads"], args["inter_op_threads"])
+    task_class = get_task_class(task, model_type)
+    task_class.random_state = args["random_state"]
+    train_gen, val_gen = create_fold_gens(task_class, model_type, train_indices, val_indices, args["random_state"])
+    fold_dir = os.path.join(cross_validation_dir, task, model_type, "fold_{}".format(fold))
+    os.makedirs(fold_dir, exist_ok=True)
+
+    train_args = (task_class.height, task_class.width, task_class.num_classes, task_class.batch_size,
+                  args["epochs"], args["learning_rate"], args["schedule_type"], False, train_gen, val_gen)
+    start = time.time()
+    if model_type == "mlp":
+        from pipeline.models.mlp import train_mlp
+        _, history, _ = train_mlp(*train_args, **model_params["mlp"])
+    elif model_type == "cnn":
+        from pipeline.models.cnn import train_cnn
+        _, history, _ = train_cnn(*train_args, **model_params["cnn"])
+    else:
+        from pipeline.models.xception import train_xception
+        _, history, _ = train_xception(
+            *train_args,
+            frozen_model_path=os.path.join(fold_dir, "frozen_model.h5"),
+            frozen_training_plot_path=os.path.join(fold_dir, "train_loss_acc_frozen.png"),
+            frozen_training_plot_name="{} fold {} (frozen model)".format(task, fold))
+
+    K.clear_session()
+    return {
+        "fold": fold,
+        "val_images": len(val_indices),
+        "val_acc": float(get_val_acc(history)),
+        "history": {k: [float(v) for v in values] for k, values in history.history.items()},
+        "seconds": time.time() - start}
+
+# Cross-validate every model type of a task, returning a dictionary of model
+# type -> summary of its folds
+def cross_validate_task(task, model_types, args):
+    # Build the decoded-image cache once, rather than in every worker
+    task_class = get_task_class(task, model_types[0])
+    task_class.random_state = args["random_state"]
+    num_images = len(task_class.get_train_val_gens("keras")[0].images)
+    folds = get_folds(num_images, args["folds"], args["seed"])
+
+    print("[INFO] {}: training {} folds of {} on {} workers...".format(
+        task, args["folds"], ",".join(model_types), args["workers"]))
+    start = time.time()
+    with ProcessPoolExecutor(
+            max_workers=args["workers"],
+            mp_context=mp.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(args["intra_op_threads"],)) as executor:
+        futures = {model_type: [executor.submit(
+            run_fold,
+            task,
+            model_type,
+            fold,
+            np.concatenate([other for i, other in enumerate(folds) if i != fold]),
+            val_indices,
+            args) for fold, val_indices in enumerate(folds)] for model_type in model_types}
+        results = {model_type: [future.result() for future in model_futures]
+                   for model_type, model_futures in futures.items()}
+    print("[INFO] {}: cross-validation took {:0.0f} seconds".format(task, time.time() - start))
+
+    summaries = {}
+    for model_type, fold_results in results.items():
+        val_accs = [result["val_acc"] for result in fold_results]
+        summaries[model_type] = {
+            "mean_val_acc": float(np.mean(val_accs)),
+            "std_val_acc": float(np.std(val_accs)),
+            "folds": fold_results}
+    return summaries
+
+def write_results(task, summaries, args):
+    path = get_output_path("cross_validation_{}.json".format(task))
+    with open(path, "w") as f:
+        json.dump({"task": task, "cross_validation": args, "model_types": summaries}, f, indent=2)
+
+    print("[INFO] {} cross-validation (written to {}):".format(task, path))
+    for model_type, summary in sorted(summaries.items(), key=lambda item: item[1]["mean_val_acc"], reverse=True):
+        print("  {}: val_acc {:0.4f} +/- {:0.4f} over {} folds".format(
+            model_type, summary["mean_val_acc"], summary["std_val_acc"], len(summary["folds"])))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-k", "--tasks", type=str, default='A1,A2,B1,B2',
+        help="tasks ('A1', 'A2', 'B1', 'B2') to cross-validate, one after the other")
+    ap.add_argument("-t", "--model_type", type=str, default='mlp,cnn',
+        help="model types ('mlp', 'cnn', 'xception') to cross-validate")
+    ap.add_argument("--folds", type=int, default=5,
+        help="number of folds")
+    ap.add_argument("-e", "--epochs", type=int, default=10,
+        help="epochs trained on each fold")
+    ap.add_argument("-l", "--learning_rate", type=float, default=0.003,
+        help="learning rate of every fold")
+    ap.add_argument("-s", "--schedule_type", type=str, default='one_cycle',
+        help="learning rate schedule of every fold")
+    ap.add_argument("-w", "--workers", type=int, default=5,
+        help="folds trained concurrently, each in its own worker process")
+    ap.add_argument("-r", "--random_state", type=int, default=42,
+        help="random state of the training runs")
+    ap.add_argument("--seed", type=int, default=0,
+        help="seed of the shuffle of the rows into folds")
+    ap.add_argument("--intra_op_threads", type=int, default=None,
+        help="cap on the threads used within each operation by each worker, the cores are shared equally by default")
+    ap.add_argument("--inter_op_threads", type=int, default=None,
+        help="cap on the operations run concurrently by each worker")
+    args = vars(ap.parse_args())
+    if args["intra_op_threads"] is None:
+        args["intra_op_threads"] = max(mp.cpu_count() // args["workers"], 1)
+
+    from pipeline.datasets.utilities import check_train_path
+    # Download the datasets once up front, rather than racing in every worker
+    check_train_path()
+
+    model_types = [str(item) for item in args["model_type"].split(",")]
+    for task in [str(item) for item in args["tasks"].split(",")]:
+        summaries = cross_validate_task(task, model_types, args)
+        write_results(task, summaries, args)
@@ -1,23 +1,16 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from pipeline.datasets.utilities import create_cartoon_set_df, create_cartoon_set_test_df
+from pipeline.datasets.utilities import create_cartoon_set_index, create_cartoon_set_test_index
 
-def create_eye_color_df():
-    # Import cartoon_set_df
-    cartoon_set_df = create_cartoon_set_df()
+# The eye_color column of the cartoon_set label index. The index is shared with the other
+# cartoon_set task, so labels.csv is only parsed once.
+def create_eye_color_labels():
+    return create_cartoon_set_index().get_task_labels("eye_color")
 
-    # Create eye_color dataframe, drop unnecessary columns
-    eye_color_df = cartoon_set_df.copy()
-    eye_color_df.drop(eye_color_df.columns[0], axis=1, inplace=True)
-    eye_color_df.drop(eye_color_df.columns[1], axis=1, inplace=True)
-    return eye_color_df
+def create_eye_color_test_labels():
+    return create_cartoon_set_test_index().get_task_labels("eye_color")
 
-def create_eye_color_test_df():
-    # Import cartoon_set_df
-    cartoon_set_df = create_cartoon_set_test_df()
+# Create eye_color dataframe, with the filename and eye_color columns as strings
+def create_eye_color_df():
+    return create_eye_color_labels().to_dataframe()
 
-    # Create eye_color dataframe, drop unnecessary columns
-    eye_color_df = cartoon_set_df.copy()
-    eye_color_df.drop(eye_color_df.columns[0], axis=1, inplace=True)
-    eye_color_df.drop(eye_color_df.columns[1], axis=1, inplace=True)
-    return eye_color_df
\ No newline at end of file
+def create_eye_color_test_df():
+    return create_eye_color_test_labels().to_dataframe()
@@ -1,23 +1,16 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from pipeline.datasets.utilities import create_cartoon_set_df, create_cartoon_set_test_df
+from pipeline.datasets.utilities import create_cartoon_set_index, create_cartoon_set_test_index
 
-def create_face_shape_df():
-    # Import cartoon_set_df
-    cartoon_set_df = create_cartoon_set_df()
+# The face_shape column of the cartoon_set label index. The index is shared with the other
+# cartoon_set task, so labels.csv is only parsed once.
+def create_face_shape_labels():
+    return create_cartoon_set_index().get_task_labels("face_shape")
 
-    # Create face_shape dataframe, drop unnecessary columns
-    face_shape_df = cartoon_set_df.copy()
-    face_shape_df.drop(face_shape_df.columns[0], axis=1, inplace=True)
-    face_shape_df.drop(face_shape_df.columns[0], axis=1, inplace=True)
-    return face_shape_df
+def create_face_shape_test_labels():
+    return create_cartoon_set_test_index().get_task_labels("face_shape")
 
-def create_face_shape_test_df():
-    # Import cartoon_set_df
-    cartoon_set_df = create_cartoon_set_test_df()
+# Create face_shape dataframe, with the filename and face_shape columns as strings
+def create_face_shape_df():
+    return create_face_shape_labels().to_dataframe()
 
-    # Create eye_color dataframe, drop unnecessary columns
-    eye_color_df = cartoon_set_df.copy()
-    eye_color_df.drop(eye_color_df.columns[0], axis=1, inplace=True)
-    eye_color_df.drop(eye_color_df.columns[0], axis=1, inplace=True)
-    return eye_color_df
\ No newline at end of file
+def create_face_shape_test_df():
+    return create_face_shape_test_labels().to_dataframe()
@@ -1,23 +1,16 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from pipeline.datasets.utilities import create_celeba_df, create_celeba_test_df
+from pipeline.datasets.utilities import create_celeba_index, create_celeba_test_index
 
-def create_gender_df():
-    # Import celeba_df
-    celeba_df = create_celeba_df()
+# The gender column of the celeba label index. The index is shared with the other
+# celeba task, so labels.csv is only parsed once.
+def create_gender_labels():
+    return create_celeba_index().get_task_labels("gender")
 
-    # Create gender dataframe, drop unnecessary columns
-    gender_df = celeba_df.copy()
-    gender_df.drop(gender_df.columns[0], axis=1, inplace=True)
-    gender_df.drop(gender_df.columns[2], axis=1, inplace=True)
-    return gender_df
+def create_gender_test_labels():
+    return create_celeba_test_index().get_task_labels("gender")
 
-def create_gender_test_df():
-    # Import celeba_df
-    celeba_df = create_celeba_test_df()
+# Create gender dataframe, with the filename and gender columns as strings
+def create_gender_df():
+    return create_gender_labels().to_dataframe()
 
-    # Create gender dataframe, drop unnecessary columns
-    gender_df = celeba_df.copy()
-    gender_df.drop(gender_df.columns[0], axis=1, inplace=True)
-    gender_df.drop(gender_df.columns[2], axis=1, inplace=True)
-    return gender_df
\ No newline at end of file
+def create_gender_test_df():
+    return create_gender_test_labels().to_dataframe()
@@ -1,23 +1,16 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from pipeline.datasets.utilities import create_celeba_df, create_celeba_test_df
+from pipeline.datasets.utilities import create_celeba_index, create_celeba_test_index
 
-def create_smiling_df():
-    # Import celeba_df
-    celeba_df = create_celeba_df()
+# The smiling column of the celeba label index. The index is shared with the other
+# celeba task, so labels.csv is only parsed once.
+def create_smiling_labels():
+    return create_celeba_index().get_task_labels("smiling")
 
-    # Create smiiling dataframe, drop unnecessary columns
-    smiling_df = celeba_df.copy()
-    smiling_df.drop(smiling_df.columns[0], axis=1, inplace=True)
-    smiling_df.drop(smiling_df.columns[1], axis=1, inplace=True)
-    return smiling_df
+def create_smiling_test_labels():
+    return create_celeba_test_index().get_task_labels("smiling")
 
-def create_smiling_test_df():
-    # Import celeba_df
-    celeba_df = create_celeba_test_df()
+# Create smiling dataframe, with the filename and smiling columns as strings
+def create_smiling_df():
+    return create_smiling_labels().to_dataframe()
 
-    # Create gender dataframe, drop unnecessary columns
-    gender_df = celeba_df.copy()
-    gender_df.drop(gender_df.columns[0], axis=1, inplace=True)
-    gender_df.drop(gender_df.columns[1], axis=1, inplace=True)
-    return gender_df
\ No newline at end of file
+def create_smiling_test_df():
+    return create_smiling_test_labels().to_dataframe()
@@ -0,0 +1,38 @@
+# Absolute paths for the datasets and outputs.
+# Paths are resolved from the location of this package rather than from the
+# working directory, so loaders, evaluators and plotters for several tasks can
+# run at the same time (e.g. in a thread pool) without changing directory.
+
+import os
+
+# The folder containing main.py
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# Plots are written here
+output_dir = os.path.join(project_dir, "output")
+
+def get_output_path(filename):
+    return os.path.join(output_dir, filename)
+
+# A single image set, e.g. data/dataset_AMLS_19-20/celeba, holding labels.csv
+# and the img/ folder
+class DatasetRoot:
+    def __init__(self, split_dir, dataset_dir, base_dir=project_dir):
+        self.path = os.path.join(base_dir, split_dir, dataset_dir)
+        self.labels_path = os.path.join(self.path, "labels.csv")
+        self.img_dir = os.path.join(self.path, "img")
+        # Decoded-image caches are kept next to img/
+        self.cache_dir = os.path.join(self.path, "cache")
+
+    def get_image_path(self, filename):
+        return os.path.join(self.img_dir, filename)
+
+    # Path of a file stored alongside the dataset, e.g. a frozen model
+    def get_path(self, filename):
+        return os.path.join(self.path, filename)
+
+# Final trained models of each task are saved here, see pipeline.serving
+saved_models_dir = os.path.join(project_dir, "saved_models")
+
+def get_saved_model_path(filename):
+    return os.path.join(saved_models_dir, filename)
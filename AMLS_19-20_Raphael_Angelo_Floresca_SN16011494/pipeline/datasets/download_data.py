@@ -1,21 +1,206 @@
-from google_drive_downloader import GoogleDriveDownloader as gdd
+# Fetch and extract the datasets.
+# The zip files can come from Google Drive (the default), a local directory or
+# a local HTTP mirror, selected with the AMLS_DATASET_SOURCE environment
+# variable, e.g. AMLS_DATASET_SOURCE=/mnt/mirror or
+# AMLS_DATASET_SOURCE=http://mirror.local/amls. Mirror downloads are chunked and
+# resumable, and zips are checked against a SHA256SUMS file from the source (or
+# AMLS_TRAIN_SHA256/AMLS_TEST_SHA256) when one is available, otherwise they are
+# tested for truncation or corruption. A bad zip is removed and fetched again.
+# Zips are extracted in parallel and a marker is only written once every member
+# has been extracted, so a partial unzip is detected and repaired.
+
+import hashlib
+import json
+import os
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pipeline.datasets.dataset_root import project_dir
 
 # Download datasets from Google Drive
-train_file_id = '1zCCpWhDfXVh4dEQoMB09nKSfLNJi-HyT' 
-train_dest_path = 'data/dataset_AMLS_19-20.zip' 
+train_file_id = '1zCCpWhDfXVh4dEQoMB09nKSfLNJi-HyT'
+train_dest_path = os.path.join(project_dir, 'data/dataset_AMLS_19-20.zip')
 
 test_file_id = '1SxoyIvITKBxcjsyb0mQwW3qU1_uLK415'
-test_dest_path = 'data/dataset_test_AMLS_19-20.zip' 
+test_dest_path = os.path.join(project_dir, 'data/dataset_test_AMLS_19-20.zip')
 
-# Download datasets from Google Drive
+# The zips are extracted into data/, next to the zip files
+extract_dir = os.path.join(project_dir, 'data')
+
+chunk_size = 1 << 20
+
+def get_dataset_source():
+    return os.environ.get("AMLS_DATASET_SOURCE", "gdrive")
+
+def is_http_source(source):
+    return source.startswith("http://") or source.startswith("https://")
+
+def get_marker_path(dest_path):
+    return os.path.splitext(dest_path)[0] + ".complete"
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# Expected checksum of a zip, from the environment or a SHA256SUMS file at the source
+def get_expected_checksum(source, zip_name, env_var):
+    if os.environ.get(env_var):
+        return os.environ[env_var].lower()
+    if source == "gdrive":
+        return None
+    try:
+        if is_http_source(source):
+            with urllib.request.urlopen(source.rstrip("/") + "/SHA256SUMS") as response:
+                sums = response.read().decode()
+        else:
+            with open(os.path.join(source, "SHA256SUMS")) as f:
+                sums = f.read()
+    except (OSError, ValueError):
+        return None
+    for line in sums.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip("*") == zip_name:
+            return parts[0].lower()
+    return None
+
+# Whether a zip can be opened and the CRC of every member matches, e.g. to
+# detect a truncated download
+def is_valid_zip(zip_path):
+    if not zipfile.is_zipfile(zip_path):
+        return False
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            return zf.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+# Without a checksum, the zip is only checked to be complete
+def verify_checksum(zip_path, expected_checksum):
+    if expected_checksum is None:
+        print("[INFO] No checksum available for {}, checking the zip is complete".format(zip_path))
+        return is_valid_zip(zip_path)
+    return sha256_file(zip_path) == expected_checksum
+
+# Download a URL in chunks into dest_path. Data is written to a .part file, and
+# an interrupted download resumes from the end of it with a Range request.
+def download_resumable(url, dest_path):
+    part_path = dest_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request = urllib.request.Request(url)
+    if offset > 0:
+        print("[INFO] Resuming download of {} at {} bytes...".format(url, offset))
+        request.add_header("Range", "bytes={}-".format(offset))
+    else:
+        print("[INFO] Downloading {}...".format(url))
+
+    with urllib.request.urlopen(request) as response:
+        # The server ignored the Range header, so start again from the beginning
+        mode = "ab" if offset > 0 and response.status == 206 else "wb"
+        with open(part_path, mode) as f:
+            for chunk in iter(lambda: response.read(chunk_size), b""):
+                f.write(chunk)
+    os.replace(part_path, dest_path)
+
+# Zips from a local directory are extracted in place rather than copied
+def get_zip_path(dest_path):
+    source = get_dataset_source()
+    if source == "gdrive" or is_http_source(source):
+        return dest_path
+    return os.path.join(source, os.path.basename(dest_path))
+
+# Make sure a verified copy of the zip from the configured source is available
+# and return its path
+def fetch_zip(file_id, dest_path, env_var):
+    source = get_dataset_source()
+    zip_name = os.path.basename(dest_path)
+    zip_path = get_zip_path(dest_path)
+    expected_checksum = get_expected_checksum(source, zip_name, env_var)
+
+    if zip_path != dest_path:
+        print("[INFO] Using {} from local mirror {}...".format(zip_name, source))
+        if not verify_checksum(zip_path, expected_checksum):
+            raise IOError("Checksum mismatch for {}".format(zip_path))
+        return zip_path
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    if os.path.exists(dest_path):
+        if verify_checksum(dest_path, expected_checksum):
+            return dest_path
+        print("[INFO] {} is incomplete or corrupt, fetching it again...".format(dest_path))
+        os.remove(dest_path)
+
+    if source == "gdrive":
+        from google_drive_downloader import GoogleDriveDownloader as gdd
+        # Downloaded next to the zip and moved into place once complete, so an
+        # interrupted download never leaves a partial zip at dest_path
+        tmp_path = "{}.{}.tmp".format(dest_path, os.getpid())
+        gdd.download_file_from_google_drive(
+            file_id=file_id,
+            dest_path=tmp_path,
+            overwrite=True)
+        os.replace(tmp_path, dest_path)
+    else:
+        download_resumable(source.rstrip("/") + "/" + zip_name, dest_path)
+
+    if not verify_checksum(dest_path, expected_checksum):
+        os.remove(dest_path)
+        raise IOError("Verification failed for {}, the download has been removed".format(dest_path))
+    return dest_path
+
+# Members which are missing or have the wrong size in the extraction directory
+def get_missing_members(zip_path, dest_dir):
+    with zipfile.ZipFile(zip_path) as zf:
+        return [info.filename for info in zf.infolist()
+                if not info.is_dir() and (
+                    not os.path.exists(os.path.join(dest_dir, info.filename)) or
+                    os.path.getsize(os.path.join(dest_dir, info.filename)) != info.file_size)]
+
+def extract_members(zip_path, dest_dir, members):
+    # Each thread needs its own handle on the zip file
+    with zipfile.ZipFile(zip_path) as zf:
+        for member in members:
+            zf.extract(member, dest_dir)
+
+# Extract the members of a zip which are not already extracted, in parallel
+def extract_zip(zip_path, dest_dir, num_workers=8):
+    members = get_missing_members(zip_path, dest_dir)
+    if not members:
+        return
+    print("[INFO] Extracting {} files from {}...".format(len(members), zip_path))
+    # zipfile creates missing parent directories itself, which races between
+    # threads, so they are all created up front
+    for directory in set(os.path.dirname(os.path.join(dest_dir, member)) for member in members):
+        os.makedirs(directory, exist_ok=True)
+    chunks = [members[i::num_workers] for i in range(num_workers)]
+    with ThreadPoolExecutor(num_workers) as executor:
+        list(executor.map(lambda chunk: extract_members(zip_path, dest_dir, chunk), chunks))
+    missing = get_missing_members(zip_path, dest_dir)
+    if missing:
+        raise IOError("{} files from {} could not be extracted".format(len(missing), zip_path))
+
+def download_dataset(file_id, dest_path, env_var):
+    zip_path = fetch_zip(file_id, dest_path, env_var)
+    extract_zip(zip_path, extract_dir)
+    with open(get_marker_path(dest_path), "w") as f:
+        json.dump({"zip": os.path.abspath(zip_path)}, f)
+
+# Whether a dataset has been fully extracted. A directory without a marker is
+# either a partial unzip, which is repaired from the zip, or an extraction from
+# before markers were written, which is trusted if the zip is no longer there.
+def is_dataset_complete(dataset_dir, dest_path):
+    if os.path.exists(get_marker_path(dest_path)):
+        return True
+    if os.path.exists(dataset_dir) and not os.path.exists(get_zip_path(dest_path)):
+        print("[INFO] {} has no completion marker and no zip to verify it against".format(dataset_dir))
+        return True
+    return False
+
+# Download datasets from the configured source
 def download_train_dataset():
-    gdd.download_file_from_google_drive(
-        file_id=train_file_id,
-        dest_path=train_dest_path,
-        unzip=True)
+    download_dataset(train_file_id, train_dest_path, "AMLS_TRAIN_SHA256")
 
 def download_test_dataset():
-    gdd.download_file_from_google_drive(
-        file_id=test_file_id,
-        dest_path=test_dest_path,
-        unzip=True)
\ No newline at end of file
+    download_dataset(test_file_id, test_dest_path, "AMLS_TEST_SHA256")
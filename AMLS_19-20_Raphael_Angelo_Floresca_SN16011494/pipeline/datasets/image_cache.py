@@ -0,0 +1,200 @@
+# Decoded-image cache for the celeba and cartoon_set splits.
+# Each split is decoded once at the target (height, width) into a memory-mapped
+# uint8 .npy file, so that later epochs read raw pixels instead of re-opening,
+# re-decoding and re-resizing every image under img/.
+# Caches are keyed by dataset, target size and a hash of labels.csv.
+
+import hashlib
+import json
+import os
+import numpy as np
+from tensorflow.keras.preprocessing.image import load_img
+from tensorflow.keras.utils import Sequence
+
+# Hash labels.csv, used to invalidate the cache when the labels change
+def hash_labels_file(labels_path):
+    sha = hashlib.sha1()
+    with open(labels_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+def get_cache_key(img_dir, height, width, labels_hash):
+    return "{}_{}x{}_{}".format(img_dir, height, width, labels_hash)
+
+# Temporary files are named per process, so that tasks running in parallel can
+# build the same cache without clobbering each other's partial writes
+def get_tmp_path(path):
+    return "{}.{}.tmp".format(path, os.getpid())
+
+# Write a file atomically by writing a temporary file and renaming it
+def save_atomic(path, write):
+    tmp_path = get_tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+# Decode every image listed in x_col into a (num_images, height, width, 3) uint8
+# array. It is written to a temporary file first and then renamed, so an
+# interrupted ingest never leaves a truncated cache behind.
+def decode_images(filenames, images_path, height, width, image_dir):
+    print("[INFO] Decoding {} images into {}...".format(len(filenames), images_path))
+    tmp_path = get_tmp_path(images_path)
+    images = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(filenames), height, width, 3))
+    for i, filename in enumerate(filenames):
+        img = load_img(os.path.join(image_dir, filename), target_size=(height, width))
+        images[i] = np.asarray(img, dtype=np.uint8)
+    images.flush()
+    del images
+    os.replace(tmp_path, images_path)
+
+# Build (or reuse) the cache for the image set at dataset_root and return the
+# memory-mapped images, the task's labels as class indices and the class names.
+# Caches are stored in the dataset directory, next to img/ and labels.csv.
+# Labels come from the label index (see label_index.py), whose class indices
+# follow the sorted order used by flow_from_dataframe with class_mode="sparse".
+def build_image_cache(task_labels, img_dir, height, width, dataset_root):
+    key = get_cache_key(img_dir, height, width, hash_labels_file(dataset_root.labels_path))
+    cache_path = os.path.join(dataset_root.cache_dir, key)
+    images_path = os.path.join(cache_path, "images.npy")
+    filenames_path = os.path.join(cache_path, "filenames.json")
+    os.makedirs(cache_path, exist_ok=True)
+
+    filenames = task_labels.filenames.tolist()
+
+    if not os.path.exists(images_path):
+        save_atomic(filenames_path, lambda f: f.write(json.dumps(filenames).encode()))
+        decode_images(filenames, images_path, height, width, dataset_root.img_dir)
+    else:
+        # Images are shared between the tasks of a dataset, so make sure the
+        # rows are in the order they were decoded in
+        with open(filenames_path) as f:
+            if json.load(f) != filenames:
+                raise ValueError("Image cache {} does not match the label index order".format(cache_path))
+
+    images = np.load(images_path, mmap_mode="r")
+    return images, task_labels.labels, task_labels.classes
+
+# Split the rows of a cache the same way ImageDataGenerator does with
+# validation_split: the first part is the validation subset, the rest is training.
+def split_indices(num_images, validation_split):
+    split_idx = int(validation_split * num_images)
+    indices = np.arange(num_images)
+    return indices[split_idx:], indices[:split_idx]
+
+# Draw the augmentation parameters of an ImageDataGenerator for one image, as
+# datagen.get_random_transform does, but from rng rather than the global
+# np.random, so that seeding a sequence does not reseed the whole process
+def get_random_transform(datagen, img_shape, rng):
+    def draw_shift(shift_range, size):
+        if not shift_range:
+            return 0
+        # A list is a choice between its values, with a random sign
+        if isinstance(shift_range, (list, tuple, np.ndarray)):
+            shift = rng.choice(shift_range) * rng.choice([-1, 1])
+        else:
+            shift = rng.uniform(-shift_range, shift_range)
+        if np.max(shift_range) < 1:
+            shift *= size
+        return shift
+
+    zx, zy = 1, 1
+    if datagen.zoom_range[0] != 1 or datagen.zoom_range[1] != 1:
+        zx, zy = rng.uniform(datagen.zoom_range[0], datagen.zoom_range[1], 2)
+    return {
+        "theta": rng.uniform(-datagen.rotation_range, datagen.rotation_range) if datagen.rotation_range else 0,
+        "tx": draw_shift(datagen.height_shift_range, img_shape[0]),
+        "ty": draw_shift(datagen.width_shift_range, img_shape[1]),
+        "shear": rng.uniform(-datagen.shear_range, datagen.shear_range) if datagen.shear_range else 0,
+        "zx": zx,
+        "zy": zy,
+        "flip_horizontal": (rng.random_sample() < 0.5) * datagen.horizontal_flip,
+        "flip_vertical": (rng.random_sample() < 0.5) * datagen.vertical_flip,
+        "channel_shift_intensity": rng.uniform(-datagen.channel_shift_range, datagen.channel_shift_range)
+            if datagen.channel_shift_range else None,
+        "brightness": rng.uniform(datagen.brightness_range[0], datagen.brightness_range[1])
+            if datagen.brightness_range is not None else None}
+
+# Keras Sequence which reads batches straight from a decoded-image cache.
+# Augmentation and rescaling are taken from an ImageDataGenerator, so the
+# batches match what flow_from_dataframe would produce for the same datagen.
+# Labels can also be a dictionary of label arrays, keyed by model output.
+# For non-augmenting, unshuffled sequences (validation and testing) the batches
+# are deterministic, so with cache_batches they are computed once and reused.
+# Shuffling and augmentation are drawn from the sequence's own RandomState.
+class CachedImageSequence(Sequence):
+    def __init__(
+            self,
+            images,
+            labels,
+            indices,
+            batch_size,
+            datagen=None,
+            preprocessing_function=None,
+            shuffle=True,
+            seed=None,
+            cache_batches=False):
+        self.images = images
+        self.labels = labels
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.datagen = datagen
+        self.preprocessing_function = preprocessing_function
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.samples = len(self.indices)
+        self.cache_batches = cache_batches and not shuffle
+        self.batch_cache = {}
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.samples / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        if idx in self.batch_cache:
+            return self.batch_cache[idx]
+
+        # Sorted indices keep reads from the memory map sequential
+        batch_indices = np.sort(self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size])
+        batch_x = self.images[batch_indices].astype(np.float32)
+        for i in range(len(batch_x)):
+            if self.preprocessing_function is not None:
+                batch_x[i] = self.preprocessing_function(batch_x[i])
+            if self.datagen is not None:
+                params = get_random_transform(self.datagen, batch_x[i].shape, self.random)
+                batch_x[i] = self.datagen.apply_transform(batch_x[i], params)
+                batch_x[i] = self.datagen.standardize(batch_x[i])
+        # A dictionary of label arrays gives one label batch per model output
+        if isinstance(self.labels, dict):
+            batch_y = {name: labels[batch_indices].astype(np.float32) for name, labels in self.labels.items()}
+        else:
+            batch_y = self.labels[batch_indices].astype(np.float32)
+        if self.cache_batches:
+            self.batch_cache[idx] = (batch_x, batch_y)
+        return batch_x, batch_y
+
+    def on_epoch_end(self):
+        self.index_array = self.indices.copy()
+        if self.shuffle:
+            self.random.shuffle(self.index_array)
+
+# One-time ingest of every split at the resolutions used by the tasks
+if __name__ == "__main__":
+    from pipeline.datasets.utilities import (create_celeba_index, create_cartoon_set_index,
+        create_celeba_test_index, create_cartoon_set_test_index,
+        celeba_root, cartoon_set_root, celeba_test_root, cartoon_set_test_root)
+
+    splits = [
+        (create_celeba_index, celeba_root, "celeba", "gender", 218, 178),
+        (create_celeba_test_index, celeba_test_root, "celeba", "gender", 218, 178),
+        (create_cartoon_set_index, cartoon_set_root, "cartoon_set", "face_shape", 299, 299),
+        (create_cartoon_set_test_index, cartoon_set_test_root, "cartoon_set", "face_shape", 299, 299)]
+
+    # The images are shared by both label columns of an image set, so a single
+    # column is enough to build the cache
+    for create_index, dataset_root, img_dir, y_col, height, width in splits:
+        build_image_cache(create_index().get_task_labels(y_col), img_dir, height, width, dataset_root)
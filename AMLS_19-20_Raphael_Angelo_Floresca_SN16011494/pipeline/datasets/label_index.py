@@ -0,0 +1,92 @@
+# Columnar label index for an image set.
+# labels.csv is parsed once per dataset root and stored in the cache folder as
+# one .npy file per column: the filenames, stored once and shared by every task
+# of the dataset, and an int8 array of class indices for each label column.
+# Later runs memory-map these files instead of parsing labels.csv again, and
+# every task of a dataset gets a view of its column from the same index.
+# The index is keyed by a hash of labels.csv, so it is rebuilt when the labels
+# change.
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from pipeline.datasets.image_cache import hash_labels_file, save_atomic
+
+# Indices already loaded in this process, keyed by labels.csv path
+loaded_indices = {}
+
+# The labels of a single task: a view of one column of a LabelIndex
+class TaskLabels:
+    def __init__(self, filenames, labels, classes, x_col, y_col):
+        self.filenames = filenames
+        # Class indices in the sorted order used by flow_from_dataframe with
+        # class_mode="sparse"
+        self.labels = labels
+        self.classes = classes
+        self.x_col = x_col
+        self.y_col = y_col
+
+    def __len__(self):
+        return len(self.filenames)
+
+    # Only needed by the flow_from_dataframe input path, which expects string
+    # filenames and class names
+    def to_dataframe(self):
+        return pd.DataFrame({
+            self.x_col: self.filenames.astype(str),
+            self.y_col: np.asarray(self.classes, dtype=object)[self.labels]})
+
+class LabelIndex:
+    def __init__(self, filenames, columns, classes, x_col):
+        self.filenames = filenames
+        self.columns = columns
+        self.classes = classes
+        self.x_col = x_col
+
+    def get_task_labels(self, y_col):
+        return TaskLabels(self.filenames, self.columns[y_col], self.classes[y_col], self.x_col, y_col)
+
+def get_index_path(dataset_root):
+    labels_hash = hash_labels_file(dataset_root.labels_path)
+    return os.path.join(dataset_root.cache_dir, "label_index_{}".format(labels_hash))
+
+# Parse labels.csv and write the index. The first column of labels.csv is the
+# row number and is not stored.
+def build_label_index(dataset_root, x_col, index_path):
+    print("[INFO] Building label index for {}...".format(dataset_root.labels_path))
+    df = pd.read_csv(dataset_root.labels_path, sep="\t", dtype=str)
+    y_cols = [col for col in df.columns[1:] if col != x_col]
+    os.makedirs(index_path, exist_ok=True)
+
+    classes = {}
+    for y_col in y_cols:
+        classes[y_col] = sorted(df[y_col].unique())
+        class_indices = {c: i for i, c in enumerate(classes[y_col])}
+        labels = np.array([class_indices[label] for label in df[y_col]], dtype=np.int8)
+        save_atomic(os.path.join(index_path, "{}.npy".format(y_col)), lambda f: np.save(f, labels))
+
+    filenames = np.array(df[x_col].tolist(), dtype=np.str_)
+    save_atomic(os.path.join(index_path, "filenames.npy"), lambda f: np.save(f, filenames))
+    # Written last, its presence marks a complete index
+    save_atomic(os.path.join(index_path, "classes.json"), lambda f: f.write(json.dumps(classes).encode()))
+
+# Load (building it if needed) the label index of the image set at dataset_root
+def load_label_index(dataset_root, x_col):
+    if dataset_root.labels_path in loaded_indices:
+        return loaded_indices[dataset_root.labels_path]
+
+    index_path = get_index_path(dataset_root)
+    classes_path = os.path.join(index_path, "classes.json")
+    if not os.path.exists(classes_path):
+        build_label_index(dataset_root, x_col, index_path)
+
+    with open(classes_path) as f:
+        classes = json.load(f)
+    filenames = np.load(os.path.join(index_path, "filenames.npy"), mmap_mode="r")
+    columns = {y_col: np.load(os.path.join(index_path, "{}.npy".format(y_col)), mmap_mode="r")
+               for y_col in classes}
+
+    index = LabelIndex(filenames, columns, classes, x_col)
+    loaded_indices[dataset_root.labels_path] = index
+    return index
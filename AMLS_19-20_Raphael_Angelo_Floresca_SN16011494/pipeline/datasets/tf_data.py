@@ -0,0 +1,179 @@
+# tf.data input backend, an alternative to the ImageDataGenerator iterators
+# returned by create_train_datagens. Files are read and decoded in parallel,
+# the decoded images are cached, and augmentation equivalent to the
+# ImageDataGenerator settings (shifts, horizontal flip, rotation and zoom) is
+# applied to whole batches on the graph. Batches are prefetched, so the model
+# never waits on a single Python thread decoding images.
+
+import math
+import numpy as np
+import tensorflow as tf
+from pipeline.distributed import get_worker_shard
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# -1 or 1 with equal probability, for every image of a batch
+def random_signs(batch_size):
+    return tf.where(tf.random.uniform([batch_size]) < 0.5, -tf.ones([batch_size]), tf.ones([batch_size]))
+
+# Build a projective transform for every image of a batch, combining a random
+# rotation, zoom, shift and horizontal flip about the image centre. The
+# transforms map output pixel coordinates to input pixel coordinates, in the
+# [a0, a1, a2, b0, b1, b2, c0, c1] format used by tf image transforms.
+def random_affine_transforms(
+        batch_size,
+        height,
+        width,
+        shift_range=0.10,
+        rotation_range=10,
+        zoom_range=(0.90, 1.10),
+        horizontal_flip=True):
+    theta = tf.random.uniform([batch_size], -rotation_range, rotation_range) * math.pi / 180
+    zx = tf.random.uniform([batch_size], zoom_range[0], zoom_range[1])
+    zy = tf.random.uniform([batch_size], zoom_range[0], zoom_range[1])
+    # The ImageDataGenerator shift ranges are the lists [-0.10, 0.10], which
+    # Keras reads as a choice between exactly those two shifts
+    tx = random_signs(batch_size) * shift_range * width
+    ty = random_signs(batch_size) * shift_range * height
+    flip = tf.ones([batch_size])
+    if horizontal_flip:
+        flip = random_signs(batch_size)
+
+    cx, cy = (width - 1) / 2., (height - 1) / 2.
+    a0 = tf.cos(theta) * zx * flip
+    a1 = -tf.sin(theta) * zy
+    b0 = tf.sin(theta) * zx * flip
+    b1 = tf.cos(theta) * zy
+    a2 = cx - a0 * cx - a1 * cy + tx
+    b2 = cy - b0 * cx - b1 * cy + ty
+    zeros = tf.zeros([batch_size])
+    return tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+
+# Apply a batch of projective transforms. tf.contrib is used on TensorFlow 1.x,
+# where out-of-image pixels are filled with zeros rather than the nearest pixel.
+def apply_transforms(images, transforms):
+    try:
+        from tensorflow.contrib.image import transform
+        return transform(images, transforms, interpolation="NEAREST")
+    except ImportError:
+        return tf.raw_ops.ImageProjectiveTransformV2(
+            images=images,
+            transforms=transforms,
+            output_shape=tf.shape(images)[1:3],
+            interpolation="NEAREST",
+            fill_mode="NEAREST")
+
+# Read, decode and resize a single image. Images are kept as uint8 until they
+# are batched, so that the cache holds a quarter of the float32 size.
+def load_image(path, label, height, width):
+    img = tf.image.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, [height, width], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    img = tf.cast(img, tf.uint8)
+    img.set_shape([height, width, 3])
+    return img, label
+
+# The rows of a data-parallel worker: every num_shards-th row from shard_index,
+# cut to the same number of rows on every worker, so that all the workers run
+# the same number of steps per epoch
+def get_shard(rows, num_shards, shard_index):
+    return rows[shard_index::num_shards][:len(rows) // num_shards]
+
+# The datasets are sharded by the rows of the task dataframe, so the automatic
+# sharding of the distribution strategy is turned off
+def get_sharded_options():
+    options = tf.data.Options()
+    try:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    except AttributeError:
+        options.experimental_distribute.auto_shard = False
+    return options
+
+def create_tf_dataset(
+        paths,
+        labels,
+        height,
+        width,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        augment,
+        cache_path="",
+        num_shards=1):
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(lambda path, label: load_image(path, label, height, width), num_parallel_calls=AUTOTUNE)
+    # An empty cache_path caches the decoded images in memory
+    ds = ds.cache(cache_path)
+    if augment:
+        ds = ds.shuffle(len(paths), seed=random_state, reshuffle_each_iteration=True)
+    ds = ds.repeat()
+    # In a data-parallel run each batch is split between the workers, which
+    # each read their own shard, so every worker trains on batch_size images of
+    # its shard per step
+    ds = ds.batch(batch_size * num_shards)
+
+    def transform_batch(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augment:
+            transforms = random_affine_transforms(tf.shape(images)[0], height, width)
+            images = apply_transforms(images, transforms)
+        # Same order as ImageDataGenerator.standardize: preprocessing_function, then rescaling
+        if preprocessing_function is not None:
+            images = preprocessing_function(images)
+        return images * (1./255), labels
+
+    ds = ds.map(transform_batch, num_parallel_calls=AUTOTUNE)
+    ds = ds.prefetch(AUTOTUNE)
+    if num_shards > 1:
+        ds = ds.with_options(get_sharded_options())
+    # Number of images per epoch, used by the trainers to compute steps_per_epoch
+    # in the same way as for the ImageDataGenerator iterators
+    ds.samples = len(paths)
+    return ds
+
+# Create tf.data datasets for training and validation from a task's labels.
+# Like create_train_datagens, images are read from dataset_root, the first
+# validation_split of the rows is used for validation and labels are the class
+# indices of the label index. Only the training set is augmented. In a
+# data-parallel run (see pipeline.distributed) each worker reads a disjoint
+# shard of the training and validation rows.
+def create_tf_datasets(
+        height,
+        width,
+        train_labels,
+        img_dir,
+        x_col,
+        y_col,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        dataset_root,
+        validation_split=0.25):
+    paths = np.array([dataset_root.get_image_path(f) for f in train_labels.filenames.tolist()])
+    labels = train_labels.labels.astype(np.float32)
+
+    split_idx = int(validation_split * len(paths))
+    num_shards, shard_index = get_worker_shard()
+
+    train_ds = create_tf_dataset(
+        get_shard(paths[split_idx:], num_shards, shard_index),
+        get_shard(labels[split_idx:], num_shards, shard_index),
+        height,
+        width,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        augment=True,
+        num_shards=num_shards)
+
+    val_ds = create_tf_dataset(
+        get_shard(paths[:split_idx], num_shards, shard_index),
+        get_shard(labels[:split_idx], num_shards, shard_index),
+        height,
+        width,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        augment=False,
+        num_shards=num_shards)
+
+    return train_ds, val_ds
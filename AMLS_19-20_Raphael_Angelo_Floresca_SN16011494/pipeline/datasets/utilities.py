@@ -1,21 +1,25 @@
 import pandas as pd
+import numpy as np
 import os
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from pipeline.datasets.download_data import download_train_dataset, download_test_dataset
+from pipeline.datasets.download_data import download_train_dataset, download_test_dataset, is_dataset_complete, train_dest_path, test_dest_path
+from pipeline.datasets.image_cache import build_image_cache, split_indices, CachedImageSequence
+from pipeline.datasets.dataset_root import DatasetRoot, project_dir
+from pipeline.datasets.label_index import load_label_index
 
 dataset_dir = ""
 data_dir = "data/dataset_AMLS_19-20"
 test_dir = "data/dataset_test_AMLS_19-20"
 parent_dir = "AMLSassignment19_20/AMLS_19-20_Raphael_Angelo_Floresca_SN16011494"
 
-# This checks whether the training dataset has been downloaded
+# This checks whether the training dataset has been downloaded and fully extracted
 def check_train_path():
-    if not os.path.exists(data_dir):
+    if not is_dataset_complete(os.path.join(project_dir, data_dir), train_dest_path):
         download_train_dataset()
 
-# This checks whether the test dataset has been downloaded
+# This checks whether the test dataset has been downloaded and fully extracted
 def check_test_path():
-    if not os.path.exists(test_dir):
+    if not is_dataset_complete(os.path.join(project_dir, test_dir), test_dest_path):
         download_test_dataset()
 
 # Paths of the two datasets
@@ -24,80 +28,116 @@ cartoon_set_dir = "cartoon_set"
 celeba_test_dir = "celeba_test"
 cartoon_set_test_dir = "cartoon_set_test"
 
-# Used to go up three directories
-def go_up_three_dirs():
-    os.chdir("..")
-    os.chdir("..")
-    os.chdir("..")
+# Absolute roots of the four image sets
+celeba_root = DatasetRoot(data_dir, celeba_dir)
+cartoon_set_root = DatasetRoot(data_dir, cartoon_set_dir)
+celeba_test_root = DatasetRoot(test_dir, celeba_test_dir)
+cartoon_set_test_root = DatasetRoot(test_dir, cartoon_set_test_dir)
+
+# Import labels.csv of an image set as a dataframe
+def read_labels(dataset_root):
+    return pd.read_csv(dataset_root.labels_path, sep="\t", dtype=str)
 
 # Create a dataframe for the celeba labels.csv
 def create_celeba_df():
     check_train_path()
-    os.chdir(os.path.join(data_dir, celeba_dir))
-    # Import data as dataframe
-    df = pd.read_csv("labels.csv", sep="\t", dtype=str)
-    go_up_three_dirs()
-    return df
+    return read_labels(celeba_root)
 
 # Create a dataframe for the cartoon_set labels.csv
 def create_cartoon_set_df():
     check_train_path()
-    os.chdir(os.path.join(data_dir, cartoon_set_dir))
-    # Import data as dataframe
-    df = pd.read_csv("labels.csv", sep="\t", dtype=str)
-    go_up_three_dirs()
-    return df
+    return read_labels(cartoon_set_root)
 
 # Create a test dataframe for the celeba labels.csv
 def create_celeba_test_df():
     check_test_path()
-    os.chdir(os.path.join(test_dir, celeba_test_dir))
-    # Import data as dataframe
-    df = pd.read_csv("labels.csv", sep="\t", dtype=str)
-    go_up_three_dirs()
-    return df
+    return read_labels(celeba_test_root)
 
 # Create a test dataframe for the cartoon_set labels.csv
 def create_cartoon_set_test_df():
     check_test_path()
-    os.chdir(os.path.join(test_dir, cartoon_set_test_dir))
-    # Import data as dataframe
-    df = pd.read_csv("labels.csv", sep="\t", dtype=str)
-    go_up_three_dirs()
-    return df
+    return read_labels(cartoon_set_test_root)
+
+# Label index of each image set, parsed from labels.csv once and shared by the
+# tasks using that image set
+def create_celeba_index():
+    check_train_path()
+    return load_label_index(celeba_root, "img_name")
+
+def create_cartoon_set_index():
+    check_train_path()
+    return load_label_index(cartoon_set_root, "file_name")
+
+def create_celeba_test_index():
+    check_test_path()
+    return load_label_index(celeba_test_root, "img_name")
+
+def create_cartoon_set_test_index():
+    check_test_path()
+    return load_label_index(cartoon_set_test_root, "file_name")
+
+# Create a non-augmenting ImageDataGenerator for validation and testing.
+# It only rescales, so evaluation is cheaper and repeatable across runs.
+def create_eval_datagen(validation_split=0.0):
+    return ImageDataGenerator(
+        rescale=1./255,
+        validation_split=validation_split)
+
+# Create the augmenting ImageDataGenerator used for training
+def create_augmenting_datagen(validation_split=0.0):
+    return ImageDataGenerator(
+        rescale=1./255, 
+        width_shift_range=[-0.10,0.10],
+        height_shift_range=[-0.10,0.10],
+        horizontal_flip=True,
+        rotation_range=10,
+        zoom_range=[0.90,1.10],
+        validation_split=validation_split)
 
 # Create ImageDataGenerators for training, validation and testing
 # Rescale to ensure RGB values fall between 0 and 1, speeding up training.
 # Set aside 20% of the training set for validation by default, this can be changed.
+# The validation set is not augmented, see create_eval_datagen.
+# With cache_eval_batches, validation batches are computed once and kept in memory.
+# Images are read from dataset_root, so the working directory is not used.
+# With use_cache, images are decoded once into the decoded-image cache and the
+# generators read batches from it instead of from img/.
 def create_train_datagens(
         height, 
         width,
-        train_df,
+        train_labels,
         img_dir,
         x_col,
         y_col,
         batch_size, 
         random_state,
         preprocessing_function,
-        validation_split=0.25):
+        dataset_root,
+        validation_split=0.25,
+        use_cache=True,
+        cache_eval_batches=False):
 
-    # Create datagen
-    datagen = ImageDataGenerator(
-        rescale=1./255, 
-        width_shift_range=[-0.10,0.10],
-        height_shift_range=[-0.10,0.10],
-        horizontal_flip=True,
-        rotation_range=10,
-        zoom_range=[0.90,1.10],
-        validation_split=validation_split)
+    # Create datagens
+    eval_datagen = create_eval_datagen(validation_split)
+    datagen = create_augmenting_datagen(validation_split)
 
-    # Create dataframes
-    train = train_df
+    if use_cache:
+        images, labels, _ = build_image_cache(train_labels, img_dir, height, width, dataset_root)
+        train_indices, val_indices = split_indices(len(images), validation_split)
+        train_gen = CachedImageSequence(images, labels, train_indices, batch_size,
+            datagen, preprocessing_function, seed=random_state)
+        val_gen = CachedImageSequence(images, labels, val_indices, batch_size,
+            eval_datagen, preprocessing_function, shuffle=False, seed=random_state,
+            cache_batches=cache_eval_batches)
+        return train_gen, val_gen
+
+    # flow_from_dataframe needs string filenames and class names
+    train = train_labels.to_dataframe()
 
     # Generate an image-label pair for the training set
     train_gen = datagen.flow_from_dataframe(
         dataframe=train, 
-        directory="img/",
+        directory=dataset_root.img_dir,
         x_col=x_col,
         y_col=y_col,
         class_mode="sparse",
@@ -107,65 +147,120 @@ def create_train_datagens(
         preprocessing_function=preprocessing_function)
 
     # Generate an image-label pair for the validation set as follows
-    val_gen = datagen.flow_from_dataframe(
+    val_gen = eval_datagen.flow_from_dataframe(
         dataframe=train,
-        directory="img/",
+        directory=dataset_root.img_dir,
         x_col=x_col,
         y_col=y_col,
         class_mode="sparse",
         target_size=(height,width),
         batch_size=batch_size,
+        shuffle=False,
         subset="validation",
         preprocessing_function=preprocessing_function)
 
-    go_up_three_dirs()
+    return train_gen, val_gen
 
+# Create training and validation sequences yielding the labels of several tasks
+# sharing an image set, as a dictionary of task name -> labels for each batch.
+# task_labels maps each task to its TaskLabels. The images are read from the
+# decoded-image cache, which the tasks share, and split into the same training
+# and validation subsets as for each task on its own.
+def create_multi_label_datagens(
+        height,
+        width,
+        task_labels,
+        img_dir,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        dataset_root,
+        validation_split=0.25):
+    first_labels = next(iter(task_labels.values()))
+    images, _, _ = build_image_cache(first_labels, img_dir, height, width, dataset_root)
+    labels = {task: task_labels[task].labels for task in task_labels}
+
+    train_indices, val_indices = split_indices(len(images), validation_split)
+    train_gen = CachedImageSequence(images, labels, train_indices, batch_size,
+        create_augmenting_datagen(validation_split), preprocessing_function, seed=random_state)
+    val_gen = CachedImageSequence(images, labels, val_indices, batch_size,
+        create_eval_datagen(validation_split), preprocessing_function, shuffle=False, seed=random_state)
     return train_gen, val_gen
 
+# Create a test sequence yielding the labels of several tasks sharing an image set
+def create_multi_label_test_datagen(
+        height,
+        width,
+        task_labels,
+        img_dir,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        dataset_root):
+    first_labels = next(iter(task_labels.values()))
+    images, _, _ = build_image_cache(first_labels, img_dir, height, width, dataset_root)
+    labels = {task: task_labels[task].labels for task in task_labels}
+    return CachedImageSequence(images, labels, np.arange(len(images)), batch_size,
+        create_eval_datagen(), preprocessing_function, shuffle=False, seed=random_state)
+
+# Create the training and validation inputs with the selected input backend:
+# "keras" for the ImageDataGenerator based generators, "tf_data" for tf.data
+def create_train_inputs(input_backend, *args, **kwargs):
+    if input_backend == "tf_data":
+        from pipeline.datasets.tf_data import create_tf_datasets
+        return create_tf_datasets(*args, **kwargs)
+    return create_train_datagens(*args, **kwargs)
+
 # Create ImageDataGenerators for training, validation and testing
 # Rescale to ensure RGB values fall between 0 and 1, speeding up training.
 # Set aside 20% of the training set for validation by default, this can be changed.
 def create_test_datagen(
         height, 
         width,
-        test_df,
+        test_labels,
         img_dir,
         x_col,
         y_col,
         batch_size, 
         random_state,
-        preprocessing_function):
+        preprocessing_function,
+        dataset_root,
+        use_cache=True,
+        cache_eval_batches=False):
 
-    # Create datagen
-    datagen = ImageDataGenerator(
-        rescale=1./255, 
-        width_shift_range=[-0.10,0.10],
-        height_shift_range=[-0.10,0.10],
-        horizontal_flip=True,
-        rotation_range=10,
-        zoom_range=[0.90,1.10]
-    )
+    # Create datagen, the test set is not augmented
+    datagen = create_eval_datagen()
 
-    # Create dataframe
-    test = test_df
+    if use_cache:
+        images, labels, _ = build_image_cache(test_labels, img_dir, height, width, dataset_root)
+        test_gen = CachedImageSequence(images, labels, np.arange(len(images)), batch_size,
+            datagen, preprocessing_function, shuffle=False, seed=random_state,
+            cache_batches=cache_eval_batches)
+        return test_gen
+
+    # flow_from_dataframe needs string filenames and class names
+    test = test_labels.to_dataframe()
 
     # Generate an image-label pair for the smiling test set as follows
-    # Set batch_size = size of test set
+    # The test set is streamed in batches of batch_size, see pipeline.evaluation
     test_gen = datagen.flow_from_dataframe(
         dataframe=test,
-        directory="img/",
+        directory=dataset_root.img_dir,
         x_col=x_col,
         y_col=y_col,
         class_mode="sparse",
         target_size=(height,width),
-        batch_size=len(test),
+        batch_size=batch_size,
+        shuffle=False,
         preprocessing_function=preprocessing_function)
 
-    go_up_three_dirs()
-
     return test_gen
 
+# Materialise the whole test set. This holds every image in memory at once,
+# prefer evaluate_streaming from pipeline.evaluation.streaming.
 def get_X_y_test_sets(test_gen):
     itr = test_gen
-    X_test, y_test = itr.next()
+    batches = [itr[i] for i in range(len(itr))]
+    X_test = np.concatenate([X for X, _ in batches])
+    y_test = np.concatenate([y for _, y in batches])
     return X_test, y_test
\ No newline at end of file
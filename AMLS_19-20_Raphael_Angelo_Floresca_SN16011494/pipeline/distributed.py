@@ -0,0 +1,163 @@
+# Data-parallel training of a task over several worker processes, on one or
+# more hosts. Every worker holds a replica of the model and reads a disjoint
+# shard of the task's training and validation rows (see
+# pipeline.datasets.tf_data). The gradients of each step are averaged over the
+# workers with a synchronous all-reduce (MultiWorkerMirroredStrategy), so each
+# step trains on a global batch of batch_size images per worker, and an epoch
+# takes 1/num_workers of the steps of a single process.
+# Worker 0 (the chief) plots, saves and tests the trained model.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with, for four
+# workers on this machine:
+#   python -m pipeline.distributed -w 4 -k A1 -t xception -e 10 -l 0.003
+# or, on each of several hosts (task index 0 on the first host, 1 on the second):
+#   python -m pipeline.distributed --worker_hosts host1:23456,host2:23456 --task_index 0 -k A1 ...
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import subprocess
+import sys
+from contextlib import contextmanager
+
+# The cluster of the current process, as described by TF_CONFIG. Returns the
+# list of worker addresses and the index of this worker, or None outside a
+# multi-worker cluster.
+def get_cluster():
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    workers = tf_config.get("cluster", {}).get("worker", [])
+    if len(workers) < 2:
+        return None
+    return workers, tf_config.get("task", {}).get("index", 0)
+
+# (number of shards, index of this worker's shard) of the task dataframes
+def get_worker_shard():
+    cluster = get_cluster()
+    if cluster is None:
+        return 1, 0
+    workers, index = cluster
+    return len(workers), index
+
+def is_chief():
+    return get_worker_shard()[1] == 0
+
+def set_cluster(worker_hosts, task_index):
+    os.environ["TF_CONFIG"] = json.dumps({
+        "cluster": {"worker": worker_hosts},
+        "task": {"type": "worker", "index": task_index}})
+
+# Must be called before any other TensorFlow op is created in the process
+def create_strategy():
+    import tensorflow as tf
+
+    num_workers, index = get_worker_shard()
+    if num_workers < 2:
+        raise ValueError("Data-parallel training needs a TF_CONFIG cluster of at least 2 workers, "
+                         "start the workers with python -m pipeline.distributed")
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    print("[INFO] Worker {} of {}, {} replicas in sync".format(
+        index, num_workers, strategy.num_replicas_in_sync))
+    return strategy
+
+# Models and optimizers of a data-parallel run must be created and compiled in
+# the strategy's scope, other runs use the default strategy
+@contextmanager
+def strategy_scope(strategy):
+    if strategy is None:
+        yield
+    else:
+        with strategy.scope():
+            yield
+
+def find_free_ports(num_ports):
+    sockets = []
+    for _ in range(num_ports):
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+# Start num_workers workers on this machine, with the arguments of this
+# process, and wait for all of them. Each worker gets an equal share of the
+# cores unless intra_op_threads is given.
+def launch_local_workers(num_workers, worker_args, intra_op_threads=None):
+    worker_hosts = ["localhost:{}".format(port) for port in find_free_ports(num_workers)]
+    if intra_op_threads is None:
+        intra_op_threads = max(mp.cpu_count() // num_workers, 1)
+
+    print("[INFO] Starting {} local workers on {}...".format(num_workers, ",".join(worker_hosts)))
+    processes = []
+    for index in range(num_workers):
+        cmd = [sys.executable, "-m", "pipeline.distributed",
+               "--worker_hosts", ",".join(worker_hosts),
+               "--task_index", str(index),
+               "--intra_op_threads", str(intra_op_threads)] + worker_args
+        env = dict(os.environ, OMP_NUM_THREADS=str(intra_op_threads))
+        processes.append(subprocess.Popen(cmd, env=env))
+
+    # A worker which fails leaves the others waiting on the all-reduce
+    return_codes = [p.wait() for p in processes]
+    failed = [index for index, code in enumerate(return_codes) if code != 0]
+    if failed:
+        raise RuntimeError("Workers {} failed".format(failed))
+
+def run_worker(args):
+    import tensorflow as tf
+    from pipeline.task_registry import run_task
+
+    set_cluster(args["worker_hosts"].split(","), args["task_index"])
+    if args["intra_op_threads"] is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args["intra_op_threads"])
+
+    acc_train, acc_test = run_task(
+        args["task"],
+        args["model_type"],
+        args["epochs"],
+        args["learning_rate"],
+        args["schedule_type"],
+        False,
+        args["random_state"],
+        input_backend="tf_data",
+        data_parallel=True)
+    if is_chief():
+        print("{}: Validation accuracy: {}, Test accuracy: {}".format(args["task"], acc_train, acc_test))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-w", "--num_workers", type=int, default=2,
+        help="number of workers to start on this machine")
+    ap.add_argument("--worker_hosts", type=str, default=None,
+        help="comma separated host:port of every worker, to start a single worker of a multi-host cluster")
+    ap.add_argument("--task_index", type=int, default=0,
+        help="index of this worker in --worker_hosts, 0 for the chief")
+    ap.add_argument("-k", "--task", type=str, default='A1',
+        help="choose which of the tasks ('A1', 'A2', 'B1', 'B2') to train")
+    ap.add_argument("-t", "--model_type", type=str, default='xception',
+        help="model type ('mlp', 'cnn', 'xception') to train")
+    ap.add_argument("-e", "--epochs", type=int, default=10,
+        help="number of epochs")
+    ap.add_argument("-l", "--learning_rate", type=float, default=0.003,
+        help="learning rate, not scaled with the number of workers")
+    ap.add_argument("-s", "--schedule_type", type=str, default='one_cycle',
+        help="learning rate schedule type")
+    ap.add_argument("-r", "--random_state", type=int, default=None,
+        help="random state of the task")
+    ap.add_argument("--intra_op_threads", type=int, default=None,
+        help="threads of each worker, local workers share the cores equally by default")
+    args = vars(ap.parse_args())
+
+    if args["worker_hosts"] is not None:
+        run_worker(args)
+    else:
+        # Pass the task settings on to the workers
+        worker_args = sys.argv[1:]
+        for flag in ["-w", "--num_workers", "--intra_op_threads"]:
+            if flag in worker_args:
+                i = worker_args.index(flag)
+                del worker_args[i:i + 2]
+        launch_local_workers(args["num_workers"], worker_args, args["intra_op_threads"])
@@ -0,0 +1,164 @@
+# Streaming evaluation of a model on a test generator.
+# The test set is iterated in bounded batches, and accuracy, loss and the
+# confusion matrix are accumulated batch by batch. Only the images needed for
+# the top losses and Grad-CAM plots are kept, so peak memory does not grow with
+# the size of the test set.
+
+import heapq
+import queue
+import threading
+from contextlib import closing
+import numpy as np
+
+class StreamingEvaluation:
+    def __init__(self, num_classes, top_k=9, top_n=3, epsilon=1e-7):
+        self.num_classes = num_classes
+        self.top_k = top_k
+        self.top_n = top_n
+        self.epsilon = epsilon
+        self.num_samples = 0
+        self.num_correct = 0
+        self.loss_sum = 0.
+        self.confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        # Min-heaps holding the misclassified images with the highest losses and
+        # the correctly classified images with the highest confidence
+        self.worst = []
+        self.best = []
+
+    # Push candidates onto a bounded min-heap, keyed by score
+    @staticmethod
+    def push_top(heap, size, score, index, payload):
+        if len(heap) < size:
+            heapq.heappush(heap, (score, index, payload))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, index, payload))
+
+    # Only the k best candidates of a batch can enter a heap of size k, so they
+    # are selected with argpartition before touching the heap
+    @staticmethod
+    def select_top(scores, k):
+        if len(scores) > k:
+            return np.argpartition(scores, -k)[-k:]
+        return np.arange(len(scores))
+
+    def update(self, X, y, probs):
+        y = np.asarray(y).astype(int)
+        preds = probs.argmax(axis=-1)
+        probs_correct_label = probs[np.arange(len(y)), y]
+        losses = -np.log(np.clip(probs_correct_label, self.epsilon, 1. - self.epsilon))
+        indices = self.num_samples + np.arange(len(y))
+
+        self.num_samples += len(y)
+        self.num_correct += int(np.sum(preds == y))
+        self.loss_sum += float(np.sum(losses))
+        np.add.at(self.confusion_matrix, (y, preds), 1)
+
+        incorrects = np.nonzero(preds != y)[0]
+        for i in incorrects[self.select_top(losses[incorrects], self.top_k)]:
+            self.push_top(self.worst, self.top_k, losses[i], indices[i],
+                (np.array(X[i]), preds[i], y[i], probs_correct_label[i]))
+
+        corrects = np.nonzero(preds == y)[0]
+        for i in corrects[self.select_top(probs_correct_label[corrects], self.top_n)]:
+            self.push_top(self.best, self.top_n, probs_correct_label[i], indices[i],
+                (np.array(X[i]), preds[i]))
+
+    @property
+    def accuracy(self):
+        return self.num_correct / float(max(self.num_samples, 1))
+
+    @property
+    def loss(self):
+        return self.loss_sum / max(self.num_samples, 1)
+
+    # Returns (loss_pred_data, images) in the format used by plot_top_losses_data,
+    # with the first column indexing into images
+    def get_loss_pred_data(self):
+        worst = sorted(self.worst, reverse=True)
+        images = np.array([payload[0] for _, _, payload in worst])
+        loss_pred_data = np.array([[i, payload[1], payload[2], loss, payload[3]]
+                                   for i, (loss, _, payload) in enumerate(worst)], dtype=float).reshape((-1, 5))
+        return loss_pred_data, images
+
+    # Returns (top_n_data, images) in the format used by plot_grad_cam_data,
+    # with the first column indexing into images
+    def get_top_n_data(self):
+        best = sorted(self.best, reverse=True)
+        images = np.array([payload[0] for _, _, payload in best])
+        top_n_data = np.array([[i, payload[1], prob]
+                               for i, (prob, _, payload) in enumerate(best)], dtype=float).reshape((-1, 3))
+        return top_n_data, images
+
+# Yield the batches of a generator in order, loading up to max_queue_size
+# batches ahead on a background thread while the model runs. When the consumer
+# stops early (e.g. on an error) and the generator is closed, the thread is
+# stopped and the batches it loaded are dropped.
+def prefetch_batches(gen, max_queue_size=2):
+    batches = queue.Queue(max_queue_size)
+    stop = threading.Event()
+
+    # Wait for room in the queue, giving up once the consumer has stopped
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load_batches():
+        try:
+            for batch in range(len(gen)):
+                if not put(gen[batch]):
+                    return
+        except Exception as e:
+            put(e)
+        put(None)
+
+    thread = threading.Thread(target=load_batches, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        while not batches.empty():
+            batches.get_nowait()
+        thread.join()
+
+# Evaluate a model over every batch of a generator
+def evaluate_streaming(model, test_gen, num_classes, top_k=9, top_n=3, max_queue_size=2):
+    print("[INFO] Evaluating test set in {} batches...".format(len(test_gen)))
+
+    evaluation = StreamingEvaluation(num_classes, top_k, top_n)
+    with closing(prefetch_batches(test_gen, max_queue_size)) as batches:
+        for X, y in batches:
+            evaluation.update(X, y, model.predict_on_batch(X))
+
+    print("[INFO] Test loss: {:0.4f}, test accuracy: {:0.4f}".format(evaluation.loss, evaluation.accuracy))
+    print("[INFO] Confusion matrix (rows: actual, columns: predicted):")
+    print(evaluation.confusion_matrix)
+    return evaluation
+
+# Evaluate a model with one output per task over every batch of a generator
+# yielding a dictionary of labels. num_classes maps each task (the name of its
+# output layer) to its number of classes. Returns an evaluation per task.
+def evaluate_streaming_multi_head(model, test_gen, num_classes, top_k=9, top_n=3, max_queue_size=2):
+    print("[INFO] Evaluating test set in {} batches...".format(len(test_gen)))
+
+    evaluations = {task: StreamingEvaluation(n, top_k, top_n) for task, n in num_classes.items()}
+    with closing(prefetch_batches(test_gen, max_queue_size)) as batches:
+        for X, y in batches:
+            probs = model.predict_on_batch(X)
+            for task, task_probs in zip(model.output_names, probs):
+                evaluations[task].update(X, y[task], task_probs)
+
+    for task, evaluation in evaluations.items():
+        print("[INFO] {} test loss: {:0.4f}, test accuracy: {:0.4f}".format(task, evaluation.loss, evaluation.accuracy))
+    return evaluations
@@ -0,0 +1,107 @@
+# Store of trained weights and learning rate finder curves, keyed by the
+# configuration which produced them.
+# The key is a hash of the task, model type, hyperparameters and a fingerprint
+# of the dataset (the hash of labels.csv), so an artifact is only reused by a
+# run with the same configuration, and a changed configuration trains again.
+# Only weights are saved, together with the training history. Every file is written to a temporary
+# path and renamed, and a manifest written last marks a complete artifact.
+
+import hashlib
+import json
+import os
+from pipeline.datasets.dataset_root import project_dir
+from pipeline.datasets.image_cache import hash_labels_file
+
+artifacts_dir = os.path.join(project_dir, "artifacts")
+
+def get_config_key(config):
+    data = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.sha1(data).hexdigest()[:16]
+
+# History-like object for training runs loaded from the store, with the same
+# history attribute as the History returned by model.fit, and the epoch whose
+# weights were restored by an adaptive budget
+class StoredHistory:
+    def __init__(self, history, restored_epoch=None):
+        self.history = history
+        self.restored_epoch = restored_epoch
+
+def write_json_atomic(path, obj):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+class Artifact:
+    def __init__(self, name, config, base_name=None):
+        self.name = name
+        # Name shared by the stages of a run, without the "_lr_finder" suffix
+        self.base_name = base_name or name
+        self.config = config
+        self.key = get_config_key(config)
+        self.path = os.path.join(artifacts_dir, "{}_{}".format(name, self.key))
+        self.manifest_path = os.path.join(self.path, "manifest.json")
+        self.weights_path = os.path.join(self.path, "weights.h5")
+        self.history_path = os.path.join(self.path, "history.json")
+
+    # Artifact of a stage of the same run, e.g. the frozen Xception stage. The
+    # stage is shared by learning rate finder and training runs.
+    def child(self, stage):
+        config = dict(self.config, stage=stage)
+        config.pop("find_lr", None)
+        return Artifact("{}_{}".format(self.base_name, stage), config)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def write_manifest(self):
+        write_json_atomic(self.manifest_path, {"name": self.name, "key": self.key, "config": self.config})
+
+    # Save the weights of a trained model and its history
+    def save_training(self, model, history):
+        print("[INFO] Saving {} weights to {}...".format(self.name, self.path))
+        os.makedirs(self.path, exist_ok=True)
+        # Keras picks the weights format from the extension, so it is kept last
+        tmp_weights_path = "{}.{}.tmp.h5".format(self.weights_path[:-3], os.getpid())
+        model.save_weights(tmp_weights_path)
+        os.replace(tmp_weights_path, self.weights_path)
+        write_json_atomic(self.history_path, {
+            "history": {k: [float(v) for v in values] for k, values in history.history.items()},
+            "restored_epoch": getattr(history, "restored_epoch", None)})
+        self.write_manifest()
+
+    # Load the weights into a model built with the same architecture, and
+    # return the stored history
+    def load_training(self, model):
+        print("[INFO] Reusing {} weights from {}...".format(self.name, self.path))
+        model.load_weights(self.weights_path)
+        with open(self.history_path) as f:
+            stored = json.load(f)
+        return StoredHistory(stored["history"], stored.get("restored_epoch"))
+
+    def save_lr_finder(self, lr_finder):
+        os.makedirs(self.path, exist_ok=True)
+        write_json_atomic(self.history_path, {
+            "lrs": [float(lr) for lr in lr_finder.lrs],
+            "losses": [float(loss) for loss in lr_finder.losses],
+            "lr_multiplier": lr_finder.lr_multiplier})
+        self.write_manifest()
+
+    def load_lr_finder(self, lr_finder):
+        print("[INFO] Reusing {} learning rate finder curve from {}...".format(self.name, self.path))
+        with open(self.history_path) as f:
+            stored = json.load(f)
+        lr_finder.lrs, lr_finder.losses = stored["lrs"], stored["losses"]
+        lr_finder.lr_multiplier = stored["lr_multiplier"]
+
+# Artifact of a task's model. The config holds the hyperparameters of the run,
+# the dataset fingerprint is added from dataset_root.
+def get_task_artifact(task, model_type, dataset_root, find_lr=False, **config):
+    config = dict(
+        config,
+        task=task,
+        model_type=model_type,
+        find_lr=bool(find_lr),
+        dataset=hash_labels_file(dataset_root.labels_path))
+    base_name = "{}_{}".format(task, model_type)
+    return Artifact(base_name + ("_lr_finder" if find_lr else ""), config, base_name)
@@ -4,74 +4,19 @@
 
 from tensorflow.keras import Sequential
 from tensorflow.keras.layers import Dense, Conv2D, Flatten, MaxPooling2D
-from tensorflow.keras.callbacks import LearningRateScheduler
-from tensorflow.keras.optimizers import SGD
-from pipeline.optimisation.learning_rate_schedulers import StepDecay, PolynomialDecay
+from pipeline.optimisation.schedules import create_schedule, create_optimizer
 from pipeline.optimisation.one_cycle_lr.lr_finder import LRFinder
-from pipeline.optimisation.one_cycle_lr.one_cycle_scheduler import OneCycleScheduler
+from pipeline.optimisation.step_timing import StepTimingCallback
+from pipeline.distributed import strategy_scope
 
-def train_cnn(
+# Build the (uncompiled) CNN
+def build_cnn(
         height,
         width,
         num_classes,
-        batch_size,
-        epochs,
-        learning_rate,
-        schedule_type,
-        find_lr,
-        train_gen,
-        val_gen,
-        num_start_filters,
-        kernel_size,
-        fcl_size):
-
-    # Store the number of epochs to train for in a convenience variable,
-    # then initialize the list of callbacks and learning rate scheduler
-    # to be used
-    callbacks = []
-    schedule = None
-    
-    if find_lr != True:
-        # check to see if step-based learning rate decay should be used
-        if schedule_type == "step":
-    	    print("[INFO] using 'step-based' learning rate decay...")
-    	    schedule = StepDecay(initAlpha=1e-1, factor=0.25, dropEvery=int(epochs/5))
- 
-        # check to see if linear learning rate decay should should be used
-        elif schedule_type == "linear":
-            print("[INFO] using 'linear' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=1)
-    
-        # check to see if a polynomial learning rate decay should be used
-        elif schedule_type == "poly":
-            print("[INFO] using 'polynomial' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=5)
-
-        elif schedule_type == "one_cycle":
-            print("[INFO] using 'one cycle' learning...")
-            schedule = OneCycleScheduler(learning_rate)
-            callbacks = [schedule]
-
-        # if the learning rate schedule is not empty, add it to the list of
-        # callbacks
-        if schedule_type != "none" and schedule_type != "one_cycle":
-	        callbacks = [LearningRateScheduler(schedule)]
-
-        # initialize the decay for the optimizer
-        decay = 0.0
- 
-        # if we are using Keras' "standard" decay, then we need to set the
-        # decay parameter
-        if schedule_type == "standard":
-        	print("[INFO] using 'keras standard' learning rate decay...")
-        	decay = 1e-1 / epochs
- 
-        # otherwise, no learning rate schedule is being used
-        elif schedule_type == "none":
-        	print("[INFO] no learning rate schedule being used")
-    else:
-        print("[INFO] Finding learning rate...")
-
+        num_start_filters=16,
+        kernel_size=3,
+        fcl_size=512):
     # Instantiate Sequential API
     model = Sequential([
         # Use 16 3x3 kernels with ReLU after.
@@ -93,24 +38,75 @@ def train_cnn(
         # Output layer
         Dense(num_classes, activation='softmax')
     ])
+    return model
 
-    if schedule_type != "one_cycle" and find_lr != True:
-        # initialize optimizer and model, then compile it
-        opt = SGD(lr=learning_rate, momentum=0.9, decay=decay)
-    else:
-        opt = SGD()
+def train_cnn(
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        find_lr,
+        train_gen,
+        val_gen,
+        num_start_filters,
+        kernel_size,
+        fcl_size,
+        step_timing_path=None,
+        artifact=None,
+        budget=None,
+        strategy=None):
+
+    # The learning rate (and, for one cycle, momentum) of every step is
+    # precomputed and evaluated by the optimizer, so no schedule callbacks are
+    # needed
+    callbacks = []
+    schedule = None
     
-    # We now compile the MLP model to specify the loss function
-    model.compile(
-        loss="sparse_categorical_crossentropy",
-        optimizer=opt,
-	    metrics=["accuracy"])
+    if find_lr != True:
+        schedule = create_schedule(schedule_type, learning_rate, epochs, train_gen.samples // batch_size)
+    else:
+        print("[INFO] Finding learning rate...")
+
+    # Data-parallel runs create the model in the strategy's scope
+    with strategy_scope(strategy):
+        model = build_cnn(height, width, num_classes, num_start_filters, kernel_size, fcl_size)
+
+        # initialize optimizer and model, then compile it
+        opt = create_optimizer(schedule_type, learning_rate, epochs, schedule, find_lr)
+
+        # We now compile the MLP model to specify the loss function
+        model.compile(
+            loss="sparse_categorical_crossentropy",
+            optimizer=opt,
+            metrics=["accuracy"])
 
     if find_lr == True:
         lr_finder = LRFinder(model)
-        lr_finder.find(train_gen)
+        # Reuse the curve of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            artifact.load_lr_finder(lr_finder)
+        else:
+            lr_finder.find(train_gen)
+            if artifact is not None:
+                artifact.save_lr_finder(lr_finder)
         return lr_finder
     else:
+        # Reuse the weights of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            history = artifact.load_training(model)
+            return model, history, schedule
+
+        # Record per-step input wait and compute time
+        if step_timing_path is not None:
+            callbacks = callbacks + [StepTimingCallback(step_timing_path, "cnn")]
+
+        # Stop early, within the time budget, and restore the best weights
+        if budget is not None:
+            callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size)]
+
         # Training and evaluating the CNN model
         history = model.fit(
             train_gen,
@@ -119,4 +115,6 @@ def train_cnn(
             validation_steps=val_gen.samples // batch_size,
             callbacks=callbacks,
             epochs=epochs)
+        if artifact is not None:
+            artifact.save_training(model, history)
         return model, history, schedule
\ No newline at end of file
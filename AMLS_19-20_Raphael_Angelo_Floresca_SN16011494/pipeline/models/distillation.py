@@ -0,0 +1,180 @@
+# Knowledge distillation from a task's trained Xception model into the CNN or MLP.
+# The teacher's class probabilities over every training image are computed once
+# and cached next to the decoded images. The student is then trained on the
+# cached images against both the true labels and the teacher's probabilities,
+# softened by a temperature (Hinton et al., 2015):
+#   loss = alpha * CE(label, student) + (1 - alpha) * T^2 * KL(teacher_T || student_T)
+# Both label kinds are packed into a single label array per image, the true
+# class index first, followed by the teacher's probabilities.
+
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from pipeline.datasets.image_cache import build_image_cache, split_indices, CachedImageSequence, hash_labels_file
+from pipeline.datasets.utilities import create_augmenting_datagen, create_eval_datagen
+from pipeline.models.mlp import build_mlp
+from pipeline.models.cnn import build_cnn
+from pipeline.optimisation.schedules import create_schedule, create_optimizer
+from pipeline.optimisation.one_cycle_lr.lr_finder import LRFinder
+from pipeline.optimisation.step_timing import StepTimingCallback
+from pipeline.serving.saved_models import get_saved_model_file, preprocess_images
+
+# Identifies a saved teacher model by its size and modification time, so soft
+# targets are computed again whenever the teacher is retrained
+def get_teacher_key(teacher_path):
+    stat = os.stat(teacher_path)
+    return "{}_{}".format(int(stat.st_mtime), stat.st_size)
+
+# Run the teacher once over every cached image, with the Xception
+# preprocessing it was trained on, and store its probabilities in a .npy file
+def compute_soft_targets(teacher_path, images, soft_targets_path, batch_size):
+    from tensorflow.keras.models import load_model
+
+    if os.path.exists(soft_targets_path):
+        print("[INFO] Loading cached soft targets from {}...".format(soft_targets_path))
+        return np.load(soft_targets_path)
+
+    print("[INFO] Computing soft targets of {} into {}...".format(teacher_path, soft_targets_path))
+    teacher = load_model(teacher_path, compile=False)
+    soft_targets = np.empty((len(images), teacher.output_shape[-1]), dtype=np.float32)
+    for i in range(0, len(images), batch_size):
+        batch = preprocess_images(images[i:i + batch_size].astype(np.float32), "xception")
+        soft_targets[i:i + len(batch)] = teacher.predict_on_batch(batch)
+
+    tmp_path = "{}.{}.tmp.npy".format(soft_targets_path[:-4], os.getpid())
+    np.save(tmp_path, soft_targets)
+    os.replace(tmp_path, soft_targets_path)
+
+    # Free the teacher before the student is built
+    K.clear_session()
+    return soft_targets
+
+# Create the training and validation sequences of a task for distillation,
+# split as for the task's other models. Returns them with the teacher key.
+def create_distillation_inputs(
+        task,
+        height,
+        width,
+        train_labels,
+        img_dir,
+        batch_size,
+        random_state,
+        dataset_root,
+        validation_split=0.25):
+    teacher_path = get_saved_model_file(task, "xception")
+    if not os.path.exists(teacher_path):
+        raise FileNotFoundError("No trained {} Xception teacher at {}, train it first with "
+                                "main.py --model_type xception".format(task, teacher_path))
+    teacher_key = get_teacher_key(teacher_path)
+
+    images, labels, _ = build_image_cache(train_labels, img_dir, height, width, dataset_root)
+    soft_targets_path = os.path.join(dataset_root.cache_dir, "soft_targets_{}_{}x{}_{}_{}.npy".format(
+        task, height, width, hash_labels_file(dataset_root.labels_path), teacher_key))
+    soft_targets = compute_soft_targets(teacher_path, images, soft_targets_path, batch_size)
+    packed_labels = np.concatenate([labels[:, None].astype(np.float32), soft_targets], axis=1)
+
+    train_indices, val_indices = split_indices(len(images), validation_split)
+    train_gen = CachedImageSequence(images, packed_labels, train_indices, batch_size,
+        create_augmenting_datagen(validation_split), seed=random_state)
+    val_gen = CachedImageSequence(images, packed_labels, val_indices, batch_size,
+        create_eval_datagen(validation_split), shuffle=False, seed=random_state)
+    return train_gen, val_gen, teacher_key
+
+# Soften probabilities with a temperature. Dividing the log probabilities is the
+# same as dividing the logits, as they only differ by a constant.
+def soften(probs, temperature):
+    return K.softmax(K.log(K.clip(probs, K.epsilon(), 1.)) / temperature)
+
+def create_distillation_loss(temperature, alpha):
+    def distillation_loss(y_true, y_pred):
+        labels, teacher_probs = y_true[:, 0], y_true[:, 1:]
+        hard_loss = K.sparse_categorical_crossentropy(labels, y_pred)
+        # The T^2 factor keeps the gradients of the soft loss on the same scale
+        # as those of the hard loss
+        soft_loss = tf.keras.losses.kullback_leibler_divergence(
+            soften(teacher_probs, temperature), soften(y_pred, temperature)) * temperature ** 2
+        return alpha * hard_loss + (1. - alpha) * soft_loss
+    return distillation_loss
+
+# Accuracy on the true labels. Named acc, so the history has the same keys as
+# for the other models.
+def acc(y_true, y_pred):
+    return K.cast(K.equal(K.cast(y_true[:, 0], "int64"), K.argmax(y_pred, axis=-1)), K.floatx())
+
+def train_distilled(
+        student_type,
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        find_lr,
+        train_gen,
+        val_gen,
+        temperature=4.,
+        alpha=0.1,
+        step_timing_path=None,
+        artifact=None,
+        budget=None):
+
+    # The learning rate (and, for one cycle, momentum) of every step is
+    # precomputed and evaluated by the optimizer
+    callbacks = []
+    schedule = None
+
+    if find_lr != True:
+        schedule = create_schedule(schedule_type, learning_rate, epochs, train_gen.samples // batch_size)
+    else:
+        print("[INFO] Finding learning rate...")
+
+    # The student uses the default architecture of the task's MLP or CNN
+    if student_type == "mlp":
+        model = build_mlp(height, width, num_classes)
+    else:
+        model = build_cnn(height, width, num_classes)
+
+    # initialize optimizer and model, then compile it
+    opt = create_optimizer(schedule_type, learning_rate, epochs, schedule, find_lr)
+    model.compile(
+        loss=create_distillation_loss(temperature, alpha),
+        optimizer=opt,
+        metrics=[acc])
+
+    if find_lr == True:
+        lr_finder = LRFinder(model)
+        # Reuse the curve of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            artifact.load_lr_finder(lr_finder)
+        else:
+            lr_finder.find(train_gen)
+            if artifact is not None:
+                artifact.save_lr_finder(lr_finder)
+        return lr_finder
+    else:
+        # Reuse the weights of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            history = artifact.load_training(model)
+            return model, history, schedule
+
+        # Record per-step input wait and compute time
+        if step_timing_path is not None:
+            callbacks = callbacks + [StepTimingCallback(step_timing_path, student_type + "_distilled")]
+
+        # Stop early, within the time budget, and restore the best weights
+        if budget is not None:
+            callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size)]
+
+        # Training the student against the true labels and soft targets
+        history = model.fit(
+            train_gen,
+            steps_per_epoch=train_gen.samples // batch_size,
+            validation_data=val_gen,
+            validation_steps=val_gen.samples // batch_size,
+            callbacks=callbacks,
+            epochs=epochs)
+        if artifact is not None:
+            artifact.save_training(model, history)
+        return model, history, schedule
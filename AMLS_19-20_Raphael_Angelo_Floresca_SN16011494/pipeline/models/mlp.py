@@ -4,11 +4,32 @@
 
 from tensorflow.keras import Sequential
 from tensorflow.keras.layers import Dense, Flatten
-from tensorflow.keras.callbacks import LearningRateScheduler
-from tensorflow.keras.optimizers import SGD
-from pipeline.optimisation.learning_rate_schedulers import StepDecay, PolynomialDecay
+from pipeline.optimisation.schedules import create_schedule, create_optimizer
 from pipeline.optimisation.one_cycle_lr.lr_finder import LRFinder
-from pipeline.optimisation.one_cycle_lr.one_cycle_scheduler import OneCycleScheduler
+from pipeline.optimisation.step_timing import StepTimingCallback
+from pipeline.distributed import strategy_scope
+
+# Build the (uncompiled) MLP
+def build_mlp(
+        height,
+        width,
+        num_classes,
+        first_af="relu",
+        second_af="relu",
+        layer1_hn=300,
+        layer2_hn=100):
+    # Instantiate Sequential API
+    model = Sequential([
+        # This flattens the input into a 1D tensor
+        Flatten(input_shape=(height,width,3)),
+        # Fully connected layer with 300 neurons, using ReLU by default.
+        Dense(layer1_hn, activation=first_af),
+        # Fully connected layer with 100 neurons, using ReLU by default.
+        Dense(layer2_hn, activation=second_af),
+        # Output layer
+        Dense(num_classes, activation="softmax") 
+    ])
+    return model
 
 def train_mlp(
         height, 
@@ -24,84 +45,60 @@ def train_mlp(
         first_af, 
         second_af, 
         layer1_hn, 
-        layer2_hn):
+        layer2_hn,
+        step_timing_path=None,
+        artifact=None,
+        budget=None,
+        strategy=None):
 
-    # Store the number of epochs to train for in a convenience variable,
-    # then initialize the list of callbacks and learning rate scheduler
-    # to be used
+    # The learning rate (and, for one cycle, momentum) of every step is
+    # precomputed and evaluated by the optimizer, so no schedule callbacks are
+    # needed
     callbacks = []
     schedule = None
     
     if find_lr != True:
-        # check to see if step-based learning rate decay should be used
-        if schedule_type == "step":
-    	    print("[INFO] using 'step-based' learning rate decay...")
-    	    schedule = StepDecay(initAlpha=1e-1, factor=0.25, dropEvery=int(epochs/5))
- 
-        # check to see if linear learning rate decay should should be used
-        elif schedule_type == "linear":
-            print("[INFO] using 'linear' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=1)
-    
-        # check to see if a polynomial learning rate decay should be used
-        elif schedule_type == "poly":
-            print("[INFO] using 'polynomial' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=5)
-
-        elif schedule_type == "one_cycle":
-            print("[INFO] using 'one cycle' learning...")
-            schedule = OneCycleScheduler(learning_rate)
-            callbacks = [schedule]
-
-        # if the learning rate schedule is not empty, add it to the list of
-        # callbacks
-        if schedule != "none" and schedule_type != "one_cycle":
-	        callbacks = [LearningRateScheduler(schedule)]
-
-        # initialize the decay for the optimizer
-        decay = 0.0
- 
-        # if we are using Keras' "standard" decay, then we need to set the
-        # decay parameter
-        if schedule_type == "standard":
-        	print("[INFO] using 'keras standard' learning rate decay...")
-        	decay = 1e-1 / epochs
- 
-        # otherwise, no learning rate schedule is being used
-        elif schedule_type == "none":
-        	print("[INFO] no learning rate schedule being used")
+        schedule = create_schedule(schedule_type, learning_rate, epochs, train_gen.samples // batch_size)
     else:
-        print("[INFO] Finding learning rate...") 
-    
-    # Instantiate Sequential API
-    model = Sequential([
-        # This flattens the input into a 1D tensor
-        Flatten(input_shape=(height,width,3)),
-        # Fully connected layer with 300 neurons, using ReLU by default.
-        Dense(layer1_hn, activation=first_af),
-        # Fully connected layer with 100 neurons, using ReLU by default.
-        Dense(layer2_hn, activation=second_af),
-        # Output layer
-        Dense(num_classes, activation="softmax") 
-    ])
+        print("[INFO] Finding learning rate...")
+
+    # Data-parallel runs create the model in the strategy's scope
+    with strategy_scope(strategy):
+        model = build_mlp(height, width, num_classes, first_af, second_af, layer1_hn, layer2_hn)
 
-    if schedule_type != "one_cycle":
         # initialize optimizer and model, then compile it
-        opt = SGD(lr=learning_rate, momentum=0.9, decay=decay)
-    else:
-        opt = SGD()
-    
-    # We now compile the MLP model to specify the loss function
-    model.compile(
-        loss="sparse_categorical_crossentropy",
-        optimizer=opt,
-	    metrics=["accuracy"])
+        opt = create_optimizer(schedule_type, learning_rate, epochs, schedule, find_lr)
+
+        # We now compile the MLP model to specify the loss function
+        model.compile(
+            loss="sparse_categorical_crossentropy",
+            optimizer=opt,
+            metrics=["accuracy"])
 
     if find_lr == True:
         lr_finder = LRFinder(model)
-        lr_finder.find(train_gen)
+        # Reuse the curve of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            artifact.load_lr_finder(lr_finder)
+        else:
+            lr_finder.find(train_gen)
+            if artifact is not None:
+                artifact.save_lr_finder(lr_finder)
         return lr_finder
     else:
+        # Reuse the weights of a run with the same configuration
+        if artifact is not None and artifact.exists():
+            history = artifact.load_training(model)
+            return model, history, schedule
+
+        # Record per-step input wait and compute time
+        if step_timing_path is not None:
+            callbacks = callbacks + [StepTimingCallback(step_timing_path, "mlp")]
+
+        # Stop early, within the time budget, and restore the best weights
+        if budget is not None:
+            callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size)]
+
         # Training and evaluating the CNN model
         history = model.fit(
             train_gen,
@@ -110,4 +107,6 @@ def train_mlp(
             validation_steps=val_gen.samples // batch_size,
             callbacks=callbacks,
             epochs=epochs)
+        if artifact is not None:
+            artifact.save_training(model, history)
         return model, history, schedule
\ No newline at end of file
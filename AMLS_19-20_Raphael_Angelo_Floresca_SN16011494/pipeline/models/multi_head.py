@@ -0,0 +1,114 @@
+# Multi-head models for the tasks sharing an image set.
+# One backbone (the MLP, CNN or Xception without its output layer) is shared by
+# every task, with one softmax head per task named after it. The model is trained
+# on batches labelled for all the tasks at once, so each image is decoded and
+# run through the backbone once rather than once per task.
+
+from tensorflow.keras.applications.xception import Xception
+from tensorflow.keras.layers import GlobalAveragePooling2D, Dense
+from tensorflow.keras import Model
+from pipeline.models.mlp import build_mlp
+from pipeline.models.cnn import build_cnn
+from pipeline.optimisation.schedules import create_schedule, create_optimizer
+from pipeline.optimisation.step_timing import StepTimingCallback
+from pipeline.shared_backbone import multi_head_model_types
+
+# Build the (uncompiled) multi-head model, where num_classes maps each task to
+# its number of classes. For Xception the base model is returned as well, and is
+# frozen for the first stage of training.
+def build_multi_head(model_type, height, width, num_classes, weights="imagenet"):
+    if model_type not in multi_head_model_types:
+        raise ValueError("Multi-head models support the {} model types, not {}".format(
+            ", ".join(multi_head_model_types), model_type))
+    base_model = None
+    if model_type == "xception":
+        base_model = Xception(weights=weights,
+                              include_top=False,
+                              input_shape=(height,width,3))
+        inputs = base_model.input
+        features = GlobalAveragePooling2D()(base_model.output)
+        for layer in base_model.layers:
+            layer.trainable = False
+    else:
+        # The MLP or CNN up to the layer before its output layer
+        if model_type == "mlp":
+            backbone = build_mlp(height, width, 1)
+        else:
+            backbone = build_cnn(height, width, 1)
+        inputs = backbone.input
+        features = backbone.layers[-2].output
+
+    # One output layer per task
+    outputs = [Dense(n, activation="softmax", name=task)(features) for task, n in num_classes.items()]
+    return Model(inputs=inputs, outputs=outputs), base_model
+
+def train_multi_head(
+        model_type,
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        train_gen,
+        val_gen,
+        step_timing_path=None,
+        artifact=None,
+        budget=None):
+
+    # The ImageNet weights are not needed when stored weights are loaded
+    reuse = artifact is not None and artifact.exists()
+    model, base_model = build_multi_head(model_type, height, width, num_classes, None if reuse else "imagenet")
+
+    # As in train_xception, the Xception heads are first trained on the frozen
+    # base for half of the epochs, then the whole model for the other half
+    if base_model is None:
+        stages = [epochs]
+    else:
+        stages = [int(epochs/2), int(epochs/2)]
+    if reuse:
+        stages = stages[-1:]
+
+    callbacks = []
+    # Record per-step input wait and compute time
+    if step_timing_path is not None:
+        callbacks = [StepTimingCallback(step_timing_path, "multi_head")]
+
+    for stage, stage_epochs in enumerate(stages):
+        if stage == len(stages) - 1 and base_model is not None:
+            for layer in base_model.layers:
+                layer.trainable = True
+
+        schedule = create_schedule(schedule_type, learning_rate, stage_epochs, train_gen.samples // batch_size, epochs)
+        opt = create_optimizer(schedule_type, learning_rate, epochs, schedule)
+
+        # The same loss and metric are used for every head, and the losses of
+        # the heads are summed
+        model.compile(loss="sparse_categorical_crossentropy",
+            optimizer=opt,
+            metrics=["accuracy"])
+
+        # Reuse the weights of a run with the same configuration
+        if reuse:
+            history = artifact.load_training(model)
+            return model, history, schedule
+
+        # Stop early, within the time budget, and restore the best weights. The
+        # first of two stages may use half of the time left.
+        stage_callbacks = callbacks
+        if budget is not None:
+            fraction = 1. / (len(stages) - stage)
+            stage_callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size, fraction)]
+
+        history = model.fit(
+            train_gen,
+            steps_per_epoch=train_gen.samples // batch_size,
+            validation_data=val_gen,
+            validation_steps=val_gen.samples // batch_size,
+            callbacks=stage_callbacks,
+            epochs=stage_epochs)
+
+    if artifact is not None:
+        artifact.save_training(model, history)
+    return model, history, schedule
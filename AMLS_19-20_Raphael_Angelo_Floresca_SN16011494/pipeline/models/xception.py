@@ -3,79 +3,93 @@
 
 from tensorflow.keras.applications.xception import Xception
 from tensorflow.keras.layers import GlobalAveragePooling2D, Dense
-from tensorflow.keras import Model
-from tensorflow.keras.models import load_model
-from tensorflow.keras.optimizers import SGD
-from tensorflow.keras.callbacks import LearningRateScheduler
+from tensorflow.keras import Model, Sequential
+from tensorflow.keras.utils import Sequence
 from tensorflow.keras import backend as K
-from pathlib import Path
-from pipeline.optimisation.learning_rate_schedulers import StepDecay, PolynomialDecay
+import numpy as np
+import os
+from pipeline.optimisation.schedules import create_schedule, create_optimizer
 from pipeline.optimisation.one_cycle_lr.lr_finder import LRFinder
-from pipeline.optimisation.one_cycle_lr.one_cycle_scheduler import OneCycleScheduler
+from pipeline.optimisation.step_timing import StepTimingCallback
 from pipeline.plotting.plotting import plot_train_loss_acc_lr
+from pipeline.distributed import strategy_scope, is_chief
+from pipeline.datasets.image_cache import hash_labels_file
 
-def train_frozen_xception(
-        height,
-        width,
-        num_classes,
-        batch_size,
-        epochs,
-        learning_rate,
-        schedule_type,
-        train_gen,
-        val_gen,
-        frozen_model_path,
-        frozen_training_plot_path,
-        frozen_training_plot_name):
+# Bottleneck features are stored in this folder next to the frozen model, keyed
+# by task, input size, augmentation seed and a hash of the labels file
+feature_cache_dir = "features"
 
-    # Store the number of epochs to train for in a convenience variable,
-    # then initialize the list of callbacks and learning rate scheduler
-    # to be used
-    callbacks = []
-    schedule = None
-    
-    # check to see if step-based learning rate decay should be used
-    if schedule_type == "step":
-        print("[INFO] using 'step-based' learning rate decay...")
-        schedule = StepDecay(initAlpha=1e-1, factor=0.25, dropEvery=int(epochs/5))
-
-    # check to see if linear learning rate decay should should be used
-    elif schedule_type == "linear":
-        print("[INFO] using 'linear' learning rate decay...")
-        schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=1)
-    
-    # check to see if a polynomial learning rate decay should be used
-    elif schedule_type == "poly":
-        print("[INFO] using 'polynomial' learning rate decay...")
-        schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=5)
-
-    elif schedule_type == "one_cycle":
-        print("[INFO] using 'one cycle' learning...")
-        schedule = OneCycleScheduler(learning_rate)
-        callbacks = [schedule]
-
-    # if the learning rate schedule is not empty, add it to the list of
-    # callbacks
-    if schedule_type != "none" and schedule_type != "one_cycle":
-        callbacks = [LearningRateScheduler(schedule)]
-
-    # initialize the decay for the optimizer
-    decay = 0.0
- 
-    # if we are using Keras' "standard" decay, then we need to set the
-    # decay parameter
-    if schedule_type == "standard":
-        print("[INFO] using 'keras standard' learning rate decay...")
-        decay = 1e-1 / epochs
- 
-    # otherwise, no learning rate schedule is being used
-    elif schedule_type == "none":
-        print("[INFO] no learning rate schedule being used")
-        
+# Sequence over in-memory (or memory-mapped) feature and label arrays, used to
+# train the classification head on cached bottleneck features
+class FeatureSequence(Sequence):
+    def __init__(self, features, labels, batch_size, shuffle=True):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.samples = len(labels)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.samples / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch_indices = np.sort(self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size])
+        return self.features[batch_indices], self.labels[batch_indices]
+
+    def on_epoch_end(self):
+        self.index_array = np.arange(self.samples)
+        if self.shuffle:
+            np.random.shuffle(self.index_array)
+
+# Run the frozen base model once over a generator and write the pooled outputs
+# to a memory-mapped feature file. The order of the batches and their
+# augmentation are seeded to make the cached features reproducible for a given
+# seed. Sequences over the decoded-image cache are seeded through their own
+# RandomState; flow_from_dataframe iterators draw from np.random, whose global
+# state is restored afterwards.
+def extract_bottleneck_features(feature_model, gen, features_path, seed):
+    labels_path = features_path.replace("_features.npy", "_labels.npy")
+    if os.path.exists(features_path) and os.path.exists(labels_path):
+        print("[INFO] Loading cached bottleneck features from {}...".format(features_path))
+        return np.load(features_path, mmap_mode="r"), np.load(labels_path)
+
+    print("[INFO] Extracting bottleneck features to {}...".format(features_path))
+    global_state = np.random.get_state()
+    if hasattr(gen, "random"):
+        gen.random = np.random.RandomState(seed)
+        gen.on_epoch_end()
+    else:
+        np.random.seed(seed)
+    tmp_path = "{}.{}.tmp".format(features_path, os.getpid())
+    features = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(gen.samples, feature_model.output_shape[-1]))
+    labels = np.empty(gen.samples, dtype=np.float32)
+
+    i = 0
+    for batch in range(len(gen)):
+        X, y = gen[batch]
+        features[i:i + len(X)] = feature_model.predict_on_batch(X)
+        labels[i:i + len(X)] = y
+        i += len(X)
+
+    np.random.set_state(global_state)
+    features.flush()
+    del features
+    np.save(labels_path, labels)
+    os.replace(tmp_path, features_path)
+    return np.load(features_path, mmap_mode="r"), labels
+
+# Build the Xception model with a new classification head, returning it along
+# with the base model. The base model is frozen for the first stage of training.
+def build_xception(height, width, num_classes, weights="imagenet"):
     # Xception is used as the base architecture for the model.
     # The top layers are not included in order to perform transfer learning.
     # Modified to allow for a custom input size
-    base_model = Xception(weights="imagenet",
+    base_model = Xception(weights=weights,
                           include_top=False,
                           input_shape=(height,width,3))
         
@@ -92,37 +106,137 @@ def train_frozen_xception(
     for layer in base_model.layers:
         layer.trainable = False
 
-    if schedule_type != "one_cycle":
+    return frozen_model, base_model
+
+def train_frozen_xception(
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        train_gen,
+        val_gen,
+        frozen_model_path,
+        frozen_training_plot_path,
+        frozen_training_plot_name,
+        cache_features=False,
+        augmentation_seed=0,
+        step_timing_path=None,
+        artifact=None,
+        budget=None,
+        strategy=None,
+        labels_path=None):
+
+    # The learning rate (and, for one cycle, momentum) of every step is
+    # precomputed and evaluated by the optimizer. The decays are defined over
+    # both stages, of which this one trains the first half of the epochs.
+    callbacks = []
+    schedule = create_schedule(schedule_type, learning_rate, int(epochs/2), train_gen.samples // batch_size, epochs)
+        
+    # The ImageNet weights are not needed when stored weights are loaded
+    reuse = artifact is not None and artifact.exists()
+    # Data-parallel runs create the model in the strategy's scope
+    with strategy_scope(strategy):
+        frozen_model, base_model = build_xception(height, width, num_classes, None if reuse else "imagenet")
+
         # initialize optimizer and model, then compile it
-        opt = SGD(lr=learning_rate, momentum=0.9, decay=decay)
+        opt = create_optimizer(schedule_type, learning_rate, epochs, schedule)
+
+    # Reuse the frozen stage of a run with the same configuration
+    if reuse:
+        frozen_model.compile(loss="sparse_categorical_crossentropy", optimizer=opt,
+                             metrics=["accuracy"])
+        artifact.load_training(frozen_model)
+        return frozen_model
+
+    # Record per-step input wait and compute time
+    if step_timing_path is not None:
+        callbacks = callbacks + [StepTimingCallback(step_timing_path, "xception (frozen)")]
+
+    # Stop early, within the time budget, and restore the best weights
+    if budget is not None:
+        callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size, fraction=0.5)]
+
+    if cache_features and not hasattr(train_gen, "__getitem__"):
+        raise ValueError("Caching bottleneck features needs the 'keras' input backend")
+    if cache_features and strategy is not None:
+        raise ValueError("Caching bottleneck features is not supported for data-parallel training")
+
+    if cache_features:
+        # The base model is frozen, so its pooled outputs are computed once and
+        # only the classification head is trained on them
+        # The output of the pooling layer, before the classification head
+        feature_model = Model(inputs=base_model.input, outputs=frozen_model.layers[-2].output)
+        feature_dir = os.path.join(os.path.dirname(os.path.abspath(frozen_model_path)), feature_cache_dir)
+        os.makedirs(feature_dir, exist_ok=True)
+        feature_name = "{}_{}x{}_seed{}".format(
+            os.path.splitext(os.path.basename(frozen_model_path))[0], height, width, augmentation_seed)
+        # Features of an older labels file are not reused
+        if labels_path is not None:
+            feature_name += "_" + hash_labels_file(labels_path)
+        train_features, train_labels = extract_bottleneck_features(
+            feature_model,
+            train_gen,
+            os.path.join(feature_dir, feature_name + "_train_features.npy"),
+            augmentation_seed)
+        val_features, val_labels = extract_bottleneck_features(
+            feature_model,
+            val_gen,
+            os.path.join(feature_dir, feature_name + "_val_features.npy"),
+            augmentation_seed)
+
+        head = Sequential([Dense(num_classes, activation="softmax", input_shape=(train_features.shape[1],))])
+        head.compile(loss="sparse_categorical_crossentropy", optimizer=opt,
+                     metrics=["accuracy"])
+
+        # Training and evaluating the classification head for the first stage
+        train_seq = FeatureSequence(train_features, train_labels, batch_size)
+        val_seq = FeatureSequence(val_features, val_labels, batch_size, shuffle=False)
+        history = head.fit(
+            train_seq,
+            steps_per_epoch=len(train_seq),
+            validation_data=val_seq,
+            validation_steps=len(val_seq),
+            callbacks=callbacks,
+            epochs=int(epochs/2))
+
+        # Copy the trained head into the full frozen model, compiled like the
+        # uncached path
+        frozen_model.layers[-1].set_weights(head.layers[-1].get_weights())
+        frozen_model.compile(loss="sparse_categorical_crossentropy", optimizer=opt,
+                             metrics=["accuracy"])
     else:
-        opt = SGD()
-        
-    # We now compile the Xception model for the first stage
-    frozen_model.compile(loss="sparse_categorical_crossentropy", optimizer=opt,
-                         metrics=["accuracy"])
+        # We now compile the Xception model for the first stage
+        with strategy_scope(strategy):
+            frozen_model.compile(loss="sparse_categorical_crossentropy", optimizer=opt,
+                                 metrics=["accuracy"])
 
-    # Training and evaluating the Xception model for the first stage
-    history = frozen_model.fit(
-        train_gen,
-        steps_per_epoch=train_gen.samples // batch_size,
-        validation_data=val_gen,
-        validation_steps=val_gen.samples // batch_size,
-        callbacks=callbacks,
-        epochs=int(epochs/2))
+        # Training and evaluating the Xception model for the first stage
+        history = frozen_model.fit(
+            train_gen,
+            steps_per_epoch=train_gen.samples // batch_size,
+            validation_data=val_gen,
+            validation_steps=val_gen.samples // batch_size,
+            callbacks=callbacks,
+            epochs=int(epochs/2))
 
-    # Plot training plot for the frozen model
-    plot_train_loss_acc_lr(
-                history,
-                int(epochs/2),
-                schedule,
-                "none",
-                frozen_training_plot_name,
-                frozen_training_plot_path,
-                None)
+    # Plot training plot for the frozen model, once for data-parallel runs
+    if is_chief():
+        plot_train_loss_acc_lr(
+                    history,
+                    int(epochs/2),
+                    schedule,
+                    "none",
+                    frozen_training_plot_name,
+                    frozen_training_plot_path,
+                    None)
 
-    # Save model
-    frozen_model.save(frozen_model_path)
+    # Save the weights for later runs with the same configuration
+    if artifact is not None:
+        artifact.save_training(frozen_model, history)
+    return frozen_model
 
 def train_xception(
         height,
@@ -137,115 +251,98 @@ def train_xception(
         val_gen,
         frozen_model_path,
         frozen_training_plot_path,
-        frozen_training_plot_name):
+        frozen_training_plot_name,
+        cache_features=False,
+        augmentation_seed=0,
+        step_timing_path=None,
+        artifact=None,
+        budget=None,
+        strategy=None,
+        labels_path=None):
+    # The learning rate finder runs straight on the frozen model with its new
+    # head, rather than after the frozen stage has been trained
     if find_lr == True:
         print("[INFO] Finding learning rate...")
-        print("[INFO] Training frozen model...")
-        train_frozen_xception(
-            height,
-            width,
-            num_classes,
-            batch_size,
-            epochs,
-            learning_rate,
-            schedule_type,
-            train_gen,
-            val_gen,
-            frozen_model_path,
-            frozen_training_plot_path,
-            frozen_training_plot_name)
-
-        model = load_model(frozen_model_path)
-
+        reuse = artifact is not None and artifact.exists()
+        with strategy_scope(strategy):
+            model, _ = build_xception(height, width, num_classes, None if reuse else "imagenet")
+            opt = create_optimizer(schedule_type, learning_rate, epochs, None, find_lr)
+            model.compile(loss="sparse_categorical_crossentropy",
+                optimizer=opt,
+                metrics=["accuracy"])
         lr_finder = LRFinder(model)
-        lr_finder.find(train_gen)
+        # Reuse the curve of a run with the same configuration
+        if reuse:
+            artifact.load_lr_finder(lr_finder)
+        else:
+            lr_finder.find(train_gen)
+            if artifact is not None:
+                artifact.save_lr_finder(lr_finder)
         return lr_finder
-    else:
-        frozen_path = Path(frozen_model_path)
-
-        if frozen_path.is_file() != True:
-            "[INFO] Training frozen model..."
-            train_frozen_xception(
-                height,
-                width,
-                num_classes,
-                batch_size,
-                epochs,
-                learning_rate,
-                schedule_type,
-                train_gen,
-                val_gen,
-                frozen_model_path,
-                frozen_training_plot_path,
-                frozen_training_plot_name)
-
-        model = load_model(frozen_model_path)
-
-        for layer in model.layers[:-2]:
-            layer.trainable = True
-
-        # Store the number of epochs to train for in a convenience variable,
-        # then initialize the list of callbacks and learning rate scheduler
-        # to be used
-        callbacks = []
-        schedule = None
-
-        # check to see if step-based learning rate decay should be used
-        if schedule_type == "step":
-            print("[INFO] using 'step-based' learning rate decay...")
-            schedule = StepDecay(initAlpha=1e-1, factor=0.25, dropEvery=int(epochs/5))
-
-        # check to see if linear learning rate decay should should be used
-        elif schedule_type == "linear":
-            print("[INFO] using 'linear' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=1)
-
-        # check to see if a polynomial learning rate decay should be used
-        elif schedule_type == "poly":
-            print("[INFO] using 'polynomial' learning rate decay...")
-            schedule = PolynomialDecay(maxEpochs=epochs, initAlpha=1e-1, power=5)
-
-        elif schedule_type == "one_cycle":
-            print("[INFO] using 'one cycle' learning...")
-            schedule = OneCycleScheduler(learning_rate)
-            callbacks = [schedule]
-
-        # if the learning rate schedule is not empty, add it to the list of
-        # callbacks
-        if schedule_type != "none" and schedule_type != "one_cycle":
-            callbacks = [LearningRateScheduler(schedule)]
-
-        # initialize the decay for the optimizer
-        decay = 0.0
-
-        # if we are using Keras' "standard" decay, then we need to set the
-        # decay parameter
-        if schedule_type == "standard":
-            print("[INFO] using 'keras standard' learning rate decay...")
-            decay = 1e-1 / epochs
-    
-        # otherwise, no learning rate schedule is being used
-        elif schedule_type == "none":
-            print("[INFO] no learning rate schedule being used")
 
-        if schedule_type != "one_cycle":
-            # initialize optimizer and model, then compile it
-            opt = SGD(lr=learning_rate, momentum=0.9, decay=decay)
-        else:
-            opt = SGD()
-    
-        # We now compile the Xception model for the first stage
-        model.compile(loss="sparse_categorical_crossentropy", 
+    frozen_artifact = artifact.child("frozen") if artifact is not None else None
+
+    print("[INFO] Training frozen model...")
+    model = train_frozen_xception(
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        train_gen,
+        val_gen,
+        frozen_model_path,
+        frozen_training_plot_path,
+        frozen_training_plot_name,
+        cache_features,
+        augmentation_seed,
+        step_timing_path,
+        frozen_artifact,
+        budget,
+        strategy,
+        labels_path)
+
+    for layer in model.layers[:-2]:
+        layer.trainable = True
+
+    # The second stage follows the same schedule type over the second
+    # half of the epochs
+    callbacks = []
+    schedule = create_schedule(schedule_type, learning_rate, int(epochs/2), train_gen.samples // batch_size, epochs)
+
+    with strategy_scope(strategy):
+        # initialize optimizer and model, then compile it
+        opt = create_optimizer(schedule_type, learning_rate, epochs, schedule)
+
+        # We now compile the Xception model for the second stage
+        model.compile(loss="sparse_categorical_crossentropy",
             optimizer=opt,
             metrics=["accuracy"])
 
-        # Training and evaluating the Xception model for the second stage
-        print("[INFO] Training full model...")
-        history = model.fit(train_gen,
-            steps_per_epoch=train_gen.samples // batch_size,
-            validation_data=val_gen,
-            validation_steps=val_gen.samples // batch_size,
-            callbacks=callbacks,
-            epochs=int(epochs/2))
+    # Reuse the weights of a run with the same configuration
+    if artifact is not None and artifact.exists():
+        history = artifact.load_training(model)
+        return model, history, schedule
+
+    # Record per-step input wait and compute time
+    if step_timing_path is not None:
+        callbacks = callbacks + [StepTimingCallback(step_timing_path, "xception")]
+
+    # Stop early, within the time budget, and restore the best weights
+    if budget is not None:
+        callbacks = callbacks + [budget.create_callback(schedule, train_gen.samples // batch_size)]
+
+    # Training and evaluating the Xception model for the second stage
+    print("[INFO] Training full model...")
+    history = model.fit(train_gen,
+        steps_per_epoch=train_gen.samples // batch_size,
+        validation_data=val_gen,
+        validation_steps=val_gen.samples // batch_size,
+        callbacks=callbacks,
+        epochs=int(epochs/2))
+    if artifact is not None:
+        artifact.save_training(model, history)
 
-        return model, history, schedule
\ No newline at end of file
+    return model, history, schedule
\ No newline at end of file
@@ -0,0 +1,107 @@
+# Adaptive epoch budget for training runs.
+# --epochs becomes an upper bound: training stops early once the validation loss
+# has not improved for `patience` epochs, or once the next epoch would not finish
+# within the time budget of the task. The weights of the epoch with the lowest
+# validation loss are restored at the end. When the time budget leaves fewer
+# epochs than planned, the rest of the learning rate (and momentum) schedule is
+# compressed into them, so that e.g. the one cycle policy still completes.
+
+import time
+from tensorflow.keras.callbacks import Callback
+
+# Settings of the budget of a task, shared by its training runs (e.g. both
+# Xception stages). The time budget starts when the budget is created.
+class TrainingBudget:
+    def __init__(self, patience=None, min_delta=0., max_minutes=None):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_minutes = max_minutes
+        self.deadline = None if max_minutes is None else time.time() + max_minutes * 60.
+
+    # The settings which change the trained weights, for the artifact store
+    @property
+    def config(self):
+        return {"patience": self.patience, "min_delta": self.min_delta, "max_minutes": self.max_minutes}
+
+    # Create the callback of a training run allowed to use `fraction` of the
+    # time left, e.g. 0.5 for the first of two Xception stages
+    def create_callback(self, schedule=None, steps_per_epoch=None, fraction=1.):
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.time() + fraction * max(self.deadline - time.time(), 0.)
+        return AdaptiveBudgetCallback(self.patience, self.min_delta, deadline, schedule, steps_per_epoch)
+
+class AdaptiveBudgetCallback(Callback):
+    def __init__(self, patience, min_delta, deadline, schedule=None, steps_per_epoch=None):
+        super(AdaptiveBudgetCallback, self).__init__()
+        self.patience = patience
+        self.min_delta = min_delta
+        self.deadline = deadline
+        self.schedule = schedule
+        self.steps_per_epoch = steps_per_epoch
+
+    def on_train_begin(self, logs=None):
+        self.best_loss = float("inf")
+        self.best_epoch = None
+        self.best_weights = None
+        self.wait = 0
+        self.epoch_seconds = 0.
+        self.planned_epochs = self.params["epochs"]
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        # The slowest epoch so far, so the estimate errs on the safe side
+        self.epoch_seconds = max(self.epoch_seconds, time.time() - self.epoch_start)
+
+        val_loss = logs.get("val_loss")
+        if val_loss is not None and val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
+            self.wait = 0
+        else:
+            self.wait += 1
+
+        if self.patience is not None and self.wait >= self.patience:
+            print("[INFO] Validation loss plateaued for {} epochs, stopping after epoch {}".format(
+                self.wait, epoch + 1))
+            self.model.stop_training = True
+            return
+
+        if self.deadline is not None:
+            affordable_epochs = int(max(self.deadline - time.time(), 0.) // self.epoch_seconds)
+            if epoch + 1 + affordable_epochs < self.planned_epochs:
+                self.planned_epochs = epoch + 1 + affordable_epochs
+                print("[INFO] Time budget leaves {} of {} epochs".format(self.planned_epochs, self.params["epochs"]))
+                if self.schedule is not None and self.steps_per_epoch is not None and affordable_epochs > 0:
+                    print("[INFO] Compressing the learning rate schedule into the remaining epochs...")
+                    self.schedule.compress((epoch + 1) * self.steps_per_epoch,
+                                           self.planned_epochs * self.steps_per_epoch)
+
+        if epoch + 1 >= self.planned_epochs and self.planned_epochs < self.params["epochs"]:
+            print("[INFO] Time budget reached, stopping after epoch {}".format(epoch + 1))
+            self.model.stop_training = True
+
+    # The History returned by fit records which epoch's weights the model ends
+    # up with, see get_val_acc
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            print("[INFO] Restoring the weights of epoch {} (val_loss {:0.4f})".format(
+                self.best_epoch + 1, self.best_loss))
+            self.model.set_weights(self.best_weights)
+            history = getattr(self.model, "history", None)
+            if history is not None:
+                history.restored_epoch = self.best_epoch
+
+# Validation accuracy of the weights a model was left with: the restored epoch
+# for runs with a budget, otherwise the last epoch. For multi-head models, the
+# accuracy of the head of the given task.
+def get_val_acc(history, task=None):
+    val_acc = history.history["val_acc" if task is None else "val_{}_acc".format(task)]
+    restored_epoch = getattr(history, "restored_epoch", None)
+    if restored_epoch is None:
+        return val_acc[-1]
+    return val_acc[restored_epoch]
@@ -1,8 +1,18 @@
 import numpy as np
 import math
+import tensorflow as tf
 import tensorflow.keras.backend as K
-from tensorflow.keras.callbacks import LambdaCallback
 import matplotlib.pyplot as plt
+from pipeline.plotting.plot_lock import synchronised_plot
+
+# Decode the first num_batches batches of a Sequence or a tf.data dataset into
+# memory
+def take_batches(generator, num_batches):
+    if hasattr(generator, "__getitem__"):
+        return [generator[i] for i in range(min(num_batches, len(generator)))]
+    next_batch = tf.compat.v1.data.make_one_shot_iterator(generator).get_next()
+    session = K.get_session()
+    return [session.run(next_batch) for _ in range(num_batches)]
 
 class LRFinder:
     def __init__(self, model):
@@ -12,53 +22,64 @@ class LRFinder:
         self.best_loss = float('inf')
         self.avg_loss = 0.
         
-    def on_batch_end(self, batch, logs, beta):
+    # Record the smoothed loss of a step and raise the learning rate for the
+    # next one. Returns False once the loss has diverged.
+    def on_batch_end(self, iteration, loss, beta):
         lr = float(K.get_value(self.model.optimizer.lr))
-        loss = logs.get('loss')
         
         # computing moving average of loss
         self.avg_loss = beta * self.avg_loss + (1. - beta) * loss
-        smooth_loss = self.avg_loss / (1. - beta**(batch+1)) # batch+1, because the batch number, batch starts from 0
+        smooth_loss = self.avg_loss / (1. - beta**(iteration+1)) # iteration+1, because the iteration number starts from 0
         
-        # if loss is NaN or diverges too much, stop training
+        # if loss is NaN or diverges too much, stop the sweep
         if smooth_loss > 4 * self.best_loss or math.isnan(smooth_loss):
-            self.model.stop_training=True
-            return
+            return False
         
         # record current stats
         self.lrs.append(lr)
         self.losses.append(smooth_loss)
         
         # update best_loss
-        if batch == 1 or smooth_loss < self.best_loss:
+        if iteration == 0 or smooth_loss < self.best_loss:
             self.best_loss = smooth_loss
             
         # update lr for next batch
         K.set_value(self.model.optimizer.lr, lr*self.lr_multiplier)
-        
+        return True
 
-    def find(self, generator, start_lr = 1e-7, end_lr = 10., beta=0.98, num_iter=100, **kwargs):
-        # calculate number of epochs
-        num_epochs = math.ceil(num_iter/len(generator))
-        
+    # The sweep replays a fixed subset of num_batches batches, decoded once and
+    # kept in memory, instead of iterating over the augmented generator. The
+    # weights are snapshotted and restored in memory, and the sweep stops as
+    # soon as the loss diverges.
+    def find(self, generator, start_lr = 1e-7, end_lr = 10., beta=0.98, num_iter=100, num_batches=5):
         # calculate lr multiplier
         self.lr_multiplier = (end_lr / start_lr)**(1./num_iter)
+
+        batches = take_batches(generator, num_batches)
         
         # save initial state
         orig_lr = float(K.get_value(self.model.optimizer.lr))
-        self.model.save_weights('orig.h5')
+        orig_weights = self.model.get_weights()
         
         # set current lr as start_lr
         K.set_value(self.model.optimizer.lr, start_lr)
         
-        # train model with callback based pn self.on_batch_end()
-        cb = LambdaCallback(on_batch_end=lambda batch,logs: self.on_batch_end(batch,logs,beta=beta))
-        self.model.fit_generator(generator=generator, epochs=num_epochs, callbacks=[cb], **kwargs)
+        print("[INFO] Sweeping learning rate over {} cached batches...".format(len(batches)))
+        for iteration in range(num_iter):
+            X, y = batches[iteration % len(batches)]
+            loss = self.model.train_on_batch(X, y)
+            # train_on_batch also returns the metrics when the model has any
+            if isinstance(loss, list):
+                loss = loss[0]
+            if not self.on_batch_end(iteration, float(loss), beta):
+                print("[INFO] Loss diverged after {} iterations".format(iteration + 1))
+                break
         
         # restore initial state
         K.set_value(self.model.optimizer.lr, orig_lr)
-        self.model.load_weights('orig.h5')
+        self.model.set_weights(orig_weights)
             
+    @synchronised_plot
     def plot_loss(self, find_lr_plot_path, skip_start=10, skip_end=5, suggestion=False):
         plt.plot(self.lrs[skip_start:-skip_end], self.losses[skip_start:-skip_end])
         plt.xlabel('learning rate')
@@ -0,0 +1,171 @@
+# Learning rate and momentum schedules precomputed for every training step.
+# Each schedule is an array with one value per step, which the optimizer looks
+# up from its own iteration counter. The training step therefore runs without
+# LearningRateScheduler or per-batch callbacks setting the optimizer variables
+# from Python, and the plots read the same arrays the optimizer used.
+# The formulas are the ones of StepDecay, PolynomialDecay and the one cycle
+# policy, evaluated for all steps at once.
+
+import numpy as np
+import matplotlib.pyplot as plt
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from tensorflow.keras.optimizers import SGD
+from tensorflow.keras.optimizers.schedules import LearningRateSchedule
+from pipeline.optimisation.learning_rate_schedulers import StepDecay, PolynomialDecay
+from pipeline.optimisation.one_cycle_lr.param_scheduler import CosineScheduler
+
+# Look up the value of a step in a precomputed array. Steps past the end of the
+# array keep the last value. The array is held in a variable, so that it can be
+# replaced during training (see TrainingSchedule.compress).
+class PrecomputedSchedule(LearningRateSchedule):
+    def __init__(self, values):
+        super(PrecomputedSchedule, self).__init__()
+        self.values = np.asarray(values, dtype=np.float32)
+        self.variable = K.variable(self.values)
+
+    def __call__(self, step):
+        index = tf.minimum(tf.cast(step, tf.int32), len(self.values) - 1)
+        return tf.gather(self.variable, index)
+
+    def set_values(self, values):
+        self.values = np.asarray(values, dtype=np.float32)
+        K.set_value(self.variable, self.values)
+
+    def get_config(self):
+        return {"values": self.values.tolist()}
+
+# Resample the part of a schedule from done_steps on, so that it ends at
+# total_steps instead. The steps past total_steps keep the last value.
+def compress_values(values, done_steps, total_steps):
+    remaining = np.interp(
+        np.linspace(done_steps, len(values) - 1, total_steps - done_steps),
+        np.arange(len(values)),
+        values)
+    compressed = np.full_like(values, values[-1])
+    compressed[:done_steps] = values[:done_steps]
+    compressed[done_steps:total_steps] = remaining
+    return compressed
+
+# Learning rates and, for the one cycle policy, momentums of every step
+class TrainingSchedule:
+    def __init__(self, lrs, momentums=None):
+        self.lrs = np.asarray(lrs, dtype=np.float32)
+        self.momentums = None if momentums is None else np.asarray(momentums, dtype=np.float32)
+        self.learning_rate = PrecomputedSchedule(self.lrs)
+        self.momentum = None if momentums is None else PrecomputedSchedule(self.momentums)
+
+    # Fit the rest of the schedule into a shorter training run, e.g. the one
+    # cycle policy into the epochs left within a time budget. Only the steps not
+    # trained yet are changed.
+    def compress(self, done_steps, total_steps):
+        if total_steps >= len(self.lrs) or total_steps <= done_steps:
+            return
+        self.lrs = compress_values(self.lrs, done_steps, total_steps)
+        self.learning_rate.set_values(self.lrs)
+        if self.momentums is not None:
+            self.momentums = compress_values(self.momentums, done_steps, total_steps)
+            self.momentum.set_values(self.momentums)
+
+    def plot(self, title="Learning Rate Schedule"):
+        plt.style.use("ggplot")
+        plt.figure()
+        if self.momentums is not None:
+            plt.subplot(121)
+        plt.plot(self.lrs)
+        plt.title(title)
+        plt.xlabel("Iteration")
+        plt.ylabel("Learning Rate")
+        if self.momentums is not None:
+            plt.subplot(122)
+            plt.plot(self.momentums)
+            plt.xlabel("Iteration")
+            plt.ylabel("Momentum")
+
+# Repeat a per-epoch schedule for every step of the epoch
+def per_epoch_schedule(decay, epochs, steps_per_epoch):
+    return np.repeat([decay(epoch) for epoch in range(epochs)], steps_per_epoch)
+
+# The one cycle policy: the learning rate rises from max_lr/start_div to max_lr
+# over the first pct_start of the steps, then falls to max_lr/end_div, while the
+# momentum follows the opposite path, all along cosine curves
+def one_cycle_schedule(max_lr, num_iter, momentums=(0.95, 0.85), start_div=25., pct_start=0.3, end_div=None):
+    if end_div is None:
+        end_div = start_div * 1e4
+    num_iter_1 = int(pct_start * num_iter)
+    num_iter_2 = num_iter - num_iter_1
+    pct_1 = np.linspace(0., 1., num_iter_1, endpoint=False)
+    pct_2 = np.linspace(0., 1., num_iter_2)
+    cosine = CosineScheduler(0., 0., num_iter).func
+
+    lrs = np.concatenate([
+        cosine(max_lr / start_div, max_lr, pct_1),
+        cosine(max_lr, max_lr / end_div, pct_2)])
+    moms = np.concatenate([
+        cosine(momentums[0], momentums[1], pct_1),
+        cosine(momentums[1], momentums[0], pct_2)])
+    return lrs, moms
+
+# Precompute the schedule of a training run of epochs epochs. decay_epochs is
+# the length the epoch-based decays are defined over, for runs training only
+# part of it (e.g. the first Xception stage). Returns None for the "standard"
+# and "none" schedule types, which do not need one.
+def create_schedule(schedule_type, learning_rate, epochs, steps_per_epoch, decay_epochs=None):
+    if decay_epochs is None:
+        decay_epochs = epochs
+    steps_per_epoch = max(steps_per_epoch, 1)
+
+    # check to see if step-based learning rate decay should be used
+    if schedule_type == "step":
+        print("[INFO] using 'step-based' learning rate decay...")
+        decay = StepDecay(initAlpha=1e-1, factor=0.25, dropEvery=max(int(decay_epochs/5), 1))
+        return TrainingSchedule(per_epoch_schedule(decay, epochs, steps_per_epoch))
+
+    # check to see if linear learning rate decay should should be used
+    elif schedule_type == "linear":
+        print("[INFO] using 'linear' learning rate decay...")
+        decay = PolynomialDecay(maxEpochs=decay_epochs, initAlpha=1e-1, power=1)
+        return TrainingSchedule(per_epoch_schedule(decay, epochs, steps_per_epoch))
+
+    # check to see if a polynomial learning rate decay should be used
+    elif schedule_type == "poly":
+        print("[INFO] using 'polynomial' learning rate decay...")
+        decay = PolynomialDecay(maxEpochs=decay_epochs, initAlpha=1e-1, power=5)
+        return TrainingSchedule(per_epoch_schedule(decay, epochs, steps_per_epoch))
+
+    elif schedule_type == "one_cycle":
+        print("[INFO] using 'one cycle' learning...")
+        lrs, momentums = one_cycle_schedule(learning_rate, epochs * steps_per_epoch)
+        return TrainingSchedule(lrs, momentums)
+
+    # if we are using Keras' "standard" decay, it is set on the optimizer
+    elif schedule_type == "standard":
+        print("[INFO] using 'keras standard' learning rate decay...")
+
+    # otherwise, no learning rate schedule is being used
+    elif schedule_type == "none":
+        print("[INFO] no learning rate schedule being used")
+    return None
+
+# Create the SGD optimizer for a schedule. The learning rate schedule is passed
+# to the optimizer directly and a momentum schedule is read from the optimizer's
+# iteration counter, so both are evaluated inside the training step.
+def create_optimizer(schedule_type, learning_rate, epochs, schedule=None, find_lr=False):
+    # The learning rate finder sets the learning rate itself. The curve is
+    # measured with the momentum the schedules train with.
+    if find_lr == True:
+        return SGD(momentum=0.9)
+
+    if schedule is None:
+        # Keras' "standard" decay, otherwise a constant learning rate
+        decay = 1e-1 / epochs if schedule_type == "standard" else 0.0
+        return SGD(lr=learning_rate, momentum=0.9, decay=decay)
+
+    if schedule.momentums is None:
+        return SGD(learning_rate=schedule.learning_rate, momentum=0.9)
+
+    optimizer = []
+    opt = SGD(learning_rate=schedule.learning_rate,
+              momentum=lambda: schedule.momentum(optimizer[0].iterations))
+    optimizer.append(opt)
+    return opt
@@ -0,0 +1,122 @@
+# Keras callback timing every training step.
+# The time from the end of one batch to the start of the next is spent waiting
+# on the input (the generator or dataset producing the batch), the time from the
+# start to the end of a batch is the train step itself. Both are recorded with
+# the resident memory of the process, to a JSON lines file or, for paths ending
+# in .json, to a Chrome trace which can be opened in chrome://tracing.
+# At the end of each epoch a summary shows how input-bound the epoch was.
+
+import json
+import os
+import time
+from tensorflow.keras.callbacks import Callback
+from pipeline.datasets.dataset_root import get_output_path
+from pipeline.distributed import get_worker_shard
+
+# Current resident set size of this process in bytes
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        # Peak rather than current RSS, in kilobytes on Linux and bytes on macOS
+        import resource
+        import sys
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+class StepTimingCallback(Callback):
+    def __init__(self, path, name="train"):
+        super(StepTimingCallback, self).__init__()
+        self.path = path
+        self.name = name
+        self.chrome_trace = path.endswith(".json")
+        self.file = None
+
+    # The file is appended to, so that consecutive fits of a run (e.g. both
+    # Xception training stages) end up in the same file. The file of an earlier
+    # run is removed by get_step_timing_path. Chrome traces are written in the
+    # JSON array format, for which the closing bracket is optional.
+    def on_train_begin(self, logs=None):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        is_new = not os.path.exists(self.path)
+        self.file = open(self.path, "a")
+        if self.chrome_trace and is_new:
+            self.file.write("[\n")
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_input_wait = 0.
+        self.epoch_compute = 0.
+        self.epoch_steps = 0
+        self.peak_rss = 0
+        self.last_batch_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        batch_end = time.time()
+        input_wait = self.batch_start - self.last_batch_end
+        compute = batch_end - self.batch_start
+        rss = get_rss_bytes()
+
+        self.epoch_input_wait += input_wait
+        self.epoch_compute += compute
+        self.epoch_steps += 1
+        self.peak_rss = max(self.peak_rss, rss)
+        self.write_step(batch, input_wait, compute, rss)
+        self.last_batch_end = batch_end
+
+    def write_step(self, batch, input_wait, compute, rss):
+        if not self.chrome_trace:
+            self.file.write(json.dumps({
+                "name": self.name,
+                "epoch": self.epoch,
+                "batch": batch,
+                "start": self.last_batch_end,
+                "input_wait_ms": input_wait * 1000.,
+                "compute_ms": compute * 1000.,
+                "rss_mb": rss / 2.**20}) + "\n")
+            return
+
+        pid = os.getpid()
+        args = {"epoch": self.epoch, "batch": batch}
+        events = [
+            {"name": "input_wait", "cat": self.name, "ph": "X", "pid": pid, "tid": 0,
+             "ts": self.last_batch_end * 1e6, "dur": input_wait * 1e6, "args": args},
+            {"name": "train_step", "cat": self.name, "ph": "X", "pid": pid, "tid": 0,
+             "ts": self.batch_start * 1e6, "dur": compute * 1e6, "args": args},
+            {"name": "rss_mb", "ph": "C", "pid": pid, "ts": self.batch_start * 1e6,
+             "args": {"rss_mb": rss / 2.**20}}]
+        for event in events:
+            self.file.write(json.dumps(event) + ",\n")
+
+    def on_epoch_end(self, epoch, logs=None):
+        total = self.epoch_input_wait + self.epoch_compute
+        input_bound = 100. * self.epoch_input_wait / total if total > 0 else 0.
+        print("[INFO] {} epoch {}: {} steps, input wait {:0.1f}s, compute {:0.1f}s, "
+              "{:0.1f}% input-bound, peak RSS {:0.0f} MB".format(
+                  self.name, epoch + 1, self.epoch_steps, self.epoch_input_wait,
+                  self.epoch_compute, input_bound, self.peak_rss / 2.**20))
+        self.file.flush()
+
+    def on_train_end(self, logs=None):
+        self.file.close()
+
+# Output file of a training run, e.g. output/step_timing_A1_mlp.jsonl for
+# step_timing="jsonl" or output/step_timing_A1_mlp.json for step_timing="trace".
+# None when step timing is off. Called once per run, and removes the file of
+# an earlier run so that steps of unrelated runs are not mixed. Every worker of
+# a data-parallel run writes its own file, e.g. step_timing_A1_mlp_worker1.jsonl.
+def get_step_timing_path(name, step_timing):
+    if step_timing is None:
+        return None
+    extension = ".json" if step_timing == "trace" else ".jsonl"
+    num_workers, index = get_worker_shard()
+    if num_workers > 1:
+        name = "{}_worker{}".format(name, index)
+    path = get_output_path("step_timing_" + name + extension)
+    if os.path.exists(path):
+        os.remove(path)
+    return path
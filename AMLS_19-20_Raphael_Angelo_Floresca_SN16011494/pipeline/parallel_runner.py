@@ -0,0 +1,59 @@
+# Runs several tasks at once, each in its own worker process with its own Keras
+# graph and session. The number of concurrent tasks and the number of threads
+# used by each worker can be capped, so that the workers share the cores of a
+# machine instead of competing for them.
+
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pipeline.task_registry import run_task
+
+# Called once in each worker before TensorFlow is imported, so that the thread
+# pools of the maths libraries are capped as well
+def init_worker(intra_op_threads):
+    if intra_op_threads is not None:
+        os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+
+# Keras sessions are reset by K.clear_session() at the end of each task, so the
+# thread limits are applied again for every task the worker runs
+def set_session_threads(intra_op_threads, inter_op_threads):
+    import tensorflow as tf
+
+    config = tf.compat.v1.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads or 0,
+        inter_op_parallelism_threads=inter_op_threads or 0)
+    tf.compat.v1.keras.backend.set_session(tf.compat.v1.Session(config=config))
+
+def run_task_in_worker(intra_op_threads, inter_op_threads, task_kwargs):
+    set_session_threads(intra_op_threads, inter_op_threads)
+    return run_task(**task_kwargs)
+
+# Run every task in task_kwargs (task name -> run_task keyword arguments) and
+# return a dictionary of task name -> (validation accuracy, test accuracy)
+def run_tasks_in_parallel(
+        task_kwargs,
+        max_concurrent_tasks,
+        intra_op_threads=None,
+        inter_op_threads=None):
+    from pipeline.datasets.utilities import check_train_path, check_test_path
+
+    # Download the datasets once up front, rather than racing in every worker
+    check_train_path()
+    check_test_path()
+
+    print("[INFO] Running {} tasks on {} workers...".format(len(task_kwargs), max_concurrent_tasks))
+
+    results = {}
+    with ProcessPoolExecutor(
+            max_workers=max_concurrent_tasks,
+            mp_context=mp.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(intra_op_threads,)) as executor:
+        futures = {
+            executor.submit(run_task_in_worker, intra_op_threads, inter_op_threads, kwargs): task
+            for task, kwargs in task_kwargs.items()}
+        for future in as_completed(futures):
+            task = futures[future]
+            results[task] = future.result()
+            print("[INFO] Task {} finished".format(task))
+    return results
@@ -1,74 +1,79 @@
 # Implementation of GradCam from https://github.com/totti0223/gradcamplusplus
+# Batched so that the gradient function is compiled once per (model, layer),
+# and Grad-CAM and Grad-CAM++ are both computed from one forward/backward pass.
 
 from scipy.ndimage.interpolation import zoom
 import numpy as np
+import weakref
 from tensorflow.keras import backend as K
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
 
 import matplotlib.pyplot as plt
 
+# Compiled engines, per model and then per layer name. Keys are weak, so that
+# engines are dropped together with their model.
+grad_cam_engines = weakref.WeakKeyDictionary()
+
+class GradCamEngine:
+    def __init__(self, input_model, layer_name):
+        # The class of each image is its top prediction, selected on the graph
+        # rather than with a separate predict call
+        y_c = K.max(input_model.output, axis=-1)
+        conv_output = input_model.get_layer(layer_name).output
+        # Images in a batch are independent, so the gradient of the summed
+        # scores gives the gradient of each image's own score
+        grads = K.gradients(K.sum(y_c), conv_output)[0]
+        self.gradient_function = K.function([input_model.input], [y_c, conv_output, grads])
+
+    # Returns the Grad-CAM and Grad-CAM++ maps for a batch of images
+    def compute(self, images, H=224, W=224):
+        y_c, conv_output, grads_val = self.gradient_function([images])
+
+        # Grad-CAM
+        weights = np.mean(grads_val, axis=(1, 2))
+        cams = np.einsum("nhwc,nc->nhw", conv_output, weights)
+
+        # Grad-CAM++
+        exp_y_c = np.exp(y_c).reshape((-1, 1, 1, 1))
+        conv_first_grad = exp_y_c*grads_val
+        conv_second_grad = exp_y_c*grads_val*grads_val
+        conv_third_grad = exp_y_c*grads_val*grads_val*grads_val
+        global_sum = np.sum(conv_output, axis=(1, 2))
+
+        alpha_num = conv_second_grad
+        alpha_denom = conv_second_grad*2.0 + conv_third_grad*global_sum[:, np.newaxis, np.newaxis, :]
+        alpha_denom = np.where(alpha_denom != 0.0, alpha_denom, np.ones(alpha_denom.shape))
+        alphas = alpha_num/alpha_denom
+
+        plus_weights = np.maximum(conv_first_grad, 0.0)
+        alpha_normalization_constant = np.sum(alphas, axis=(1, 2))
+        alphas /= alpha_normalization_constant[:, np.newaxis, np.newaxis, :]
+
+        deep_linearization_weights = np.sum(plus_weights*alphas, axis=(1, 2))
+        cams_plus = np.einsum("nhwc,nc->nhw", conv_output, deep_linearization_weights)
+
+        return ([self.postprocess(cam, H) for cam in cams],
+                [self.postprocess(cam, H) for cam in cams_plus])
+
+    # Passing through ReLU, then resizing and scaling from 0 to 1.0
+    @staticmethod
+    def postprocess(cam, H):
+        cam = np.maximum(cam, 0)
+        cam = zoom(cam,H/cam.shape[0])
+        cam = cam / np.max(cam)
+        return cam
+
+def get_grad_cam_engine(input_model, layer_name):
+    engines = grad_cam_engines.setdefault(input_model, {})
+    if layer_name not in engines:
+        engines[layer_name] = GradCamEngine(input_model, layer_name)
+    return engines[layer_name]
+
 def grad_cam(input_model, image, layer_name,H=224,W=224):
-    cls = np.argmax(input_model.predict(image))
-    def normalize(x):
-        """Utility function to normalize a tensor by its L2 norm"""
-        return (x + 1e-10) / (K.sqrt(K.mean(K.square(x))) + 1e-10)
     """GradCAM method for visualizing input saliency."""
-    y_c = input_model.output[0, cls]
-    conv_output = input_model.get_layer(layer_name).output
-    grads = K.gradients(y_c, conv_output)[0]
-    #grads = normalize(grads)
-    gradient_function = K.function([input_model.input], [conv_output, grads])
-
-    output, grads_val = gradient_function([image])
-    output, grads_val = output[0, :], grads_val[0, :, :, :]
-
-    weights = np.mean(grads_val, axis=(0, 1))
-    cam = np.dot(output, weights)
-    #print (cam)
-
-    cam = np.maximum(cam, 0)
-    #cam = resize(cam, (H, W))
-    cam = zoom(cam,H/cam.shape[0])
-    #cam = np.maximum(cam, 0)
-    cam = cam / cam.max()
-    return cam
+    cams, _ = get_grad_cam_engine(input_model, layer_name).compute(image, H, W)
+    return cams[0]
 
 def grad_cam_plus(input_model, img, layer_name,H=224,W=224):
-    cls = np.argmax(input_model.predict(img))
-    y_c = input_model.output[0, cls]
-    #cost = 全部のラベルの値。cost*label_indexでy_cになる
-    conv_output = input_model.get_layer(layer_name).output
-    #conv_output = target_conv_layer, mixed10の出力1,5,5,2048
-    grads = K.gradients(y_c, conv_output)[0]
-    #grads = normalize(grads)
-
-    first = K.exp(y_c)*grads
-    second = K.exp(y_c)*grads*grads
-    third = K.exp(y_c)*grads*grads*grads
-
-    gradient_function = K.function([input_model.input], [y_c,first,second,third, conv_output, grads])
-    y_c, conv_first_grad, conv_second_grad,conv_third_grad, conv_output, grads_val = gradient_function([img])
-    global_sum = np.sum(conv_output[0].reshape((-1,conv_first_grad[0].shape[2])), axis=0)
-
-    alpha_num = conv_second_grad[0]
-    alpha_denom = conv_second_grad[0]*2.0 + conv_third_grad[0]*global_sum.reshape((1,1,conv_first_grad[0].shape[2]))
-    alpha_denom = np.where(alpha_denom != 0.0, alpha_denom, np.ones(alpha_denom.shape))
-    alphas = alpha_num/alpha_denom
-
-    weights = np.maximum(conv_first_grad[0], 0.0)
-
-    alpha_normalization_constant = np.sum(np.sum(alphas, axis=0),axis=0)
-
-    alphas /= alpha_normalization_constant.reshape((1,1,conv_first_grad[0].shape[2]))
-
-    deep_linearization_weights = np.sum((weights*alphas).reshape((-1,conv_first_grad[0].shape[2])),axis=0)
-    #print deep_linearization_weights
-    grad_CAM_map = np.sum(deep_linearization_weights*conv_output[0], axis=2)
-
-    # Passing through ReLU
-    cam = np.maximum(grad_CAM_map, 0)
-    cam = zoom(cam,H/cam.shape[0])
-    cam = cam / np.max(cam) # scale 0 to 1.0    
-    #cam = resize(cam, (224,224))
-
-    return cam
\ No newline at end of file
+    _, cams_plus = get_grad_cam_engine(input_model, layer_name).compute(img, H, W)
+    return cams_plus[0]
@@ -0,0 +1,15 @@
+# pyplot keeps the current figure in global state, so two tasks plotting from
+# different threads would draw onto each other's figures. Every plotting
+# function holds this lock while it draws and saves.
+
+import functools
+import threading
+
+plot_lock = threading.RLock()
+
+def synchronised_plot(plot_function):
+    @functools.wraps(plot_function)
+    def wrapper(*args, **kwargs):
+        with plot_lock:
+            return plot_function(*args, **kwargs)
+    return wrapper
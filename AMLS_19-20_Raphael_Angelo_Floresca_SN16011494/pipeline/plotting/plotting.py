@@ -1,13 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from pipeline.plotting.gradcamutils import grad_cam, grad_cam_plus
+from pipeline.plotting.gradcamutils import get_grad_cam_engine
+from pipeline.plotting.plot_lock import synchronised_plot
 
 # Plot the training loss and accuracy
+@synchronised_plot
 def plot_train_loss_acc_lr(H, epochs, schedule, schedule_type, task_name, tla_plot_path, lr_plot_path):
     
     print("[INFO] Plotting training and validation loss/accuracy graph...")
 
-    N = np.arange(0, epochs)
+    # Runs with an adaptive budget can stop before the planned epochs
+    N = np.arange(0, len(H.history["loss"]))
     plt.style.use("ggplot")
     plt.figure()
     plt.plot(N, H.history["loss"], label="train_loss")
@@ -20,82 +23,88 @@ def plot_train_loss_acc_lr(H, epochs, schedule, schedule_type, task_name, tla_pl
     plt.legend()
     plt.savefig(tla_plot_path)
  
-    if schedule_type != "none" and schedule_type != "one_cycle":
-        print("Plotting learning rate graph...")
-        schedule.plot(N)
+    # The schedule holds the learning rate (and momentum) of every step the
+    # optimizer took, "none" and "standard" have no schedule to plot
+    if schedule is not None:
+        print("[INFO] Plotting learning rate graph...")
+        schedule.plot()
         plt.savefig(lr_plot_path)
-    elif schedule_type != "none" and schedule_type == "one_cycle":
+    plt.clf()
+    plt.close()
+
+# Plot the training loss and the accuracy of each head of a multi-head model
+@synchronised_plot
+def plot_multi_head_loss_acc_lr(H, epochs, schedule, tasks, task_name, tla_plot_path, lr_plot_path):
+
+    print("[INFO] Plotting training and validation loss/accuracy graph...")
+
+    # Runs with an adaptive budget can stop before the planned epochs
+    N = np.arange(0, len(H.history["loss"]))
+    plt.style.use("ggplot")
+    plt.figure()
+    plt.plot(N, H.history["loss"], label="train_loss")
+    plt.plot(N, H.history["val_loss"], label="val_loss")
+    for task in tasks:
+        plt.plot(N, H.history[task + "_acc"], label=task + "_train_acc")
+        plt.plot(N, H.history["val_" + task + "_acc"], label=task + "_val_acc")
+    plt.title("Training Loss and Accuracy on " + task_name)
+    plt.xlabel("Epoch")
+    plt.ylabel("Loss/Accuracy")
+    plt.legend()
+    plt.savefig(tla_plot_path)
+
+    if schedule is not None:
         print("[INFO] Plotting learning rate graph...")
         schedule.plot()
         plt.savefig(lr_plot_path)
     plt.clf()
     plt.close()
 
+# Get the predicted class probabilities for the whole test set in a single
+# batched inference pass. Everything else is computed from this matrix.
+def get_probs(model, X_test, batch_size=32):
+    return model.predict(X_test, batch_size=batch_size)
+
 # Get indices of wrongfully misclassified test set
 # https://stackoverflow.com/questions/39300880/how-to-find-wrong-prediction-cases-in-test-set-cnns-using-keras
-def get_wrong_indices(model, X_test, y_test):
-    incorrects = np.asarray(np.nonzero(model.predict(X_test).argmax(axis=-1).reshape((-1,)) != y_test))
-    incorrects = incorrects.T.flatten()
+def get_wrong_indices(probs, y_test):
+    incorrects = np.nonzero(probs.argmax(axis=-1) != y_test)[0]
     return incorrects
 
 # This returns an array which contains the predictions for the misclassified images
-def get_incorrect_preds(model, X_test, y_test, incorrects):
-    incorrect_preds = []
-
-    for incorrect in np.nditer(incorrects):
-        probs_pred = model.predict(X_test[incorrect:incorrect+1])
-        incorrect_pred = probs_pred.argmax(axis=-1)
-        incorrect_preds.append(incorrect_pred)
-
-    incorrect_preds = np.asarray(incorrect_preds)
-    incorrect_preds = incorrect_preds.T.flatten()
-    incorrect_preds = incorrect_preds.astype(float)
-    return incorrect_preds
+def get_incorrect_preds(probs, incorrects):
+    return probs[incorrects].argmax(axis=-1).astype(float)
 
 # This returns an array which contains the actual labels for the misclassified images
-def get_actual_labels(X_test, y_test, incorrects):
-    actual_labels = []
+def get_actual_labels(y_test, incorrects):
+    return np.asarray(y_test)[incorrects].astype(float)
 
-    for incorrect in np.nditer(incorrects):
-        actual_label = y_test[incorrect]
-        actual_labels.append(actual_label)
-
-    actual_labels = np.asarray(actual_labels)
-    actual_labels = actual_labels.T.flatten()
-    actual_labels = actual_labels.astype(float)
-    return actual_labels
-
-# This returns an array which contains the individual losses for the misclassified images
-def get_incorrect_losses(model, X_test, y_test, incorrects):
-    incorrect_losses = [] 
-
-    for incorrect in np.nditer(incorrects):
-        loss = model.evaluate(X_test[incorrect:incorrect+1], y_test[incorrect:incorrect+1], verbose=0)
-        incorrect_losses.append(loss[0])
-
-    incorrect_losses = np.asarray(incorrect_losses)
-    incorrect_losses = incorrect_losses.astype(float)
-    return incorrect_losses
-
-def get_probs_correct_label(model, X_test, y_test, incorrects):
 # This returns an array which contains the probabilities of the actual label
 # for the misclassified images
-    probs_correct_label = []
-
-    for incorrect in np.nditer(incorrects):
-        prob_correct_label = model.predict(X_test[incorrect:incorrect+1])
-        probs_correct_label.append(prob_correct_label[0,int(y_test[incorrect])])
-
-    probs_correct_label = np.asarray(probs_correct_label)
-    probs_correct_label = probs_correct_label.astype(float)
-    return probs_correct_label
-
-def create_loss_pred_data(model, X_test, y_test):
-    incorrects = get_wrong_indices(model, X_test, y_test)
-    incorrect_preds = get_incorrect_preds(model, X_test, y_test, incorrects)
-    actual_labels = get_actual_labels(X_test, y_test, incorrects)
-    incorrect_losses = get_incorrect_losses(model, X_test, y_test, incorrects)
-    probs_correct_label = get_probs_correct_label(model, X_test, y_test, incorrects)
+def get_probs_correct_label(probs, y_test, incorrects):
+    return probs[incorrects, np.asarray(y_test)[incorrects].astype(int)].astype(float)
+
+# This returns an array which contains the individual losses for the misclassified images.
+# This is the sparse categorical cross-entropy, clipped the same way as in Keras.
+def get_incorrect_losses(probs, y_test, incorrects, epsilon=1e-7):
+    probs_correct_label = get_probs_correct_label(probs, y_test, incorrects)
+    return -np.log(np.clip(probs_correct_label, epsilon, 1. - epsilon))
+
+# If top_k is given, only the k images with the highest losses are kept. They
+# are selected with argpartition, so only those k rows are sorted.
+def create_loss_pred_data(model, X_test, y_test, top_k=None, probs=None):
+    if probs is None:
+        probs = get_probs(model, X_test)
+    incorrects = get_wrong_indices(probs, y_test)
+    incorrect_losses = get_incorrect_losses(probs, y_test, incorrects)
+
+    if top_k is not None and top_k < len(incorrects):
+        top = np.argpartition(incorrect_losses, -top_k)[-top_k:]
+        incorrects, incorrect_losses = incorrects[top], incorrect_losses[top]
+
+    incorrect_preds = get_incorrect_preds(probs, incorrects)
+    actual_labels = get_actual_labels(y_test, incorrects)
+    probs_correct_label = get_probs_correct_label(probs, y_test, incorrects)
 
     # This joins together the indices of incorrectly misclassified images, their losses and
     # actual label probabilities into a numpy array. It is then sorted in descending order
@@ -107,8 +116,6 @@ def create_loss_pred_data(model, X_test, y_test):
     loss_pred_data = loss_pred_data[np.argsort(loss_pred_data[:,3])[::-1]]
     return loss_pred_data
 
-
-
 # This plots a single misclassified image alongside its predicted label,
 # its actual label, the error rate for the image and the probability given
 # to the actual label
@@ -125,57 +132,48 @@ def plot_wrong_image(i, loss_pred_data, img_data):
 # This plots the images which have been the most misclassified when running the
 # model on the test set. Inspired by the plot_top_losses function in the fastai
 # library
-def plot_top_losses(model, X_test, y_test, ptl_plot_path):
+def plot_top_losses(model, X_test, y_test, ptl_plot_path, num_images=9, probs=None):
+
+    loss_pred_data = create_loss_pred_data(model, X_test, y_test, num_images, probs)
+    plot_top_losses_data(loss_pred_data, X_test, ptl_plot_path, num_images)
+
+# Plot the top losses from precomputed loss_pred_data, whose first column
+# indexes into img_data
+@synchronised_plot
+def plot_top_losses_data(loss_pred_data, img_data, ptl_plot_path, num_images=9):
 
     print("[INFO] Plotting top losses...")
 
-    loss_pred_data = create_loss_pred_data(model, X_test, y_test)
-    num_images = 9
     plt.figure(figsize=(6, 6))
     if np.shape(loss_pred_data)[0] >= num_images:
         for i in range(num_images):
             plt.subplot(3, 3, i+1)
-            plot_wrong_image(i, loss_pred_data, X_test)
+            plot_wrong_image(i, loss_pred_data, img_data)
     else:
-        for i in range(num_images):
+        for i in range(np.shape(loss_pred_data)[0]):
             plt.subplot(np.shape(loss_pred_data)[0], 1, i+1)
-            plot_wrong_image(i, loss_pred_data, X_test)
+            plot_wrong_image(i, loss_pred_data, img_data)
     plt.tight_layout()
     plt.savefig(ptl_plot_path)
 
-def get_correct_indices(model, X_test, y_test):
-    corrects = np.asarray(np.nonzero(model.predict(X_test).argmax(axis=-1).reshape((-1,)) == y_test))
-    corrects = corrects.T.flatten()
+def get_correct_indices(probs, y_test):
+    corrects = np.nonzero(probs.argmax(axis=-1) == y_test)[0]
     return corrects
 
-def get_correct_preds(model, X_test, y_test, corrects):
-    correct_preds = []
-
-    for correct in np.nditer(corrects):
-        probs_pred = model.predict(X_test[correct:correct+1])
-        correct_pred = probs_pred.argmax(axis=-1)
-        correct_preds.append(correct_pred)
-
-    correct_preds = np.asarray(correct_preds)
-    correct_preds = correct_preds.T.flatten()
-    correct_preds = correct_preds.astype(float)
-    return correct_preds
+def get_correct_preds(probs, corrects):
+    return probs[corrects].argmax(axis=-1).astype(float)
 
-def get_correct_accuracies(model, X_test, y_test, corrects):
-    correct_accuracies = []
+# Every correctly classified image has an accuracy of 1, so the probability
+# given to the correct label is used to rank them instead
+def get_correct_accuracies(probs, corrects):
+    return probs[corrects].max(axis=-1).astype(float)
 
-    for correct in np.nditer(corrects):
-        accuracy = model.evaluate(X_test[correct:correct+1], y_test[correct:correct+1], verbose=0)
-        correct_accuracies.append(accuracy[1])
-    
-    correct_accuracies = np.asarray(correct_accuracies)
-    correct_accuracies = correct_accuracies.astype(float)
-    return correct_accuracies
-
-def create_top_n_data(model, X_test, y_test, top_n):
-    corrects = get_correct_indices(model, X_test, y_test)
-    correct_preds = get_correct_preds(model, X_test, y_test, corrects)
-    correct_accuracies = get_correct_accuracies(model, X_test, y_test, corrects)
+def create_top_n_data(model, X_test, y_test, top_n, probs=None):
+    if probs is None:
+        probs = get_probs(model, X_test)
+    corrects = get_correct_indices(probs, y_test)
+    correct_preds = get_correct_preds(probs, corrects)
+    correct_accuracies = get_correct_accuracies(probs, corrects)
 
     top_n_data = np.column_stack((corrects.astype(float),
                                   correct_preds,
@@ -184,19 +182,28 @@ def create_top_n_data(model, X_test, y_test, top_n):
     top_n_data = top_n_data[:top_n,:]
     return top_n_data
 
-def plot_grad_cam(model, X_test, y_test, top_n, layer_name, grad_cam_plot_path):
-    top_n_data = create_top_n_data(model, X_test, y_test, top_n)
+def plot_grad_cam(model, X_test, y_test, top_n, layer_name, grad_cam_plot_path, probs=None):
+    top_n_data = create_top_n_data(model, X_test, y_test, top_n, probs)
+    plot_grad_cam_data(model, top_n_data, X_test, layer_name, grad_cam_plot_path)
+
+# Plot Grad-CAM maps from precomputed top_n_data, whose first column indexes
+# into img_data
+@synchronised_plot
+def plot_grad_cam_data(model, top_n_data, img_data, layer_name, grad_cam_plot_path):
+    top_n = np.shape(top_n_data)[0]
+    X_test = img_data
 
     plt.figure(figsize=(6, 6))
 
     print("[INFO] Plotting Grad-CAM results...")
 
-    for i in range(top_n):
-        img = X_test[int(top_n_data[i,0])] 
-        img = np.expand_dims(img, axis=0)
+    # Both maps are computed for all the selected images in one batch
+    imgs = X_test[top_n_data[:,0].astype(int)]
+    gradcams, gradcampluses = get_grad_cam_engine(model, layer_name).compute(imgs)
 
-        gradcam = grad_cam(model, img, layer_name=layer_name)
-        gradcamplus = grad_cam_plus(model, img, layer_name=layer_name)
+    for i in range(top_n):
+        gradcam = gradcams[i]
+        gradcamplus = gradcampluses[i]
 
         index = i*3
         
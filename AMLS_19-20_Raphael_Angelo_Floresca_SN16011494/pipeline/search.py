@@ -0,0 +1,258 @@
+# Hyperparameter search with successive halving and Hyperband.
+# Samples configurations of the learning rate, schedule type and the MLP
+# (layer sizes and activations) or CNN (filters, kernel size and fully connected
+# size) architecture, and trains them concurrently in worker processes. Every
+# trial first trains for a few epochs; only the best 1/eta of the trials of a
+# rung go on to train eta times as many epochs, continuing from their weights,
+# until the survivors reach the full number of epochs. Hyperband runs several
+# such brackets, trading the number of trials against their starting epochs.
+# The workers read the decoded-image cache, which is built once up front.
+# A leaderboard of every trial is written per task to the output folder.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with:
+#   python -m pipeline.search -k A1 -t mlp,cnn -n 27 --max_epochs 9
+
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from pipeline.task_registry import get_task_class
+from pipeline.parallel_runner import init_worker, set_session_threads
+from pipeline.datasets.dataset_root import get_output_path
+from pipeline.models.artifact_store import artifacts_dir
+
+search_dir = os.path.join(artifacts_dir, "search")
+
+# Values sampled for each model type, on top of the learning rate and schedule
+search_spaces = {
+    "mlp": {
+        "first_af": ["relu", "elu", "tanh"],
+        "second_af": ["relu", "elu", "tanh"],
+        "layer1_hn": [100, 300, 500, 1000],
+        "layer2_hn": [50, 100, 200]},
+    "cnn": {
+        "num_start_filters": [8, 16, 32],
+        "kernel_size": [3, 5],
+        "fcl_size": [128, 256, 512, 1024]}
+}
+
+def sample_config(rng, model_types, schedule_types, lr_range):
+    model_type = model_types[rng.randint(len(model_types))]
+    config = {
+        "model_type": model_type,
+        "schedule_type": schedule_types[rng.randint(len(schedule_types))],
+        # Sampled uniformly on a log scale
+        "learning_rate": float(10 ** rng.uniform(np.log10(lr_range[0]), np.log10(lr_range[1])))}
+    for name, values in search_spaces[model_type].items():
+        config[name] = values[rng.randint(len(values))]
+    return config
+
+def build_trial_model(config, height, width, num_classes):
+    params = {name: config[name] for name in search_spaces[config["model_type"]]}
+    if config["model_type"] == "mlp":
+        from pipeline.models.mlp import build_mlp
+        return build_mlp(height, width, num_classes, **params)
+    from pipeline.models.cnn import build_cnn
+    return build_cnn(height, width, num_classes, **params)
+
+# Train a trial from initial_epoch up to epochs in a worker process, and return
+# its validation accuracy. The schedule spans max_epochs, so that a trial
+# promoted to the next rung continues along the same schedule: its weights are
+# reloaded and the optimizer's step counter is moved to where it stopped.
+def run_trial(
+        task,
+        config,
+        initial_epoch,
+        epochs,
+        max_epochs,
+        trial_path,
+        input_backend,
+        random_state,
+        intra_op_threads,
+        inter_op_threads):
+    from tensorflow.keras import backend as K
+    from pipeline.optimisation.schedules import create_schedule, create_optimizer
+
+    set_session_threads(intra_op_threads, inter_op_threads)
+    task_class = get_task_class(task, config["model_type"])
+    # Every trial uses the same training and validation split
+    task_class.random_state = random_state
+    train_gen, val_gen = task_class.get_train_val_gens(input_backend)
+    steps_per_epoch = train_gen.samples // task_class.batch_size
+
+    model = build_trial_model(config, task_class.height, task_class.width, task_class.num_classes)
+    schedule = create_schedule(config["schedule_type"], config["learning_rate"], max_epochs, steps_per_epoch)
+    opt = create_optimizer(config["schedule_type"], config["learning_rate"], max_epochs, schedule)
+    model.compile(loss="sparse_categorical_crossentropy", optimizer=opt, metrics=["accuracy"])
+
+    weights_path = os.path.join(trial_path, "weights.h5")
+    if initial_epoch > 0:
+        model.load_weights(weights_path)
+        K.set_value(opt.iterations, initial_epoch * steps_per_epoch)
+
+    start = time.time()
+    history = model.fit(
+        train_gen,
+        steps_per_epoch=steps_per_epoch,
+        validation_data=val_gen,
+        validation_steps=val_gen.samples // task_class.batch_size,
+        initial_epoch=initial_epoch,
+        epochs=epochs,
+        verbose=0)
+    os.makedirs(trial_path, exist_ok=True)
+    model.save_weights(weights_path)
+
+    # tf.data inputs belong to the graph cleared here, so they are rebuilt by
+    # the next trial of this worker
+    K.clear_session()
+    task_class.loaded.pop("train_gens_tf_data", None)
+    return {
+        "val_acc": float(history.history["val_acc"][-1]),
+        "history": {k: [float(v) for v in values] for k, values in history.history.items()},
+        "seconds": time.time() - start}
+
+# Number of trials and starting epochs of each bracket. Successive halving is
+# the single most aggressive bracket, Hyperband runs every bracket.
+def get_brackets(method, num_trials, min_epochs, max_epochs, eta):
+    s_max = int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+    if method == "successive_halving":
+        return [(num_trials, s_max)]
+    return [(int(math.ceil((s_max + 1) / (s + 1) * eta ** s)), s) for s in reversed(range(s_max + 1))]
+
+# Epochs trained by the end of each rung of a bracket with s halvings
+def get_rung_epochs(s, max_epochs, eta):
+    return [max(int(round(max_epochs * eta ** (i - s))), 1) for i in range(s + 1)]
+
+# Run one bracket: train all its trials to the first rung, keep the best
+# 1/eta of them, train those to the next rung, and so on
+def run_bracket(executor, task, trials, s, args):
+    rung_epochs = get_rung_epochs(s, args["max_epochs"], args["eta"])
+    survivors = trials
+    trained_epochs = 0
+    for rung, epochs in enumerate(rung_epochs):
+        print("[INFO] {} rung {}: training {} trials to {} epochs...".format(task, rung, len(survivors), epochs))
+        futures = [executor.submit(
+            run_trial,
+            task,
+            trial["config"],
+            trained_epochs,
+            epochs,
+            args["max_epochs"],
+            trial["path"],
+            args["input_backend"],
+            args["random_state"],
+            args["intra_op_threads"],
+            args["inter_op_threads"]) for trial in survivors]
+        for trial, future in zip(survivors, futures):
+            result = future.result()
+            trial["epochs"] = epochs
+            trial["val_acc"] = result["val_acc"]
+            trial["seconds"] += result["seconds"]
+            trial["rungs"].append({"epochs": epochs, "val_acc": result["val_acc"], "history": result["history"]})
+        trained_epochs = epochs
+
+        if rung == len(rung_epochs) - 1:
+            break
+        # Promote the best trials, the weights of the others are not needed
+        survivors = sorted(survivors, key=lambda trial: trial["val_acc"], reverse=True)
+        num_promoted = max(len(survivors) // args["eta"], 1)
+        for trial in survivors[num_promoted:]:
+            shutil.rmtree(trial["path"], ignore_errors=True)
+        survivors = survivors[:num_promoted]
+
+def search_task(task, args):
+    rng = np.random.RandomState(args["seed"])
+    model_types = [str(item) for item in args["model_type"].split(",")]
+    schedule_types = [str(item) for item in args["schedule_type"].split(",")]
+    lr_range = [float(item) for item in args["lr_range"].split(",")]
+
+    # Build the decoded-image cache once, rather than in every worker
+    task_class = get_task_class(task, model_types[0])
+    task_class.random_state = args["random_state"]
+    task_class.get_train_val_gens(args["input_backend"])
+
+    # Weights of an earlier search of this task are not continued from
+    shutil.rmtree(os.path.join(search_dir, task), ignore_errors=True)
+
+    brackets = get_brackets(args["method"], args["num_trials"], args["min_epochs"], args["max_epochs"], args["eta"])
+    trials = []
+    with ProcessPoolExecutor(
+            max_workers=args["workers"],
+            mp_context=mp.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(args["intra_op_threads"],)) as executor:
+        for bracket, (num_trials, s) in enumerate(brackets):
+            print("[INFO] {} bracket {}: {} trials starting at {} epochs...".format(
+                task, bracket, num_trials, get_rung_epochs(s, args["max_epochs"], args["eta"])[0]))
+            bracket_trials = [{
+                "trial": len(trials) + i,
+                "bracket": bracket,
+                "config": sample_config(rng, model_types, schedule_types, lr_range),
+                "path": os.path.join(search_dir, task, "trial_{}".format(len(trials) + i)),
+                "epochs": 0,
+                "val_acc": None,
+                "seconds": 0.,
+                "rungs": []} for i in range(num_trials)]
+            trials.extend(bracket_trials)
+            run_bracket(executor, task, bracket_trials, s, args)
+    return trials
+
+# Trials which trained the most epochs first, then by validation accuracy
+def write_leaderboard(task, trials, args):
+    leaderboard = sorted(trials, key=lambda trial: (trial["epochs"], trial["val_acc"]), reverse=True)
+    path = get_output_path("search_leaderboard_{}.json".format(task))
+    with open(path, "w") as f:
+        json.dump({"task": task, "search": args, "leaderboard": leaderboard}, f, indent=2)
+
+    print("[INFO] {} leaderboard (written to {}):".format(task, path))
+    for rank, trial in enumerate(leaderboard[:10]):
+        print("  {:2d}. val_acc {:0.4f} after {:2d} epochs: {}".format(
+            rank + 1, trial["val_acc"], trial["epochs"], trial["config"]))
+    return leaderboard
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-k", "--tasks", type=str, default='A1,A2,B1,B2',
+        help="tasks ('A1', 'A2', 'B1', 'B2') to search, one after the other")
+    ap.add_argument("-t", "--model_type", type=str, default='mlp,cnn',
+        help="model types ('mlp', 'cnn') sampled by the search")
+    ap.add_argument("-s", "--schedule_type", type=str, default='one_cycle',
+        help="learning rate schedules sampled by the search")
+    ap.add_argument("-l", "--lr_range", type=str, default='0.0001,0.1',
+        help="lowest and highest learning rate, sampled on a log scale")
+    ap.add_argument("-m", "--method", type=str, default="hyperband", choices=["successive_halving", "hyperband"],
+        help="a single successive halving bracket, or every Hyperband bracket")
+    ap.add_argument("-n", "--num_trials", type=int, default=27,
+        help="configurations sampled by successive halving")
+    ap.add_argument("--min_epochs", type=int, default=1,
+        help="epochs trained before the first trials are stopped")
+    ap.add_argument("--max_epochs", type=int, default=9,
+        help="epochs trained by the best trials")
+    ap.add_argument("--eta", type=int, default=3,
+        help="1/eta of the trials of each rung are promoted to the next")
+    ap.add_argument("-w", "--workers", type=int, default=2,
+        help="trials trained concurrently, each in its own worker process")
+    ap.add_argument("-i", "--input_backend", type=str, default='keras',
+        help="training input pipeline ('keras', 'tf_data')")
+    ap.add_argument("-r", "--random_state", type=int, default=42,
+        help="random state of the training and validation split shared by all trials")
+    ap.add_argument("--seed", type=int, default=0,
+        help="seed of the sampled configurations")
+    ap.add_argument("--intra_op_threads", type=int, default=None,
+        help="cap on the threads used within each operation by each worker")
+    ap.add_argument("--inter_op_threads", type=int, default=None,
+        help="cap on the operations run concurrently by each worker")
+    args = vars(ap.parse_args())
+
+    from pipeline.datasets.utilities import check_train_path
+    # Download the datasets once up front, rather than racing in every worker
+    check_train_path()
+
+    for task in [str(item) for item in args["tasks"].split(",")]:
+        trials = search_task(task, args)
+        write_leaderboard(task, trials, args)
@@ -0,0 +1,48 @@
+# CPU runtime for the int8 TFLite exports of the task models (see quantise.py).
+# Uses the standalone tflite_runtime interpreter when it is installed, so that
+# inference hosts do not need TensorFlow, and falls back to tf.lite otherwise.
+
+import numpy as np
+
+def load_interpreter(model_path, num_threads=None):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+    # Older interpreters do not take the number of threads
+    try:
+        return Interpreter(model_path=model_path, num_threads=num_threads)
+    except TypeError:
+        return Interpreter(model_path=model_path)
+
+# Batch prediction with an exported model. Inputs and outputs are float32 as for
+# the Keras model, the interpreter quantises them at the edges of the graph.
+class Int8Model:
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = load_interpreter(model_path, num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = self.interpreter.get_input_details()[0]["shape"][0]
+
+    # The interpreter is resized only when the batch size changes
+    def resize(self, batch_size):
+        if batch_size != self.batch_size:
+            input_shape = self.interpreter.get_input_details()[0]["shape"]
+            self.interpreter.resize_tensor_input(self.input_index, [batch_size] + list(input_shape[1:]))
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict_on_batch(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        self.resize(len(images))
+        self.interpreter.set_tensor(self.input_index, images)
+        self.interpreter.invoke()
+        # Copied, as the output buffer is reused by the next invocation
+        return np.array(self.interpreter.get_tensor(self.output_index))
+
+    def predict(self, images, batch_size=32):
+        return np.concatenate([self.predict_on_batch(images[i:i + batch_size])
+                               for i in range(0, len(images), batch_size)])
@@ -0,0 +1,171 @@
+# Int8 post-training quantisation of the saved task models.
+# Each model saved by main.py (see saved_models.py) is converted to TFLite with
+# int8 weights and activations. The activation ranges are calibrated on a sample
+# of the task's training images, preprocessed as during training. The float
+# and int8 models are then compared on the test set: accuracy, agreement of
+# their predictions, batch-size-1 and batched CPU latency, and file size.
+# The exports are written next to the saved models as <task>_<model_type>_int8.tflite
+# and can be served with pipeline.serving.server --int8.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with:
+#   python -m pipeline.serving.quantise -k A1,A2,B1,B2
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from pipeline.task_registry import task_names, get_task_class
+from pipeline.datasets.dataset_root import get_output_path
+from pipeline.serving.saved_models import (load_model_info, get_saved_model_file, get_int8_model_file,
+    find_saved_model_types, preprocess_images)
+from pipeline.serving.int8_runtime import Int8Model
+from pipeline.benchmark import summarise_latencies
+
+# Decoded images of a cached sequence, preprocessed in batches of batch_size
+def iterate_images(gen, indices, preprocessing, batch_size):
+    for i in range(0, len(indices), batch_size):
+        batch_indices = np.sort(indices[i:i + batch_size])
+        yield batch_indices, preprocess_images(gen.images[batch_indices].astype(np.float32), preprocessing)
+
+def convert_to_int8(task, model_type, info, num_calibration, seed):
+    import tensorflow as tf
+
+    # The calibration sample is drawn from the training subset, without
+    # augmentation. The task class only gives access to the decoded images.
+    task_class = get_task_class(task, model_type)
+    train_gen, _ = task_class.get_train_val_gens("keras")
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(train_gen.indices, min(num_calibration, len(train_gen.indices)), replace=False)
+
+    def representative_dataset():
+        for _, images in iterate_images(train_gen, indices, info["preprocessing"], 1):
+            yield [images]
+
+    print("[INFO] Quantising {} {} to int8 on {} calibration images...".format(task, model_type, len(indices)))
+    converter = tf.compat.v1.lite.TFLiteConverter.from_keras_model_file(get_saved_model_file(task, model_type))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    path = get_int8_model_file(task, model_type)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(converter.convert())
+    os.replace(tmp_path, path)
+    return path
+
+# Accuracy and batched latency of predict_on_batch over the test images, along
+# with the predicted classes
+def evaluate_model(predict_on_batch, test_gen, indices, preprocessing, batch_size):
+    preds = np.empty(len(indices), dtype=np.int64)
+    labels = np.empty(len(indices), dtype=np.int64)
+    latencies = []
+    i = 0
+    for batch_indices, images in iterate_images(test_gen, indices, preprocessing, batch_size):
+        start = time.time()
+        probs = predict_on_batch(images)
+        latencies.append(time.time() - start)
+        preds[i:i + len(batch_indices)] = np.asarray(probs).argmax(axis=-1)
+        labels[i:i + len(batch_indices)] = test_gen.labels[batch_indices]
+        i += len(batch_indices)
+
+    return preds, {
+        "accuracy": float(np.mean(preds == labels)),
+        "batched": summarise_latencies(latencies, batch_size)}
+
+def measure_latency(predict_on_batch, image, num_runs):
+    predict_on_batch(image)
+    latencies = []
+    for _ in range(num_runs):
+        start = time.time()
+        predict_on_batch(image)
+        latencies.append(time.time() - start)
+    return summarise_latencies(latencies, 1)
+
+def compare_models(task, model_type, info, int8_path, num_test, batch_size, latency_runs, num_threads):
+    from tensorflow.keras.models import load_model
+
+    task_class = get_task_class(task, model_type)
+    test_gen = task_class.get_test_gen()
+    indices = test_gen.indices[:num_test] if num_test is not None else test_gen.indices
+    preprocessing = info["preprocessing"]
+    _, first_image = next(iterate_images(test_gen, indices[:1], preprocessing, 1))
+
+    print("[INFO] Comparing float and int8 {} {} on {} test images...".format(task, model_type, len(indices)))
+    float_model = load_model(get_saved_model_file(task, model_type), compile=False)
+    int8_model = Int8Model(int8_path, num_threads)
+
+    report = {"task": task, "model_type": model_type, "test_images": len(indices)}
+    preds = {}
+    for name, predict_on_batch, path in [
+            ("float", float_model.predict_on_batch, get_saved_model_file(task, model_type)),
+            ("int8", int8_model.predict_on_batch, int8_path)]:
+        preds[name], result = evaluate_model(predict_on_batch, test_gen, indices, preprocessing, batch_size)
+        result["batch_size_1"] = measure_latency(predict_on_batch, first_image, latency_runs)
+        result["size_mb"] = os.path.getsize(path) / 2.**20
+        report[name] = result
+
+    report["agreement"] = float(np.mean(preds["float"] == preds["int8"]))
+    report["accuracy_drop"] = report["float"]["accuracy"] - report["int8"]["accuracy"]
+    report["batch_size_1_speedup"] = report["float"]["batch_size_1"]["p50_ms"] / report["int8"]["batch_size_1"]["p50_ms"]
+    report["batched_speedup"] = report["float"]["batched"]["mean_ms"] / report["int8"]["batched"]["mean_ms"]
+    return report
+
+def print_report(report):
+    print("[INFO] {} {}: accuracy {:0.4f} -> {:0.4f} (agreement {:0.4f}), "
+          "p50 latency {:0.1f} -> {:0.1f} ms, batched {:0.0f} -> {:0.0f} images/sec, "
+          "size {:0.1f} -> {:0.1f} MB".format(
+              report["task"], report["model_type"],
+              report["float"]["accuracy"], report["int8"]["accuracy"], report["agreement"],
+              report["float"]["batch_size_1"]["p50_ms"], report["int8"]["batch_size_1"]["p50_ms"],
+              report["float"]["batched"]["images_per_sec"], report["int8"]["batched"]["images_per_sec"],
+              report["float"]["size_mb"], report["int8"]["size_mb"]))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-k", "--tasks", type=str, default='A1,A2,B1,B2',
+        help="choose which of the tasks ('A1', 'A2', 'B1', 'B2') to quantise")
+    ap.add_argument("-t", "--model_type", type=str, default=None,
+        help="model type ('mlp', 'cnn', 'xception') to quantise for each of the tasks, defaults to the latest saved")
+    ap.add_argument("-c", "--num_calibration", type=int, default=200,
+        help="training images used to calibrate the activation ranges")
+    ap.add_argument("-n", "--num_test", type=int, default=None,
+        help="test images used for the comparison, the whole test set by default")
+    ap.add_argument("-b", "--batch_size", type=int, default=32,
+        help="batch size of the batched latency")
+    ap.add_argument("--latency_runs", type=int, default=50,
+        help="timed calls for the batch-size-1 latency")
+    ap.add_argument("--num_threads", type=int, default=None,
+        help="threads used by the int8 interpreter")
+    ap.add_argument("--seed", type=int, default=0,
+        help="seed of the calibration sample")
+    ap.add_argument("-o", "--output", type=str, default=get_output_path("quantisation_report.json"),
+        help="path of the JSON report")
+    args = vars(ap.parse_args())
+    tasks = [str(item) for item in args["tasks"].split(",")]
+    model_types = {}
+    if args["model_type"] is not None:
+        model_types = dict(zip(task_names, [str(item) for item in args["model_type"].split(",")]))
+
+    reports = []
+    for task in tasks:
+        model_type = model_types.get(task)
+        if model_type is None:
+            saved_types = find_saved_model_types(task)
+            if not saved_types:
+                print("[INFO] No saved model for {}, skipping".format(task))
+                continue
+            model_type = saved_types[0]
+
+        info = load_model_info(task, model_type)
+        int8_path = convert_to_int8(task, model_type, info, args["num_calibration"], args["seed"])
+        report = compare_models(task, model_type, info, int8_path, args["num_test"], args["batch_size"],
+                                args["latency_runs"], args["num_threads"])
+        print_report(report)
+        reports.append(report)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args["output"])), exist_ok=True)
+    with open(args["output"], "w") as f:
+        json.dump({"config": args, "models": reports}, f, indent=2)
+    print("[INFO] Quantisation report written to {}".format(args["output"]))
@@ -0,0 +1,83 @@
+# Saving and loading the final trained model of each task.
+# Each model is stored as <task>_<model_type>.h5 in the saved_models folder,
+# with a JSON file describing how its inputs were prepared during training
+# (input size and preprocessing) and the class names of its outputs.
+
+import json
+import os
+from pipeline.datasets.dataset_root import saved_models_dir, get_saved_model_path
+
+def get_model_name(task, model_type):
+    return "{}_{}".format(task, model_type)
+
+# The Xception models were trained on preprocess_input followed by the 1/255
+# rescaling of the generators, the MLP and CNN models on the rescaling only
+def get_preprocessing(model_type):
+    return "xception" if model_type == "xception" else "rescale"
+
+# Preprocess a float array of images (pixel values 0-255) as during training.
+# The Xception preprocess_input scales pixels to [-1, 1], which is done with
+# numpy here so that int8 inference hosts do not need TensorFlow.
+def preprocess_images(x, preprocessing):
+    if preprocessing == "xception":
+        x = x / 127.5 - 1.
+    return x * (1./255)
+
+# Save a trained task object (e.g. an A1Xception) after training
+def save_task_model(task, model_type, task_model):
+    save_model(
+        task,
+        model_type,
+        task_model.model,
+        task_model.height,
+        task_model.width,
+        task_model.get_train_labels().classes)
+
+# Save the Keras model of a task, with the input size and class names it was
+# trained with
+def save_model(task, model_type, model, height, width, classes):
+    os.makedirs(saved_models_dir, exist_ok=True)
+    name = get_model_name(task, model_type)
+    model_path = get_saved_model_path(name + ".h5")
+    info_path = get_saved_model_path(name + ".json")
+
+    info = {
+        "task": task,
+        "model_type": model_type,
+        "height": height,
+        "width": width,
+        "preprocessing": get_preprocessing(model_type),
+        "classes": [str(c) for c in classes]}
+
+    print("[INFO] Saving {} model to {}...".format(task, model_path))
+    # Keras picks the file format from the extension, so it is kept last. The
+    # optimizer is left out: saved models are loaded with compile=False, and
+    # its scheduled hyperparameters cannot be serialised.
+    tmp_model_path = "{}.{}.tmp.h5".format(model_path[:-3], os.getpid())
+    model.save(tmp_model_path, include_optimizer=False)
+    os.replace(tmp_model_path, model_path)
+
+    tmp_info_path = "{}.{}.tmp".format(info_path, os.getpid())
+    with open(tmp_info_path, "w") as f:
+        json.dump(info, f)
+    os.replace(tmp_info_path, info_path)
+
+def load_model_info(task, model_type):
+    with open(get_saved_model_path(get_model_name(task, model_type) + ".json")) as f:
+        return json.load(f)
+
+def get_saved_model_file(task, model_type):
+    return get_saved_model_path(get_model_name(task, model_type) + ".h5")
+
+# The int8 TFLite export of a saved model, see quantise.py
+def get_int8_model_file(task, model_type):
+    return get_saved_model_path(get_model_name(task, model_type) + "_int8.tflite")
+
+# Model types saved for a task, most recently saved first
+def find_saved_model_types(task):
+    model_types = []
+    for model_type in ["mlp", "cnn", "xception", "mlp_distilled", "cnn_distilled"]:
+        path = get_saved_model_file(task, model_type)
+        if os.path.exists(path) and os.path.exists(path[:-3] + ".json"):
+            model_types.append((os.path.getmtime(path), model_type))
+    return [model_type for _, model_type in sorted(model_types, reverse=True)]
@@ -0,0 +1,277 @@
+# Local inference server for the trained A1, A2, B1 and B2 models.
+# Serves the models saved by main.py (see saved_models.py) over HTTP on
+# localhost, using only the standard library on top of the training stack.
+# Concurrent requests for a task are grouped into micro-batches: a batch is run
+# as soon as it is full or the oldest request in it has waited for the latency
+# budget. Images are decoded and preprocessed on the request threads, so only
+# the model itself runs on the batching thread.
+#
+# Run in the AMLS_19-20_Raphael_Angelo_Floresca_SN16011494 folder with:
+#   python -m pipeline.serving.server --port 8000
+# Endpoints:
+#   POST /predict/<task>  raw image bytes, or JSON {"path": ...} / {"paths": [...]}
+#   GET /models           the served models and their preprocessing
+#   GET /stats            p50/p99 latency, throughput and mean batch size per task
+# With --int8, the int8 exports written by quantise.py are served instead,
+# without importing TensorFlow when tflite_runtime is installed.
+
+import argparse
+import collections
+import io
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
+from pipeline.task_registry import task_names
+from pipeline.serving.saved_models import (load_model_info, get_saved_model_file, get_int8_model_file,
+    find_saved_model_types, preprocess_images)
+
+# Latencies of the most recent requests, used for the percentiles
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.num_requests = 0
+        self.start_time = time.time()
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.num_requests += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            num_requests = self.num_requests
+        elapsed = time.time() - self.start_time
+        if len(latencies) == 0:
+            return {"requests": 0}
+        return {
+            "requests": num_requests,
+            "p50_latency_ms": float(np.percentile(latencies, 50)),
+            "p99_latency_ms": float(np.percentile(latencies, 99)),
+            "throughput_images_per_sec": num_requests / max(elapsed, 1e-9),
+            "mean_batch_size": float(batch_sizes.mean())}
+
+class PendingRequest:
+    def __init__(self, image):
+        self.image = image
+        self.enqueue_time = time.time()
+        self.done = threading.Event()
+        self.probs = None
+        self.error = None
+
+# Groups requests into batches of up to max_batch_size, waiting at most
+# max_latency_ms after the first request of a batch for more to arrive
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch_size, max_latency_ms, stats):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.stats = stats
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Submit a list of preprocessed images and wait for their probabilities
+    def predict(self, images):
+        pending = [PendingRequest(image) for image in images]
+        for request in pending:
+            self.requests.put(request)
+        for request in pending:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+        return np.array([request.probs for request in pending])
+
+    def collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].enqueue_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                probs = self.predict_fn(np.stack([request.image for request in batch]))
+                for request, request_probs in zip(batch, probs):
+                    request.probs = request_probs
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            end_time = time.time()
+            self.stats.record_batch([end_time - request.enqueue_time for request in batch])
+            for request in batch:
+                request.done.set()
+
+# A saved task model with its preprocessing and micro-batcher
+# With int8, the int8 TFLite export of the model is served instead
+class ServedModel:
+    def __init__(self, task, model_type, max_batch_size, max_latency_ms, int8=False):
+        self.info = load_model_info(task, model_type)
+        self.int8 = int8
+        if int8:
+            from pipeline.serving.int8_runtime import Int8Model
+
+            print("[INFO] Loading {} {} int8 model...".format(task, model_type))
+            self.model = Int8Model(get_int8_model_file(task, model_type))
+        else:
+            import tensorflow as tf
+            from tensorflow.keras import backend as K
+            from tensorflow.keras.models import load_model
+
+            print("[INFO] Loading {} {} model...".format(task, model_type))
+            self.model = load_model(get_saved_model_file(task, model_type), compile=False)
+            # Build the predict function up front, as Keras graphs and sessions
+            # are not shared with the batching thread implicitly
+            if hasattr(self.model, "_make_predict_function"):
+                self.model._make_predict_function()
+            self.graph = tf.compat.v1.get_default_graph()
+            self.session = K.get_session()
+
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(self.predict_on_batch, max_batch_size, max_latency_ms, self.stats)
+
+    def predict_on_batch(self, images):
+        if self.int8:
+            return self.model.predict_on_batch(images)
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict_on_batch(images)
+
+    # Decode an image from a path or the bytes of an upload, in the same way as
+    # for training: resized to the model input, then Xception preprocess_input
+    # (for the Xception models) followed by the 1/255 rescaling. PIL is used
+    # directly, as Keras' load_img does, so int8 hosts do not need TensorFlow.
+    def preprocess(self, image):
+        from PIL import Image
+
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+        with Image.open(image) as img:
+            img = img.convert("RGB").resize((self.info["width"], self.info["height"]), Image.NEAREST)
+            x = np.asarray(img, dtype=np.float32)
+        return preprocess_images(x, self.info["preprocessing"])
+
+    def predict(self, images):
+        probs = self.batcher.predict([self.preprocess(image) for image in images])
+        return [{
+            "class": self.info["classes"][int(p.argmax())],
+            "class_index": int(p.argmax()),
+            "probabilities": [float(prob) for prob in p]} for p in probs]
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def create_handler(served_models):
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/models":
+                self.send_json(200, {task: model.info for task, model in served_models.items()})
+            elif self.path == "/stats":
+                self.send_json(200, {task: model.stats.summary() for task, model in served_models.items()})
+            else:
+                self.send_json(404, {"error": "unknown endpoint {}".format(self.path)})
+
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "predict":
+                self.send_json(404, {"error": "unknown endpoint {}".format(self.path)})
+                return
+            if parts[1] not in served_models:
+                self.send_json(404, {"error": "no model served for task {}".format(parts[1])})
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                try:
+                    request = json.loads(body.decode())
+                    images = request["paths"] if "paths" in request else [request["path"]]
+                except (ValueError, KeyError) as e:
+                    self.send_json(400, {"error": "expected {{\"path\": ...}} or {{\"paths\": [...]}}: {}".format(e)})
+                    return
+            else:
+                images = [body]
+
+            try:
+                predictions = served_models[parts[1]].predict(images)
+            except (IOError, OSError, ValueError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+                return
+            self.send_json(200, {"task": parts[1], "predictions": predictions})
+
+        # Requests are counted in /stats rather than logged one by one
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+# Load the selected model of each task, defaulting to the most recently saved one
+def load_served_models(tasks, model_types, max_batch_size, max_latency_ms, int8=False):
+    served_models = {}
+    for task in tasks:
+        model_type = model_types.get(task)
+        if model_type is None:
+            saved_types = find_saved_model_types(task)
+            if not saved_types:
+                print("[INFO] No saved model for {}, skipping".format(task))
+                continue
+            model_type = saved_types[0]
+        served_models[task] = ServedModel(task, model_type, max_batch_size, max_latency_ms, int8)
+    return served_models
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", type=str, default="127.0.0.1",
+        help="address to listen on")
+    ap.add_argument("--port", type=int, default=8000,
+        help="port to listen on")
+    ap.add_argument("-k", "--tasks", type=str, default='A1,A2,B1,B2',
+        help="choose which of the tasks ('A1', 'A2', 'B1', 'B2') to serve")
+    ap.add_argument("-t", "--model_type", type=str, default=None,
+        help="model type ('mlp', 'cnn', 'xception') to serve for each of the tasks, defaults to the latest saved")
+    ap.add_argument("-b", "--max_batch_size", type=int, default=32,
+        help="largest micro-batch run by a model")
+    ap.add_argument("-m", "--max_latency_ms", type=float, default=10.,
+        help="longest time a request waits for its micro-batch to fill")
+    ap.add_argument("--int8", action="store_true",
+        help="serve the int8 exports written by pipeline.serving.quantise")
+    args = vars(ap.parse_args())
+    tasks = [str(item) for item in args["tasks"].split(",")]
+    model_types = {}
+    if args["model_type"] is not None:
+        model_types = dict(zip(task_names, [str(item) for item in args["model_type"].split(",")]))
+
+    served_models = load_served_models(tasks, model_types, args["max_batch_size"], args["max_latency_ms"], args["int8"])
+    server = ThreadingHTTPServer((args["host"], args["port"]), create_handler(served_models))
+    print("[INFO] Serving {} on http://{}:{}".format(", ".join(served_models), args["host"], args["port"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for task, model in served_models.items():
+        print("[INFO] {}: {}".format(task, model.stats.summary()))
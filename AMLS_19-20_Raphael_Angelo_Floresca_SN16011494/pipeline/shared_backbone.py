@@ -0,0 +1,143 @@
+# Runs the tasks sharing an image set as a single multi-head model.
+# A1 (gender) and A2 (smiling) are both labelled on the celeba images, B1 (face
+# shape) and B2 (eye colour) on the cartoon_set images. Instead of one model per
+# task, each image set gets one model with a head per task (see
+# pipeline.models.multi_head), trained from a single input yielding the labels
+# of both tasks, then tested and saved for pipeline.serving task by task.
+
+from pipeline.task_registry import get_task_class
+from pipeline.datasets.dataset_root import get_output_path
+
+# Tasks labelled on the same image set, keyed by its image directory, with the
+# names of its (training, test) dataset roots in pipeline.datasets.utilities,
+# which is only imported once a shared model is run
+shared_image_sets = {
+    "celeba": {"tasks": ["A1", "A2"], "roots": ("celeba_root", "celeba_test_root")},
+    "cartoon_set": {"tasks": ["B1", "B2"], "roots": ("cartoon_set_root", "cartoon_set_test_root")}
+}
+
+# Backbones a multi-head model can be built on. Distilled students are trained
+# per task, against their task's teacher.
+multi_head_model_types = ["mlp", "cnn", "xception"]
+
+# Image sets with more than one of the selected tasks, mapped to those tasks
+def get_shared_task_groups(tasks):
+    groups = {}
+    for image_set, info in shared_image_sets.items():
+        shared_tasks = [task for task in info["tasks"] if task in tasks]
+        if len(shared_tasks) > 1:
+            groups[image_set] = shared_tasks
+    return groups
+
+# Build, train and test the multi-head model of an image set, returning a
+# dictionary of task name -> (validation accuracy, test accuracy). The first
+# task's settings are used for the shared model.
+def run_shared_backbone(
+        image_set,
+        tasks,
+        model_type,
+        epochs,
+        learning_rate,
+        schedule_type,
+        random_state,
+        step_timing=None,
+        budget=None):
+    from tensorflow.keras import backend as K
+    from tensorflow.keras import Model
+    from tensorflow.keras.applications.xception import preprocess_input
+    from pipeline.datasets import utilities
+    from pipeline.models.multi_head import train_multi_head
+    from pipeline.models.artifact_store import get_task_artifact
+    from pipeline.plotting.plotting import plot_multi_head_loss_acc_lr, plot_top_losses_data
+    from pipeline.evaluation.streaming import evaluate_streaming_multi_head
+    from pipeline.optimisation.step_timing import get_step_timing_path
+    from pipeline.optimisation.adaptive_budget import get_val_acc
+    from pipeline.serving.saved_models import save_model
+
+    dataset_root, test_root = [getattr(utilities, root) for root in shared_image_sets[image_set]["roots"]]
+    task_classes = {task: get_task_class(task, model_type) for task in tasks}
+    first_class = task_classes[tasks[0]]
+    height, width, batch_size = first_class.height, first_class.width, first_class.batch_size
+    if random_state is None:
+        random_state = first_class.random_state
+    preprocessing_function = preprocess_input if model_type == "xception" else None
+    num_classes = {task: task_classes[task].num_classes for task in tasks}
+    name = "_".join(tasks)
+
+    train_labels = {task: task_classes[task].get_train_labels() for task in tasks}
+    train_gen, val_gen = utilities.create_multi_label_datagens(
+        height,
+        width,
+        train_labels,
+        image_set,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        dataset_root)
+
+    # Trained weights are reused by runs with the same configuration
+    artifact = get_task_artifact(
+        name,
+        model_type + "_multi_head",
+        dataset_root,
+        height=height,
+        width=width,
+        batch_size=batch_size,
+        epochs=epochs,
+        learning_rate=learning_rate,
+        schedule_type=schedule_type,
+        random_state=random_state,
+        budget=budget.config if budget is not None else None)
+
+    print("[INFO] Training {} multi-head {} for {}...".format(image_set, model_type, ", ".join(tasks)))
+    model, history, schedule = train_multi_head(
+        model_type,
+        height,
+        width,
+        num_classes,
+        batch_size,
+        epochs,
+        learning_rate,
+        schedule_type,
+        train_gen,
+        val_gen,
+        get_step_timing_path("{}_{}_multi_head".format(name, model_type), step_timing),
+        artifact,
+        budget)
+
+    plot_multi_head_loss_acc_lr(
+        history,
+        len(history.history["loss"]),
+        schedule,
+        tasks,
+        name,
+        get_output_path("train_loss_acc_{}_{}_multi_head.png".format(name, model_type)),
+        get_output_path("lr_{}_{}_multi_head.png".format(name, model_type)))
+
+    test_labels = {task: task_classes[task].get_test_labels() for task in tasks}
+    test_gen = utilities.create_multi_label_test_datagen(
+        height,
+        width,
+        test_labels,
+        image_set,
+        batch_size,
+        random_state,
+        preprocessing_function,
+        test_root)
+    evaluations = evaluate_streaming_multi_head(model, test_gen, num_classes)
+
+    results = {}
+    for task in tasks:
+        loss_pred_data, loss_images = evaluations[task].get_loss_pred_data()
+        plot_top_losses_data(loss_pred_data, loss_images,
+            get_output_path("plot_top_losses_{}_{}_multi_head.png".format(task, model_type)))
+
+        # Each task is served by the backbone with its own head only
+        task_model = Model(inputs=model.input, outputs=model.get_layer(task).output)
+        save_model(task, model_type, task_model, height, width, train_labels[task].classes)
+
+        results[task] = (get_val_acc(history, task), evaluations[task].accuracy)
+
+    # Clear GPU memory
+    K.clear_session()
+    return results
@@ -0,0 +1,96 @@
+# Lazy registry of the task classes.
+# Task modules are only imported once a task is selected, so tasks which are
+# not run never load their dataframes or build their generators.
+
+import importlib
+from pipeline.serving.saved_models import save_task_model, get_saved_model_file
+
+task_names = ["A1", "A2", "B1", "B2"]
+
+task_registry = {
+    "A1": {"mlp": "A1.a1:A1MLP", "cnn": "A1.a1:A1CNN", "xception": "A1.a1:A1Xception",
+           "cnn_distilled": "A1.a1:A1Distilled", "mlp_distilled": "A1.a1:A1Distilled"},
+    "A2": {"mlp": "A2.a2:A2MLP", "cnn": "A2.a2:A2CNN", "xception": "A2.a2:A2Xception",
+           "cnn_distilled": "A2.a2:A2Distilled", "mlp_distilled": "A2.a2:A2Distilled"},
+    "B1": {"mlp": "B1.b1:B1MLP", "cnn": "B1.b1:B1CNN", "xception": "B1.b1:B1Xception",
+           "cnn_distilled": "B1.b1:B1Distilled", "mlp_distilled": "B1.b1:B1Distilled"},
+    "B2": {"mlp": "B2.b2:B2MLP", "cnn": "B2.b2:B2CNN", "xception": "B2.b2:B2Xception",
+           "cnn_distilled": "B2.b2:B2Distilled", "mlp_distilled": "B2.b2:B2Distilled"}
+}
+
+def get_task_class(task, model_type):
+    module_name, class_name = task_registry[task][model_type].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+# Build, train and test a single task, returning its validation and test accuracy
+def run_task(
+        task,
+        model_type,
+        epochs,
+        learning_rate,
+        schedule_type,
+        find_lr,
+        random_state,
+        cache_features=False,
+        input_backend="keras",
+        step_timing=None,
+        patience=None,
+        min_delta=0.,
+        time_budget=None,
+        data_parallel=False,
+        cache_eval_batches=False):
+    from tensorflow.keras import backend as K
+    from pipeline.optimisation.adaptive_budget import TrainingBudget
+    from pipeline.distributed import create_strategy, is_chief
+
+    # With patience or a time budget (in minutes), --epochs is an upper bound
+    budget = None
+    if patience is not None or time_budget is not None:
+        budget = TrainingBudget(patience, min_delta, time_budget)
+
+    # Data-parallel runs train one replica per worker of the TF_CONFIG cluster,
+    # see pipeline.distributed
+    strategy = None
+    if data_parallel:
+        if model_type not in ["mlp", "cnn", "xception"] or find_lr == True or cache_features:
+            raise ValueError("Data-parallel training supports training the mlp, cnn and xception models only")
+        if budget is not None:
+            raise ValueError("Data-parallel workers must run the same epochs, the adaptive budget is not supported")
+        if input_backend != "tf_data":
+            print("[INFO] Data-parallel training reads its shard with the 'tf_data' input backend")
+            input_backend = "tf_data"
+        strategy = create_strategy()
+
+    task_class = get_task_class(task, model_type)
+    if model_type == "xception":
+        model = task_class(epochs, learning_rate, schedule_type, find_lr, random_state, cache_features,
+            input_backend=input_backend, step_timing=step_timing, budget=budget, strategy=strategy,
+            cache_eval_batches=cache_eval_batches)   # Build model object.
+    elif model_type.endswith("_distilled"):
+        # Distilled students always read the decoded-image cache
+        model = task_class(epochs, learning_rate, schedule_type, find_lr, random_state,
+            model_type[:-len("_distilled")], step_timing=step_timing, budget=budget)   # Build model object.
+    else:
+        model = task_class(epochs, learning_rate, schedule_type, find_lr, random_state,
+            input_backend=input_backend, step_timing=step_timing, budget=budget, strategy=strategy,
+            cache_eval_batches=cache_eval_batches)   # Build model object.
+
+    # Only the chief of a data-parallel run plots, saves and tests the model
+    if strategy is not None and not is_chief():
+        K.clear_session()
+        return None, None
+
+    acc_train = model.train()   # Train model based on the training set (you should fine-tune your model based on validation set.)
+    acc_test = 'TBD'
+    if find_lr != True:
+        # Keep the trained model for pipeline.serving
+        save_task_model(task, model_type, model)
+        if strategy is not None:
+            # The test set is predicted by a copy of the model outside the strategy
+            from tensorflow.keras.models import load_model
+            model.model = load_model(get_saved_model_file(task, model_type), compile=False)
+        acc_test = model.test() # Test model based on the test set.
+
+    # Clear GPU memory
+    K.clear_session()
+    return acc_train, acc_test
@@ -0,0 +1,28 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from pipeline.datasets.download_data import extract_zip, get_missing_members
+
+class ExtractZipTest(unittest.TestCase):
+    # Nested directories extracted by several workers into an empty folder
+    def test_extract_nested_directories_in_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = os.path.join(tmp_dir, "dataset.zip")
+            members = ["dataset/{}/{}/img_{}.txt".format(split, i % 3, i)
+                       for split in ["celeba", "cartoon_set"] for i in range(60)]
+            with zipfile.ZipFile(zip_path, "w") as zf:
+                for member in members:
+                    zf.writestr(member, member)
+
+            dest_dir = os.path.join(tmp_dir, "data")
+            os.makedirs(dest_dir)
+            extract_zip(zip_path, dest_dir, num_workers=8)
+
+            self.assertEqual(get_missing_members(zip_path, dest_dir), [])
+            for member in members:
+                with open(os.path.join(dest_dir, member)) as f:
+                    self.assertEqual(f.read(), member)
+
+if __name__ == "__main__":
+    unittest.main()